@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 from trytond.pool import Pool
 from product import (
-    Product, ProductsRelated, ProductTemplate, ProductMedia, ProductCategory
+    Product, ProductsRelated, ProductTemplate, ProductMedia, ProductCategory,
+    ProductUriRedirect, ProductDeletion, ProductFeed,
+    ProductAvailabilityRefresh
 )
 from website import WebSite
 
@@ -13,6 +15,10 @@ def register():
         ProductCategory,
         ProductMedia,
         ProductsRelated,
+        ProductUriRedirect,
+        ProductDeletion,
+        ProductFeed,
+        ProductAvailabilityRefresh,
         WebSite,
         module='nereid_catalog', type_='model'
     )
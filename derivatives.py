@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-generation of the image derivatives (thumbnails) of product media.
+
+The images of products are served in the sizes of the listings, the zoom
+and the thumbnails through the transformation route of
+`nereid_image_transformation`, which generates a derivative on the first
+request for it and keeps it in a file. The functions of this module
+generate those files beforehand, so that visitors never wait for them:
+
+* when media are created or their file changes, their derivatives are
+  generated in a pool of threads of the process once the transaction is
+  committed (see :meth:`ProductMedia.enqueue_derivatives`), when the
+  `derivative_workers` option of the `nereid_catalog` section of the
+  configuration gives the number of threads::
+
+    [nereid_catalog]
+    derivative_workers = 2
+
+* the derivatives of the whole catalog can be generated by processes in
+  parallel with :func:`backfill_derivatives`, which can be interrupted and
+  resumed::
+
+    python -m trytond.modules.nereid_catalog.derivatives -c trytond.conf \\
+        --processes 8 --checkpoint /var/tmp/derivatives.json <database>
+"""
+import os
+import json
+import logging
+import argparse
+from datetime import datetime
+from multiprocessing import Pool as ProcessPool
+from multiprocessing.pool import ThreadPool
+from tempfile import gettempdir
+from threading import Lock
+
+from flask import Flask
+from werkzeug.utils import secure_filename
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
+from trytond.modules.nereid_image_transformation.static_file import \
+    TransformationCommand
+
+__all__ = [
+    'DERIVATIVES_FOLDER', 'get_derivative_filename', 'generate_derivatives',
+    'DerivativesDataManager', 'DerivativeQueue', 'derivative_queue',
+    'backfill_derivatives',
+]
+
+logger = logging.getLogger('nereid_catalog.derivatives')
+
+
+#: The folder in which the transformation route of
+#: `nereid_image_transformation` keeps the derivatives, the `nereid` folder
+#: of the temporary directory unless given by the `derivatives_folder`
+#: option of the `nereid_catalog` section of the configuration, which must
+#: be the folder the route writes to
+DERIVATIVES_FOLDER = config.get(
+    'nereid_catalog', 'derivatives_folder',
+    default=os.path.join(gettempdir(), 'nereid')
+)
+
+# The application of the request contexts in which the transformation route
+# is called outside of requests
+_transform_app = Flask(__name__)
+
+
+def get_derivative_filename(database_name, file_id, commands, extension):
+    """
+    Return the name of the file in which the transformation route keeps the
+    derivative of a static file
+    """
+    return os.path.join(
+        DERIVATIVES_FOLDER, database_name, str(file_id),
+        '%s.%s' % (secure_filename(commands), extension)
+    )
+
+
+def generate_derivatives(file_ids, sizes):
+    """
+    Generate the missing or outdated thumbnails of the static files, in the
+    current transaction, and return the number of thumbnails generated.
+
+    The files which are not images are skipped and the errors are logged.
+
+    :param file_ids: The IDs of the static files
+    :param sizes: A list of `(width, height)` of the thumbnails
+    """
+    StaticFile = Pool().get('nereid.static.file')
+    database_name = Transaction().database.name
+
+    count = 0
+    for static_file in StaticFile.browse(file_ids):
+        if 'image' not in (static_file.mimetype or ''):
+            continue
+        extension = os.path.splitext(static_file.name)[1][1:] or 'png'
+        modified = static_file.write_date or static_file.create_date
+        for width, height in sizes:
+            commands = unicode(
+                TransformationCommand().thumbnail(width, height, 'a')
+            )
+            filename = get_derivative_filename(
+                database_name, static_file.id, commands, extension
+            )
+            if os.path.exists(filename) and datetime.utcfromtimestamp(
+                    os.path.getmtime(filename)) >= modified:
+                continue
+            # The route writes the derivative and sends it
+            try:
+                with _transform_app.test_request_context():
+                    static_file.transform_static_file(
+                        commands, extension
+                    ).close()
+            except Exception:
+                logger.exception(
+                    'Derivative %s of %s failed', commands, static_file.name
+                )
+                continue
+            count += 1
+    return count
+
+
+def _generate_in_transaction(database_name, file_ids, sizes):
+    with Transaction().start(database_name, 0, readonly=True):
+        return generate_derivatives(file_ids, sizes)
+
+
+def _generate_in_background(database_name, file_ids, sizes):
+    try:
+        _generate_in_transaction(database_name, file_ids, sizes)
+    except Exception:
+        logger.exception('Derivatives of the files %s failed', file_ids)
+
+
+class DerivativeQueue(object):
+    """
+    A pool of threads generating derivatives in the background, each batch
+    in its own transaction
+    """
+
+    def __init__(self):
+        self._pool = None
+        self._lock = Lock()
+
+    def put(self, database_name, file_ids, sizes, workers):
+        """
+        Queue the generation of the derivatives of the static files
+
+        :param workers: The number of threads of the pool, when created
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(workers)
+        self._pool.apply_async(
+            _generate_in_background, (database_name, file_ids, sizes)
+        )
+
+
+#: The derivative generation queue of the process
+derivative_queue = DerivativeQueue()
+
+
+class DerivativesDataManager(object):
+    """
+    A data manager of a transaction which queues the generation of the
+    derivatives of static files once the transaction is committed, so that
+    the workers see the files.
+    """
+
+    def __init__(self, database_name):
+        self.database_name = database_name
+        self.file_ids = set()
+        self.sizes = []
+        self.workers = 1
+
+    def __eq__(self, other):
+        if not isinstance(other, DerivativesDataManager):
+            return NotImplemented
+        return self.database_name == other.database_name
+
+    def add(self, file_ids, sizes, workers):
+        self.file_ids.update(file_ids)
+        self.sizes = sizes
+        self.workers = workers
+
+    def abort(self, trans):
+        self.file_ids.clear()
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        if self.file_ids:
+            derivative_queue.put(
+                self.database_name, sorted(self.file_ids), self.sizes,
+                self.workers
+            )
+        self.file_ids.clear()
+
+    def tpc_abort(self, trans):
+        self.file_ids.clear()
+
+
+def _init_process(database_name):
+    Pool(database_name).init()
+
+
+def _backfill_batch(args):
+    database_name, file_ids, sizes = args
+    return file_ids[-1], len(file_ids), _generate_in_transaction(
+        database_name, file_ids, sizes
+    )
+
+
+def _read_checkpoint(checkpoint):
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as checkpoint_file:
+            return json.load(checkpoint_file)['last_id']
+    return 0
+
+
+def _write_checkpoint(checkpoint, last_id):
+    with open(checkpoint + '.tmp', 'w') as checkpoint_file:
+        json.dump({'last_id': last_id}, checkpoint_file)
+    os.rename(checkpoint + '.tmp', checkpoint)
+
+
+def backfill_derivatives(
+        database_name, processes=4, checkpoint=None, batch_size=100):
+    """
+    Generate the derivatives of the static files of all the product media
+    with a pool of processes and return the number of derivatives
+    generated.
+
+    The static files are processed in the order of their IDs and the ID of
+    the last file of the batches done is written to the checkpoint file, if
+    any, from which a later call resumes.
+
+    :param database_name: The name of the database
+    :param processes: The number of processes
+    :param checkpoint: The name of the checkpoint file
+    :param batch_size: The number of static files per batch
+    """
+    Pool.start()
+    # The processes are forked before any connection to the database is
+    # opened, as connections can not be shared with child processes
+    process_pool = ProcessPool(
+        processes, initializer=_init_process, initargs=(database_name,)
+    )
+    last_id = _read_checkpoint(checkpoint)
+
+    pool = Pool(database_name)
+    pool.init()
+    with Transaction().start(database_name, 0, readonly=True):
+        Media = pool.get('product.media')
+        media = Media.__table__()
+        cursor = Transaction().connection.cursor()
+
+        sizes = Media.get_derivative_sizes()
+        cursor.execute(*media.select(
+            media.static_file,
+            where=media.static_file > last_id,
+            group_by=media.static_file,
+            order_by=media.static_file.asc
+        ))
+        file_ids = [file_id for file_id, in cursor.fetchall()]
+
+    generated = 0
+    try:
+        for batch_last_id, files, count in process_pool.imap(
+                _backfill_batch, [
+                    (database_name, list(ids), sizes)
+                    for ids in grouped_slice(file_ids, batch_size)
+                ]):
+            generated += count
+            if checkpoint:
+                _write_checkpoint(checkpoint, batch_last_id)
+            logger.info(
+                '%d derivatives generated for %d files up to %d',
+                count, files, batch_last_id
+            )
+    finally:
+        process_pool.terminate()
+        process_pool.join()
+    return generated
+
+
+def main():
+    from trytond.config import config
+
+    parser = argparse.ArgumentParser(
+        description='Generate the image derivatives of the product media'
+    )
+    parser.add_argument('database_name')
+    parser.add_argument('-c', '--config', dest='config_file')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--checkpoint')
+    parser.add_argument('--batch-size', type=int, default=100)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config.update_etc(options.config_file)
+    generated = backfill_derivatives(
+        options.database_name, options.processes, options.checkpoint,
+        options.batch_size
+    )
+    logger.info('%d derivatives generated', generated)
+
+
+if __name__ == '__main__':
+    main()
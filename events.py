@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Change events of the catalog.
+
+The models of the catalog publish an event on each creation, modification
+and deletion of their records with :func:`publish`, giving the IDs and
+fields changed and the IDs of the products affected. The handlers
+subscribed to :data:`event_bus` receive them:
+
+* at once in the process making the change, within its transaction
+* once the transaction is committed in the other processes, when the bus
+  is shared between them, without a transaction
+
+The bus is local to the process unless the `event_bus` option of the
+`nereid_catalog` section of the configuration gives an SQLite file shared
+by the processes of the server (see :class:`SQLiteEventBus`)::
+
+    [nereid_catalog]
+    event_bus = sqlite:////var/lib/nereid/events.sqlite
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import namedtuple
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = [
+    'CatalogEvent', 'LocalEventBus', 'SQLiteEventBus', 'EventsDataManager',
+    'event_bus', 'publish',
+]
+
+logger = logging.getLogger('nereid_catalog.events')
+
+#: A change of records of the catalog. The `action` is `create`, `write` or
+#: `delete` and the `fields` are those given to the action.
+CatalogEvent = namedtuple('CatalogEvent', [
+    'database_name', 'model', 'action', 'ids', 'fields', 'product_ids',
+])
+
+
+class LocalEventBus(object):
+    """
+    A bus delivering the events to the handlers of the process only
+    """
+
+    def __init__(self):
+        self._handlers = []
+
+    def subscribe(self, handler):
+        """
+        Subscribe the handler to the events, once.
+
+        The handler is called with the event and whether it is local, that
+        is from the process and within the transaction of the change.
+        """
+        if handler not in self._handlers:
+            self._handlers.append(handler)
+
+    def start(self):
+        """
+        Start receiving the events of the other processes, if not started
+        in the process
+        """
+        pass
+
+    def dispatch(self, event, local):
+        for handler in self._handlers:
+            handler(event, local)
+
+    def publish(self, event):
+        """
+        Deliver the event to the handlers of the process
+        """
+        self.dispatch(event, True)
+
+    def send(self, events):
+        """
+        Deliver the committed events to the other processes
+        """
+        pass
+
+
+class SQLiteEventBus(LocalEventBus):
+    """
+    A bus delivering the events to the other processes of the host too,
+    through an SQLite file.
+
+    The committed events are appended to the file and each process reads
+    the new events every :attr:`poll_interval` seconds from a thread. As the
+    thread does not survive a fork, it is started again in the forked
+    processes on their first use of the bus or of the caches of the catalog
+    (see :meth:`start`).
+
+    :param filename: The name of the SQLite file
+    """
+
+    #: The number of seconds between the reads of the new events
+    poll_interval = 1
+
+    #: The number of seconds the events are kept in the file
+    retention = 60 * 60
+
+    def __init__(self, filename):
+        super(SQLiteEventBus, self).__init__()
+        self.filename = filename
+        self._last_id = None
+        self._pid = None
+        self._lock = threading.Lock()
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS catalog_event ('
+                    'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                    'create_time REAL, pid INTEGER, database_name TEXT, '
+                    'model TEXT, action TEXT, ids TEXT, fields TEXT, '
+                    'product_ids TEXT)'
+                )
+        finally:
+            connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.filename, timeout=10)
+
+    def subscribe(self, handler):
+        super(SQLiteEventBus, self).subscribe(handler)
+        self.start()
+
+    def start(self):
+        """
+        Start the thread reading the events in the process, if not started
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            connection = self._connect()
+            try:
+                self._last_id = connection.execute(
+                    'SELECT MAX(id) FROM catalog_event'
+                ).fetchone()[0] or 0
+            finally:
+                connection.close()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('Reading the catalog events failed')
+
+    def poll(self):
+        """
+        Deliver the new events of the other processes to the handlers and
+        return their number
+        """
+        connection = self._connect()
+        try:
+            rows = connection.execute(
+                'SELECT id, pid, database_name, model, action, ids, fields, '
+                'product_ids FROM catalog_event WHERE id > ? ORDER BY id',
+                (self._last_id,)
+            ).fetchall()
+        finally:
+            connection.close()
+        count = 0
+        for row in rows:
+            self._last_id = row[0]
+            if row[1] == os.getpid():
+                continue
+            database_name, model, action, ids, fields, product_ids = row[2:]
+            self.dispatch(CatalogEvent(
+                database_name, model, action, json.loads(ids),
+                json.loads(fields), json.loads(product_ids)
+            ), False)
+            count += 1
+        return count
+
+    def send(self, events):
+        now = time.time()
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT INTO catalog_event (create_time, pid, '
+                    'database_name, model, action, ids, fields, '
+                    'product_ids) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [(
+                        now, os.getpid(), event.database_name, event.model,
+                        event.action, json.dumps(event.ids),
+                        json.dumps(event.fields),
+                        json.dumps(event.product_ids),
+                    ) for event in events]
+                )
+                connection.execute(
+                    'DELETE FROM catalog_event WHERE create_time < ?',
+                    (now - self.retention,)
+                )
+        finally:
+            connection.close()
+
+
+class EventsDataManager(object):
+    """
+    A data manager of a transaction which sends its events to the other
+    processes once it is committed
+    """
+
+    def __init__(self, database_name):
+        self.database_name = database_name
+        self.events = []
+
+    def __eq__(self, other):
+        if not isinstance(other, EventsDataManager):
+            return NotImplemented
+        return self.database_name == other.database_name
+
+    def add(self, event):
+        self.events.append(event)
+
+    def abort(self, trans):
+        self.events = []
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        if self.events:
+            try:
+                event_bus.send(self.events)
+            except Exception:
+                logger.exception('Sending the catalog events failed')
+        self.events = []
+
+    def tpc_abort(self, trans):
+        self.events = []
+
+
+def _get_event_bus():
+    uri = config.get('nereid_catalog', 'event_bus')
+    if uri:
+        scheme, filename = uri.split('://', 1)
+        if scheme != 'sqlite':
+            raise ValueError('Unsupported event bus: %s' % uri)
+        return SQLiteEventBus(filename)
+    return LocalEventBus()
+
+
+#: The event bus of the process
+event_bus = _get_event_bus()
+
+
+def publish(model, action, ids, fields=None, product_ids=None):
+    """
+    Publish the change of the records of the model on :data:`event_bus`
+
+    :param model: The name of the model
+    :param action: `create`, `write` or `delete`
+    :param ids: The IDs of the records
+    :param fields: The names of the fields given to the action
+    :param product_ids: The IDs of the products affected by the change
+    """
+    event_bus.start()
+    transaction = Transaction()
+    event = CatalogEvent(
+        transaction.database.name, model, action, sorted(map(int, ids)),
+        sorted(fields or []), sorted(set(map(int, product_ids or [])))
+    )
+    event_bus.publish(event)
+    transaction.join(EventsDataManager(transaction.database.name)).add(event)
+    return event
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+from decimal import Decimal
+
+from lxml import etree
+from lxml.builder import ElementMaker
+
+__all__ = [
+    'JSONLinesWriter', 'CSVFeedWriter', 'GoogleMerchantFeedWriter',
+    'FEED_WRITERS',
+]
+
+#: The fields of the records of product feeds, in the order of the columns
+#: of CSV feeds. They follow the Google Merchant product data specification.
+FEED_FIELDS = [
+    'id', 'title', 'description', 'link', 'image_link', 'price',
+    'availability', 'condition', 'mpn',
+]
+
+
+class FeedJSONEncoder(json.JSONEncoder):
+    """
+    JSON encoder of feed records, which serializes decimals (prices) as
+    strings to keep their precision
+    """
+
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return str(obj)
+        return super(FeedJSONEncoder, self).default(obj)
+
+
+class JSONLinesWriter(object):
+    """
+    Writes records as newline delimited JSON (one JSON document per line)
+    to a file, one record at a time so that a feed of any size is written
+    in constant memory.
+
+    :param file_obj: A file like object opened for writing
+    """
+
+    #: The fields of the records written, with the ID, for the records of a
+    #: previous feed which are removed, see :meth:`remove`
+    removal_fields = {'removed': True}
+
+    def __init__(self, file_obj, **kwargs):
+        self.file_obj = file_obj
+        self.count = 0
+        self.removed = 0
+
+    def write(self, record):
+        """
+        Write a record
+
+        :param record: A JSON serializable dictionary
+        """
+        self.write_record(record)
+        self.count += 1
+
+    def remove(self, record_id):
+        """
+        Write the removal of a record of a previous feed, in delta feeds
+
+        :param record_id: The ID of the record
+        """
+        record = dict(self.removal_fields, id=record_id)
+        self.write_record(record)
+        self.removed += 1
+
+    def write_record(self, record):
+        self.file_obj.write(json.dumps(record, cls=FeedJSONEncoder))
+        self.file_obj.write('\n')
+
+    def close(self):
+        """
+        Finish the feed. The file itself is not closed.
+        """
+        pass
+
+
+class CSVFeedWriter(JSONLinesWriter):
+    """
+    Writes product feed records (see :data:`FEED_FIELDS`) as CSV with a
+    header row
+    """
+
+    removal_fields = {'availability': 'out of stock'}
+
+    def __init__(self, file_obj, **kwargs):
+        super(CSVFeedWriter, self).__init__(file_obj)
+        self.writer = csv.DictWriter(
+            file_obj, FEED_FIELDS, extrasaction='ignore'
+        )
+        self.writer.writeheader()
+
+    def write_record(self, record):
+        self.writer.writerow(dict(
+            (key, unicode(value).encode('utf-8'))
+            for key, value in record.iteritems() if value is not None
+        ))
+
+
+class GoogleMerchantFeedWriter(JSONLinesWriter):
+    """
+    Writes product feed records (see :data:`FEED_FIELDS`) as a Google
+    Merchant RSS 2.0 feed. The items are serialized one at a time between
+    the channel header and footer.
+
+    :param title: The title of the channel
+    :param link: The link to the website of the channel
+    :param description: The description of the channel
+    """
+
+    namespace = 'http://base.google.com/ns/1.0'
+
+    #: The fields written as plain RSS elements, the others are written in
+    #: the Google namespace
+    rss_fields = ('title', 'description', 'link')
+
+    removal_fields = {'availability': 'out of stock'}
+
+    def __init__(self, file_obj, title=u'', link=u'', description=u''):
+        super(GoogleMerchantFeedWriter, self).__init__(file_obj)
+        self.element = ElementMaker(nsmap={'g': self.namespace})
+        self.g_element = ElementMaker(
+            namespace=self.namespace, nsmap={'g': self.namespace}
+        )
+        channel = etree.tostring(self.element.channel(
+            self.element.title(title),
+            self.element.link(link),
+            self.element.description(description),
+        ), encoding='utf-8')
+        file_obj.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        file_obj.write('<rss version="2.0" xmlns:g="%s">\n' % self.namespace)
+        # Write the channel header without its closing tag, the items are
+        # appended as they come
+        file_obj.write(channel[:channel.rindex('</channel>')] + '\n')
+
+    def write_record(self, record):
+        children = []
+        for field in FEED_FIELDS:
+            value = record.get(field)
+            if value is None:
+                continue
+            maker = self.element if field in self.rss_fields \
+                else self.g_element
+            children.append(getattr(maker, field)(unicode(value)))
+        self.file_obj.write(etree.tostring(
+            self.element.item(*children), encoding='utf-8'
+        ))
+        self.file_obj.write('\n')
+
+    def close(self):
+        self.file_obj.write('</channel>\n</rss>\n')
+
+
+#: The feed writers by format name
+FEED_WRITERS = {
+    'jsonl': JSONLinesWriter,
+    'csv': CSVFeedWriter,
+    'google': GoogleMerchantFeedWriter,
+}
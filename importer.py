@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk import of catalogs.
+
+A catalog is imported from a stream of rows, one per variant, as read from
+CSV or JSON lines files by :data:`READERS`. The rows of the variants of a
+template must follow each other. The fields of a row are:
+
+`template`
+    The name of the template (required)
+`code`
+    The code of the variant, which identifies it in the related products
+`uri`
+    The URI of the variant. Defaults to the slug of the template name.
+`displayed_on_eshop`
+    Whether the variant is displayed, true by default
+`list_price`, `cost_price`, `uom`, `description`, `long_description`
+    The values of the template, read from its first row. `uom` is the name
+    of the unit of measure, `Unit` by default.
+`images`
+    The paths of the image files of the variant
+`up_sells`, `cross_sells`
+    The codes of the related products of the variant
+
+The lists of the CSV files are separated by `|`. A catalog is imported in
+one transaction with::
+
+    python -m trytond.modules.nereid_catalog.importer -c trytond.conf \\
+        <database> catalog.jsonl
+"""
+import os
+import csv
+import json
+import time
+import logging
+import argparse
+from decimal import Decimal
+from itertools import groupby, islice
+
+from nereid.helpers import slugify
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
+
+__all__ = ['read_jsonl', 'read_csv', 'READERS', 'CatalogImporter']
+
+logger = logging.getLogger('nereid_catalog.importer')
+
+#: The fields of rows holding lists
+LIST_FIELDS = ('images', 'up_sells', 'cross_sells')
+
+
+def read_jsonl(file_obj):
+    """
+    Read the rows of a JSON lines file
+    """
+    for line in file_obj:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_csv(file_obj):
+    """
+    Read the rows of a CSV file with a header row. The empty values are
+    ignored.
+    """
+    for row in csv.DictReader(file_obj):
+        row = dict(
+            (key, value.decode('utf-8'))
+            for key, value in row.iteritems() if value
+        )
+        for field in LIST_FIELDS:
+            if field in row:
+                row[field] = row[field].split('|')
+        yield row
+
+
+#: The readers of rows by format name
+READERS = {
+    'jsonl': read_jsonl,
+    'csv': read_csv,
+}
+
+
+def _to_boolean(value):
+    if isinstance(value, basestring):
+        return value.lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+
+class CatalogImporter(object):
+    """
+    Imports catalogs in batches of templates.
+
+    The templates of a batch are created with their variants and media at
+    once, without the check of the uniqueness of the URIs of each batch.
+    The URIs are generated and deduplicated in memory against the URIs of
+    the existing products, loaded once (see
+    :meth:`Product.get_unique_uri`), and checked by a single query at the
+    end. The related products are created once all the variants exist.
+
+    :param folder_name: The name of the static folder of the image files
+    """
+
+    #: The number of templates created at once
+    batch_size = 500
+
+    def __init__(self, folder_name='catalog'):
+        self.folder_name = folder_name
+        self.stats = dict.fromkeys([
+            'templates', 'products', 'media', 'relations',
+        ], 0)
+
+    def import_rows(self, rows):
+        """
+        Import the rows and return the statistics of the import: the number
+        of templates, products, media and relations created, the duration
+        and the number of products per second
+        """
+        Product = Pool().get('product.product')
+
+        start = time.time()
+        with Transaction().set_context(_defer_uri_check=True):
+            self.taken_uris = Product.get_taken_uris()
+            self.folder = self._get_folder()
+            self.uoms = {}
+            relations = []
+            templates = groupby(rows, key=lambda row: row['template'])
+            while True:
+                batch = [
+                    (name, list(template_rows))
+                    for name, template_rows in islice(
+                        templates, self.batch_size
+                    )
+                ]
+                if not batch:
+                    break
+                relations.extend(self._import_batch(batch))
+                logger.info('%d products imported', self.stats['products'])
+            self._import_relations(relations)
+        Product.check_uri_duplicates()
+
+        self.stats['seconds'] = round(time.time() - start, 3)
+        self.stats['products_per_second'] = round(
+            self.stats['products'] / max(self.stats['seconds'], 0.001), 1
+        )
+        return self.stats
+
+    def _get_folder(self):
+        StaticFolder = Pool().get('nereid.static.folder')
+
+        folders = StaticFolder.search([('name', '=', self.folder_name)])
+        if folders:
+            return folders[0]
+        folder, = StaticFolder.create([{'name': self.folder_name}])
+        return folder
+
+    def _get_uom(self, name):
+        Uom = Pool().get('product.uom')
+
+        if name not in self.uoms:
+            self.uoms[name], = Uom.search([('name', '=', name)], limit=1)
+        return self.uoms[name]
+
+    def _get_static_files(self, paths):
+        """
+        Return a dictionary of the static files of the image files by path,
+        creating those missing from the folder
+        """
+        StaticFile = Pool().get('nereid.static.file')
+
+        names = dict((path, os.path.basename(path)) for path in paths)
+        files = dict(
+            (f.name, f) for f in StaticFile.search([
+                ('folder', '=', self.folder.id),
+                ('name', 'in', list(set(names.values()))),
+            ])
+        )
+        to_create = {}
+        for path, name in names.iteritems():
+            if name not in files and name not in to_create:
+                with open(path, 'rb') as image_file:
+                    to_create[name] = {
+                        'name': name,
+                        'folder': self.folder.id,
+                        'file_binary': buffer(image_file.read()),
+                    }
+        if to_create:
+            files.update(
+                (f.name, f) for f in StaticFile.create(to_create.values())
+            )
+        return dict((path, files[name]) for path, name in names.iteritems())
+
+    def _import_batch(self, batch):
+        """
+        Create the templates of the batch with their variants and media and
+        return the list of the relations of the variants as tuples
+        `(code, up-sell codes, cross-sell codes)`
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+
+        static_files = self._get_static_files(set(
+            path for _, rows in batch for row in rows
+            for path in row.get('images') or []
+        ))
+
+        vlist, relations = [], []
+        for name, rows in batch:
+            first = rows[0]
+            products = []
+            for row in rows:
+                products.append({
+                    'code': row.get('code'),
+                    'uri': Product.get_unique_uri(
+                        row.get('uri') or slugify(name), self.taken_uris,
+                        [row.get('code')]
+                    ),
+                    'displayed_on_eshop': _to_boolean(
+                        row.get('displayed_on_eshop', True)
+                    ),
+                    'media': [('create', [
+                        {'static_file': static_files[path].id, 'sequence': i}
+                        for i, path in enumerate(row.get('images') or [])
+                    ])],
+                })
+                self.stats['media'] += len(row.get('images') or [])
+                if row.get('up_sells') or row.get('cross_sells'):
+                    if not row.get('code'):
+                        Product.raise_user_error(
+                            'import_relations_without_code', {
+                                'template': name,
+                            })
+                    relations.append((
+                        row.get('code'), row.get('up_sells') or [],
+                        row.get('cross_sells') or [],
+                    ))
+            vlist.append({
+                'name': name,
+                'type': 'goods',
+                'default_uom': self._get_uom(first.get('uom') or u'Unit'),
+                'list_price': Decimal(str(first.get('list_price') or 0)),
+                'cost_price': Decimal(str(first.get('cost_price') or 0)),
+                'description': first.get('description'),
+                'long_description': first.get('long_description'),
+                'products': [('create', products)],
+            })
+            self.stats['products'] += len(products)
+
+        Template.create(vlist)
+        self.stats['templates'] += len(vlist)
+        return relations
+
+    def _import_relations(self, relations):
+        """
+        Create the up-sells and cross-sells of the variants, identified by
+        their codes
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Related = pool.get('product.product-product.product')
+
+        codes = set()
+        for code, up_sells, cross_sells in relations:
+            codes.add(code)
+            codes.update(up_sells)
+            codes.update(cross_sells)
+        ids = {}
+        for sub_codes in grouped_slice(list(codes)):
+            ids.update(
+                (p.code, p.id) for p in Product.search([
+                    ('code', 'in', list(sub_codes)),
+                ])
+            )
+
+        vlist = []
+        for code, up_sells, cross_sells in relations:
+            vlist.extend(
+                {'product': ids[code], 'up_sell': ids[related]}
+                for related in up_sells if related in ids
+            )
+            vlist.extend(
+                {'product': ids[code], 'cross_sell': ids[related]}
+                for related in cross_sells if related in ids
+            )
+        for sub_vlist in grouped_slice(vlist, self.batch_size):
+            Related.create(list(sub_vlist))
+        self.stats['relations'] += len(vlist)
+
+
+def main():
+    from trytond.config import config
+
+    parser = argparse.ArgumentParser(description='Import a catalog')
+    parser.add_argument('database_name')
+    parser.add_argument('filename')
+    parser.add_argument('-c', '--config', dest='config_file')
+    parser.add_argument('--format', choices=sorted(READERS))
+    parser.add_argument('--folder', default='catalog')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config.update_etc(options.config_file)
+    Pool.start()
+    Pool(options.database_name).init()
+
+    format = options.format or os.path.splitext(options.filename)[1][1:]
+    with open(options.filename) as rows_file, \
+            Transaction().start(options.database_name, 0) as transaction:
+        stats = CatalogImporter(options.folder).import_rows(
+            READERS[format](rows_file)
+        )
+        transaction.commit()
+    logger.info(
+        'Imported %(templates)d templates, %(products)d products, '
+        '%(media)d media and %(relations)d relations in %(seconds)ss '
+        '(%(products_per_second)s products per second)', stats
+    )
+
+
+if __name__ == '__main__':
+    main()
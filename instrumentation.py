@@ -0,0 +1,525 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the routes of the catalog.
+
+The routes decorated with :func:`instrumented` count the SQL queries they
+execute (including those of the rendering of their template), the records
+read through the ORM by model and the time they take. In debug mode the
+figures are sent back as `X-Catalog-*` response headers; they are always
+accumulated per route in :data:`route_metrics`.
+
+A statement executed :data:`REPEATED_QUERY_THRESHOLD` times or more by a
+single request is the signature of an N+1 query (a query per record of a
+list instead of one for the list) and is logged as such in debug mode.
+
+Tests can bound the number of queries of a block with :func:`query_budget`.
+
+The function field getters decorated with :func:`timed` and the
+instrumented routes can also be timed, which is opt-in with the `timing`
+option of the `nereid_catalog` section of the configuration. The call
+counts, record counts (batch sizes) and cumulative times are kept in
+:data:`timings`, exported as Prometheus text by :func:`prometheus_text` and
+sent to the statsd collector given by the `statsd` option (`host:port`)::
+
+    [nereid_catalog]
+    timing = True
+    statsd = 127.0.0.1:8125
+"""
+import time
+import socket
+import inspect
+import logging
+import threading
+from collections import defaultdict
+from functools import wraps
+
+from nereid import current_app
+from nereid.templating import LazyRenderer
+from werkzeug.datastructures import Headers
+from werkzeug.wrappers import BaseResponse
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = [
+    'QueryCounter', 'RequestStats', 'RouteMetrics', 'QueryBudgetExceeded',
+    'query_budget', 'instrumented', 'record_read', 'route_metrics',
+    'Timings', 'StatsdClient', 'timed', 'timings', 'prometheus_text',
+]
+
+logger = logging.getLogger('nereid_catalog.instrumentation')
+
+#: The number of executions of a same statement by a request from which it
+#: is reported as an N+1 query
+REPEATED_QUERY_THRESHOLD = 5
+
+_local = threading.local()
+
+
+class QueryCounter(object):
+    """
+    Counts the SQL queries executed on the connection of the current
+    transaction while it is active, as a context manager or between calls
+    to :meth:`start` and :meth:`stop`.
+
+    The statements executed are counted too, see :meth:`repeated_queries`.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = defaultdict(int)
+        self._connections = []
+
+    def start(self):
+        transaction = Transaction()
+        self._connections.append(transaction.connection)
+        transaction.connection = _CountingConnection(
+            transaction.connection, self
+        )
+
+    def stop(self):
+        Transaction().connection = self._connections.pop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def add(self, statement):
+        self.count += 1
+        self.statements[statement] += 1
+
+    def repeated_queries(self, threshold=None):
+        """
+        Return a dictionary of the statements executed at least `threshold`
+        times (:data:`REPEATED_QUERY_THRESHOLD` by default) with their
+        number of executions
+        """
+        threshold = threshold or REPEATED_QUERY_THRESHOLD
+        return dict(
+            (statement, count)
+            for statement, count in self.statements.iteritems()
+            if count >= threshold
+        )
+
+
+class _CountingConnection(object):
+
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._counter
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class _CountingCursor(object):
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, statement, *args, **kwargs):
+        self._counter.add(statement)
+        return self._cursor.execute(statement, *args, **kwargs)
+
+    def executemany(self, statement, *args, **kwargs):
+        self._counter.add(statement)
+        return self._cursor.executemany(statement, *args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class RequestStats(QueryCounter):
+    """
+    The queries, ORM reads and time of a request to an instrumented route
+
+    :param route: The name of the route
+    """
+
+    def __init__(self, route):
+        super(RequestStats, self).__init__()
+        self.route = route
+        self.reads = defaultdict(int)
+        self.duration = 0.0
+        self._started = None
+
+    def start(self):
+        super(RequestStats, self).start()
+        _local.stats = getattr(_local, 'stats', []) + [self]
+        self._started = time.time()
+
+    def stop(self):
+        self.duration += time.time() - self._started
+        _local.stats = _local.stats[:-1]
+        super(RequestStats, self).stop()
+
+    def get_headers(self):
+        """
+        Return the debug response headers of the request
+        """
+        return {
+            'X-Catalog-Queries': str(self.count),
+            'X-Catalog-Repeated-Queries': str(len(self.repeated_queries())),
+            'X-Catalog-Reads': ', '.join(
+                '%s=%d' % (model, count)
+                for model, count in sorted(self.reads.iteritems())
+            ),
+            'X-Catalog-Time': '%.1f' % (self.duration * 1000),
+        }
+
+    def finish(self, response=None):
+        """
+        Record the request in the route metrics and, in debug mode, add the
+        debug headers to the response (a response object or the headers of
+        a lazy renderer) and log the repeated queries
+        """
+        route_metrics.record(self)
+        if timings.enabled:
+            timings.record('route', self.route, 1, self.duration)
+        if not current_app.debug:
+            return
+        if isinstance(response, BaseResponse):
+            response = response.headers
+        if isinstance(response, (dict, Headers)):
+            for name, value in self.get_headers().iteritems():
+                response[name] = value
+        for statement, count in self.repeated_queries().iteritems():
+            logger.warning(
+                'Query executed %d times by %s (N+1 query?): %s',
+                count, self.route, statement
+            )
+
+
+class RouteMetrics(object):
+    """
+    The figures of the requests to the instrumented routes accumulated per
+    route since the start of the process (or the last :meth:`reset`)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, stats):
+        """
+        Add the figures of a request
+
+        :param stats: The :class:`RequestStats` of the request
+        """
+        with self._lock:
+            metrics = self._routes.setdefault(stats.route, {
+                'requests': 0,
+                'queries': 0,
+                'max_queries': 0,
+                'repeated_queries': 0,
+                'reads': defaultdict(int),
+                'time': 0.0,
+                'max_time': 0.0,
+            })
+            metrics['requests'] += 1
+            metrics['queries'] += stats.count
+            metrics['max_queries'] = max(metrics['max_queries'], stats.count)
+            metrics['repeated_queries'] += len(stats.repeated_queries())
+            for model, count in stats.reads.iteritems():
+                metrics['reads'][model] += count
+            metrics['time'] += stats.duration
+            metrics['max_time'] = max(metrics['max_time'], stats.duration)
+
+    def snapshot(self):
+        """
+        Return a copy of the metrics as a dictionary by route
+        """
+        with self._lock:
+            return dict(
+                (route, dict(metrics, reads=dict(metrics['reads'])))
+                for route, metrics in self._routes.iteritems()
+            )
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+#: The metrics of the instrumented routes of the process
+route_metrics = RouteMetrics()
+
+
+def record_read(model, ids):
+    """
+    Count the records of the model read by the requests being instrumented
+
+    :param model: The name of the model
+    :param ids: The IDs of the records read
+    """
+    for stats in getattr(_local, 'stats', ()):
+        stats.reads[model] += len(ids)
+
+
+class _InstrumentedRenderer(LazyRenderer):
+    """
+    A lazy renderer which counts its rendering in the stats of the request
+    """
+
+    __slots__ = ('stats',)
+
+    def __init__(self, renderer, stats):
+        self.template_name_or_list = renderer.template_name_or_list
+        self.context = renderer.context
+        self.headers = renderer.headers
+        self.status = renderer.status
+        self.stats = stats
+
+    def render(self):
+        # Only the first rendering is the one of the request
+        stats, self.stats = self.stats, None
+        if stats is None:
+            return super(_InstrumentedRenderer, self).render()
+        stats.start()
+        try:
+            return super(_InstrumentedRenderer, self).render()
+        finally:
+            stats.stop()
+            stats.finish(self.headers)
+
+
+def instrumented(function):
+    """
+    A decorator of the routes of the catalog (below the route decorators)
+    which instruments them, see :class:`RequestStats`.
+
+    The templates rendered lazily by the route are counted with it.
+    """
+    @wraps(function)
+    def wrapper(cls, *args, **kwargs):
+        stats = RequestStats('%s.%s' % (cls.__name__, function.__name__))
+        stats.start()
+        try:
+            rv = function(cls, *args, **kwargs)
+        finally:
+            stats.stop()
+        if isinstance(rv, LazyRenderer):
+            return _InstrumentedRenderer(rv, stats)
+        stats.finish(rv)
+        return rv
+    return wrapper
+
+
+class StatsdClient(object):
+    """
+    Sends the timings to a statsd collector over UDP. Sending is best
+    effort, the errors are ignored.
+
+    :param host: The host of the collector
+    :param port: The port of the collector
+    :param prefix: The prefix of the names of the metrics
+    """
+
+    def __init__(self, host, port, prefix='nereid_catalog'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, kind, name, size, duration):
+        """
+        Send the call count, the number of records and the duration of a
+        call
+        """
+        metric = '.'.join([self.prefix, kind, name.replace('.', '_')])
+        try:
+            self.socket.sendto('\n'.join([
+                '%s.calls:1|c' % metric,
+                '%s.records:%d|c' % (metric, size),
+                '%s.time:%.3f|ms' % (metric, duration * 1000),
+            ]), self.address)
+        except socket.error:
+            pass
+
+
+class Timings(object):
+    """
+    The call counts, record counts and cumulative times of the timed
+    getters and routes, since the start of the process (or the last
+    :meth:`reset`). Nothing is recorded unless :attr:`enabled`.
+    """
+
+    def __init__(self):
+        self.enabled = config.getboolean(
+            'nereid_catalog', 'timing', default=False
+        )
+        self.statsd = None
+        address = config.get('nereid_catalog', 'statsd')
+        if address:
+            host, port = address.rsplit(':', 1)
+            self.statsd = StatsdClient(host, int(port))
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def record(self, kind, name, size, duration):
+        """
+        Record a call
+
+        :param kind: `getter` or `route`
+        :param name: The name of the getter or route
+        :param size: The number of records of the call
+        :param duration: The duration of the call in seconds
+        """
+        with self._lock:
+            entry = self._calls.setdefault((kind, name), {
+                'calls': 0,
+                'records': 0,
+                'max_records': 0,
+                'time': 0.0,
+            })
+            entry['calls'] += 1
+            entry['records'] += size
+            entry['max_records'] = max(entry['max_records'], size)
+            entry['time'] += duration
+        if self.statsd:
+            self.statsd.send(kind, name, size, duration)
+
+    def snapshot(self):
+        """
+        Return a copy of the timings as a dictionary by `(kind, name)`
+        """
+        with self._lock:
+            return dict(
+                (key, dict(entry)) for key, entry in self._calls.iteritems()
+            )
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+
+
+#: The timings of the getters and routes of the process
+timings = Timings()
+
+
+def timed(function):
+    """
+    A decorator of function field getters (below the `classmethod`
+    decorator) which records their calls in :data:`timings` when enabled.
+    The number of records of a call is the length of the list of records
+    of class method getters, one for instance method getters.
+    """
+    def call(obj, *args, **kwargs):
+        if not timings.enabled:
+            return function(obj, *args, **kwargs)
+        size = len(args[0]) if args and isinstance(args[0], list) else 1
+        start = time.time()
+        try:
+            return function(obj, *args, **kwargs)
+        finally:
+            timings.record(
+                'getter', '%s.%s' % (obj.__name__, function.__name__), size,
+                time.time() - start
+            )
+
+    # Tryton gives the list of the names of the fields to the getters
+    # having a `names` argument only
+    if 'names' in inspect.getargspec(function).args:
+        @wraps(function)
+        def wrapper(cls, records, names):
+            return call(cls, records, names)
+        return wrapper
+    return wraps(function)(call)
+
+
+def prometheus_text():
+    """
+    Return the route metrics and the timings in the Prometheus text
+    exposition format
+    """
+    def escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"')
+
+    lines = []
+
+    def add(metric, kind, help, samples):
+        lines.append('# HELP nereid_catalog_%s %s' % (metric, help))
+        lines.append('# TYPE nereid_catalog_%s %s' % (metric, kind))
+        for labels, value in sorted(samples):
+            lines.append('nereid_catalog_%s{%s} %s' % (metric, ','.join(
+                '%s="%s"' % (label, escape(label_value))
+                for label, label_value in labels
+            ), value))
+
+    routes = route_metrics.snapshot()
+    add('route_requests_total', 'counter', 'Requests to the route', [
+        ((('route', route),), metrics['requests'])
+        for route, metrics in routes.iteritems()
+    ])
+    add('route_queries_total', 'counter', 'SQL queries of the route', [
+        ((('route', route),), metrics['queries'])
+        for route, metrics in routes.iteritems()
+    ])
+    add('route_reads_total', 'counter', 'Records read by the route', [
+        ((('route', route), ('model', model)), count)
+        for route, metrics in routes.iteritems()
+        for model, count in metrics['reads'].iteritems()
+    ])
+    add('route_seconds_total', 'counter', 'Time spent in the route', [
+        ((('route', route),), metrics['time'])
+        for route, metrics in routes.iteritems()
+    ])
+
+    calls = timings.snapshot()
+    add('calls_total', 'counter', 'Calls of the timed function', [
+        ((('kind', kind), ('name', name)), entry['calls'])
+        for (kind, name), entry in calls.iteritems()
+    ])
+    add('records_total', 'counter', 'Records of the timed function calls', [
+        ((('kind', kind), ('name', name)), entry['records'])
+        for (kind, name), entry in calls.iteritems()
+    ])
+    add('seconds_total', 'counter', 'Time spent in the timed function', [
+        ((('kind', kind), ('name', name)), entry['time'])
+        for (kind, name), entry in calls.iteritems()
+    ])
+    return '\n'.join(lines) + '\n'
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class query_budget(QueryCounter):
+    """
+    A context manager failing with :exc:`QueryBudgetExceeded` when its
+    block executes more than `max_queries` SQL queries. Meant for tests::
+
+        with query_budget(10):
+            client.get('/products')
+
+    :param max_queries: The number of queries allowed
+    """
+
+    def __init__(self, max_queries):
+        super(query_budget, self).__init__()
+        self.max_queries = max_queries
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(query_budget, self).__exit__(exc_type, exc_value, traceback)
+        if exc_type is None and self.count > self.max_queries:
+            raise QueryBudgetExceeded(
+                '%d queries executed, the budget is %d:\n%s' % (
+                    self.count, self.max_queries, '\n'.join(
+                        '%dx %s' % (count, statement)
+                        for statement, count in sorted(
+                            self.statements.iteritems(),
+                            key=lambda s: -s[1]
+                        )
+                    )
+                )
+            )
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+from nereid.contrib.pagination import Pagination
+from werkzeug.utils import cached_property
+from sql import Literal
+from sql.aggregate import Count
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.transaction import Transaction
+
+__all__ = ['CatalogPagination']
+
+
+class CatalogPagination(Pagination):
+    """
+    Pagination over the catalog which stops counting at `count_limit`.
+
+    Counting all the records matching a catalog domain costs as much as
+    scanning them. When more than `count_limit` records match, the count is
+    not computed exactly; the count limit is used as a lower bound estimate
+    and :attr:`count_is_estimate` is set, which templates may use to render
+    "more than N results".
+
+    In the `approximate` count mode, the count beyond the limit is instead
+    the row estimate of the query planner on PostgreSQL, or an exact count
+    on other databases. Either is cached per domain for
+    :attr:`count_cache_timeout` seconds, so that the large result sets are
+    not counted on each page view.
+
+    :param count_limit: Maximum number of records to count exactly. A falsy
+                        value counts all the records.
+    :param count_mode: `exact` or `approximate`
+
+    The records of the page are searched once, however many times the
+    pagination is iterated.
+    """
+
+    #: Number of seconds for which the approximate count of a domain is
+    #: reused before being computed again
+    count_cache_timeout = 60 * 10
+
+    _count_cache = Cache('nereid_catalog.pagination.count')
+
+    def __init__(self, obj, domain, page, per_page, order=None,
+                 count_limit=None, count_mode='exact'):
+        self.count_limit = count_limit
+        self.count_mode = count_mode
+        self.count_is_estimate = False
+        self._items = None
+        super(CatalogPagination, self).__init__(
+            obj, domain, page, per_page, order
+        )
+
+    @cached_property
+    def count(self):
+        """
+        Returns the count of entries, bounded by the count limit
+        """
+        if self.ids_domain() or self._count is not None or \
+                not self.count_limit:
+            return super(CatalogPagination, self).count
+
+        query = self.obj.search(
+            self.domain, limit=self.count_limit + 1, order=[], query=True
+        )
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*query.select(Count(Literal(1))))
+        count = cursor.fetchone()[0]
+        if count <= self.count_limit:
+            return count
+
+        self.count_is_estimate = True
+        if self.count_mode == 'approximate':
+            return max(self.get_approximate_count(), self.count_limit)
+        return self.count_limit
+
+    def items(self):
+        """
+        Returns the records of the page
+        """
+        if self._items is None:
+            self._items = super(CatalogPagination, self).items()
+        return self._items
+
+    def get_approximate_count(self):
+        """
+        Returns the cached approximate count of the domain, computing it
+        when missing or older than :attr:`count_cache_timeout`
+        """
+        key = (self.obj.__name__, repr(self.domain))
+        cached = self._count_cache.get(key)
+        if cached is not None and \
+                cached[0] + self.count_cache_timeout > time.time():
+            return cached[1]
+
+        if backend.name() == 'postgresql':
+            count = self._get_planner_estimate()
+        else:
+            count = self.obj.search(self.domain, count=True)
+        self._count_cache.set(key, (time.time(), count))
+        return count
+
+    def _get_planner_estimate(self):
+        """
+        Returns the number of rows the PostgreSQL planner estimates for the
+        domain
+        """
+        query, params = tuple(
+            self.obj.search(self.domain, order=[], query=True)
+        )
+        cursor = Transaction().connection.cursor()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
@@ -1,23 +1,54 @@
 # -*- coding: utf-8 -*-
+import os
+import json
+import fcntl
+import time
+import mimetypes
+from datetime import datetime, timedelta
 from collections import deque
+from itertools import chain
+from tempfile import NamedTemporaryFile, gettempdir
+from threading import Event, Lock
 
-from nereid import render_template, route
+from nereid import Nereid, render_template, route, abort, current_user
 from nereid.globals import session, request, current_app
-from nereid.helpers import slugify, url_for
-from nereid import jsonify, Markup, current_locale
-from nereid.contrib.pagination import Pagination
+from nereid.helpers import slugify, url_for, send_file
+from nereid import jsonify, Markup, current_locale, current_website
 from nereid.contrib.sitemap import SitemapIndex, SitemapSection
 from werkzeug.exceptions import NotFound
+from werkzeug.routing import Map, Rule
+from werkzeug.utils import redirect
+from flask import g, has_app_context
 from flask.ext.babel import format_currency
 
-from trytond.model import ModelSQL, ModelView, fields
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, ModelSingleton, fields
 from trytond.pyson import Eval, Not, Bool
 from trytond.pool import Pool, PoolMeta
-from sql import Null
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.modules.nereid_image_transformation.static_file import \
+    TransformationCommand
+from sql import Null, Literal, Select, Union
+from sql.aggregate import Count, Max
+from sql.conditionals import Case
+from sql.functions import CurrentTimestamp, Lower
+from sql.operators import And, Or
+
+from search import PrefixIndex, SearchIndex, StaleRecordsDataManager
+from feed import JSONLinesWriter, FEED_WRITERS
+from instrumentation import instrumented, record_read, timed
+from derivatives import DerivativesDataManager
+from replica import on_replica
+from snapshot import ProductSnapshot, catalog_snapshot
+from events import event_bus, publish
 
 __all__ = [
     'Product', 'ProductsRelated', 'ProductTemplate',
-    'ProductMedia', 'ProductCategory'
+    'ProductMedia', 'ProductCategory', 'ProductUriRedirect',
+    'ProductDeletion', 'ProductFeed', 'ProductAvailabilityRefresh',
 ]
 
 DEFAULT_STATE = {'invisible': Not(Bool(Eval('displayed_on_eshop')))}
@@ -27,6 +58,99 @@ DEFAULT_STATE2 = {
 }
 
 
+def get_url_root():
+    """
+    Return the URL of the root of the website in the locale of the request,
+    built once per request.
+
+    This method works only under a nereid request context
+    """
+    if not hasattr(g, 'catalog_url_root'):
+        g.catalog_url_root = url_for('nereid.website.home')
+    return g.catalog_url_root
+
+
+#: The rule of the transformation route of `nereid_image_transformation`,
+#: to build the paths of thumbnails outside of the applications
+TRANSFORM_RULE = (
+    '/static-file-transform/<int:active_id>/<path:commands>.<extension>'
+)
+
+_TRANSFORM_ENDPOINT = 'nereid.static.file.transform_static_file'
+_transform_urls = Map([
+    Rule(TRANSFORM_RULE, endpoint=_TRANSFORM_ENDPOINT),
+]).bind('')
+
+
+def _get_transform_urls():
+    # The application routes the requests with its own map
+    if has_app_context() and isinstance(current_app, Nereid):
+        return current_app.url_map.bind('')
+    return _transform_urls
+
+
+def get_thumbnail_path(file_id, file_name, width, height, extension=None):
+    """
+    Return the path, relative to the root of the website, of the thumbnail
+    of the static file fitting in the given size, as served by the
+    transformation route of `nereid_image_transformation`.
+
+    >>> get_thumbnail_path(7, 'shoe.png', 300, 300)
+    'static-file-transform/7/thumbnail%2Cw_300%2Ch_300%2Cm_a.png'
+    >>> get_thumbnail_path(7, 'shoe.png', 300, 300, 'webp')
+    'static-file-transform/7/thumbnail%2Cw_300%2Ch_300%2Cm_a.webp'
+
+    :param extension: The format of the thumbnail, the format of the file by
+                      default
+    """
+    extension = extension or os.path.splitext(file_name)[1][1:] or 'png'
+    return _get_transform_urls().build(_TRANSFORM_ENDPOINT, {
+        'active_id': file_id,
+        'commands': unicode(
+            TransformationCommand().thumbnail(width, height, 'a')
+        ),
+        'extension': extension,
+    }).lstrip('/')
+
+
+def _on_catalog_event(event, local):
+    """
+    Invalidate the caches of the catalog built from the products affected
+    by a change, see :mod:`~nereid_catalog.events`.
+
+    The products are discarded from the catalog snapshot. The changes of
+    other processes only invalidate the in-memory indexes besides, as the
+    caches of Tryton are synchronised between processes by Tryton.
+    The products changed by the process are invalidated in the indexes
+    again once the transaction ends.
+    """
+    if event.model == 'product.category':
+        return
+    if catalog_snapshot is not None:
+        catalog_snapshot.discard(event.product_ids)
+    if local:
+        pool = Pool()
+        Product = pool.get('product.product')
+        Product.invalidate_catalog_caches(
+            event.product_ids,
+            event.fields if event.model == Product.__name__ else None
+        )
+        Transaction().join(StaleRecordsDataManager(
+            event.database_name, Product.invalidate_catalog_indexes
+        )).add(event.product_ids)
+        if event.model == 'product.media':
+            pool.get('product.media')._srcset_cache.clear()
+    elif event.database_name in Pool.database_list():
+        Product = Pool(event.database_name).get('product.product')
+        Product.invalidate_catalog_indexes(
+            event.product_ids, event.database_name
+        )
+
+
+def _get_fields(vlist):
+    return set(name for values in vlist for name in values)
+
+
 class ProductMedia(ModelSQL, ModelView):
     "Product Media"
     __name__ = "product.media"
@@ -38,9 +162,96 @@ class ProductMedia(ModelSQL, ModelView):
     template = fields.Many2One("product.template", "Template", select=True)
     url = fields.Function(fields.Char("URL"), "get_url")
 
+    #: The widths of the images of the srcsets of media, see
+    #: :meth:`get_srcsets`
+    srcset_widths = [160, 320, 640, 1280]
+
+    #: The formats of the srcsets of media. None is the format of the file.
+    srcset_formats = [None]
+
+    _srcset_cache = Cache(
+        'nereid_catalog.media.srcset', size_limit=10240, context=False
+    )
+
+    #: The sizes of the zoomed images of media
+    zoom_sizes = [(1200, 1200)]
+
+    #: The number of threads of the process generating the derivatives of
+    #: the media created or changed, from the `derivative_workers` option
+    #: of the `nereid_catalog` section of the configuration. Zero disables
+    #: the generation.
+    derivative_workers = config.getint(
+        'nereid_catalog', 'derivative_workers', default=0
+    )
+
+    @timed
     def get_url(self, name):
         return self.static_file.url
 
+    @classmethod
+    def get_srcsets(cls, media, widths=None, formats=None):
+        """
+        Return the srcsets of the media as a dictionary of dictionaries of
+        the srcset attributes (`<url> <width>w, ...`) by format, by media
+        ID. The images of a width fit in a square of that width.
+
+        The static files of all the media not in the cache are read in a
+        single query and the URLs are built from the paths of the
+        transformation route, so that a gallery or a listing does not read
+        and build URLs image by image. The paths are cached per media until
+        the media change.
+
+        This method works only under a nereid request context
+
+        :param media: A list of media
+        :param widths: The widths of the images, :attr:`srcset_widths` by
+                       default
+        :param formats: The formats of the images, :attr:`srcset_formats`
+                        by default
+        """
+        StaticFile = Pool().get('nereid.static.file')
+        medium = cls.__table__()
+        static_file = StaticFile.__table__()
+        cursor = Transaction().connection.cursor()
+
+        widths = tuple(widths or cls.srcset_widths)
+        formats = tuple(formats or cls.srcset_formats)
+        paths, missing = {}, []
+        for media_id in set(map(int, media)):
+            cached = cls._srcset_cache.get((media_id, widths, formats))
+            if cached is None:
+                missing.append(media_id)
+            else:
+                paths[media_id] = cached
+
+        for sub_ids in grouped_slice(missing):
+            cursor.execute(*medium.join(
+                static_file, condition=medium.static_file == static_file.id
+            ).select(
+                medium.id, static_file.id, static_file.name,
+                where=reduce_ids(medium.id, sub_ids)
+            ))
+            for media_id, file_id, file_name in cursor.fetchall():
+                paths[media_id] = cls._srcset_cache.set(
+                    (media_id, widths, formats), dict(
+                        (format, [
+                            (width, get_thumbnail_path(
+                                file_id, file_name, width, width, format
+                            )) for width in widths
+                        ]) for format in formats
+                    )
+                )
+
+        root = get_url_root()
+        return dict(
+            (media_id, dict(
+                (format, ', '.join(
+                    '%s%s %dw' % (root, path, width)
+                    for width, path in format_paths
+                )) for format, format_paths in media_paths.iteritems()
+            )) for media_id, media_paths in paths.iteritems()
+        )
+
     @classmethod
     def __setup__(cls):
         super(ProductMedia, cls).__setup__()
@@ -51,6 +262,94 @@ class ProductMedia(ModelSQL, ModelView):
     def default_sequence():
         return 10
 
+    @classmethod
+    def read(cls, ids, fields_names=None):
+        record_read(cls.__name__, ids)
+        return super(ProductMedia, cls).read(ids, fields_names=fields_names)
+
+    @staticmethod
+    def _get_product_ids(media):
+        """
+        Return the IDs of the variants whose images include the media
+        """
+        ids = set()
+        for medium in media:
+            if medium.product:
+                ids.add(medium.product.id)
+            if medium.template:
+                ids.update(map(int, medium.template.products))
+        return list(ids)
+
+    @classmethod
+    def _media_changed(cls, action, ids, fields, product_ids):
+        Product = Pool().get('product.product')
+
+        Product.update_default_images(product_ids)
+        publish(cls.__name__, action, ids, fields, product_ids)
+
+    @classmethod
+    def get_derivative_sizes(cls):
+        """
+        Return the list of the sizes `(width, height)` of the thumbnails of
+        media generated beforehand: the listing and search suggestion
+        thumbnails, the widths of the srcsets and the zoom sizes
+        """
+        Product = Pool().get('product.product')
+
+        sizes = Product.listing_thumbnail_sizes + \
+            [Product.suggest_thumbnail_size] + \
+            [(width, width) for width in cls.srcset_widths] + cls.zoom_sizes
+        return sorted(set(sizes))
+
+    @classmethod
+    def enqueue_derivatives(cls, media):
+        """
+        Generate the derivatives of the files of the media in the background
+        once the transaction is committed (see
+        :mod:`~nereid_catalog.derivatives`)
+        """
+        if not cls.derivative_workers or not media:
+            return
+        transaction = Transaction()
+        datamanager = transaction.join(
+            DerivativesDataManager(transaction.database.name)
+        )
+        datamanager.add(
+            [m.static_file.id for m in media], cls.get_derivative_sizes(),
+            cls.derivative_workers
+        )
+
+    @classmethod
+    def create(cls, vlist):
+        media = super(ProductMedia, cls).create(vlist)
+        cls._media_changed(
+            'create', media, _get_fields(vlist), cls._get_product_ids(media)
+        )
+        cls.enqueue_derivatives(media)
+        return media
+
+    @classmethod
+    def write(cls, *args):
+        media = sum(args[::2], [])
+        product_ids = cls._get_product_ids(media)
+        super(ProductMedia, cls).write(*args)
+        media = cls.browse(map(int, media))
+        cls._media_changed('write', media, _get_fields(args[1::2]), list(
+            set(product_ids) | set(cls._get_product_ids(media))
+        ))
+        actions = iter(args)
+        cls.enqueue_derivatives(cls.browse([
+            m.id for records, values in zip(actions, actions)
+            if 'static_file' in values for m in records
+        ]))
+
+    @classmethod
+    def delete(cls, media):
+        ids = map(int, media)
+        product_ids = cls._get_product_ids(media)
+        super(ProductMedia, cls).delete(media)
+        cls._media_changed('delete', ids, None, product_ids)
+
 
 class ProductTemplate:
     __metaclass__ = PoolMeta
@@ -70,6 +369,178 @@ class ProductTemplate:
         getter='get_template_images'
     )
 
+    #: Aggregates over the displayed variants used when the catalog is
+    #: listed one tile per template. See :meth:`render_list`.
+    displayed_variant = fields.Function(
+        fields.Many2One('product.product', 'Displayed Variant'),
+        'get_listing_aggregates'
+    )
+    displayed_variants_count = fields.Function(
+        fields.Integer('Displayed Variants Count'), 'get_listing_aggregates'
+    )
+    min_sale_price = fields.Function(
+        fields.Numeric('Min. Sale Price'), 'get_listing_aggregates'
+    )
+    max_sale_price = fields.Function(
+        fields.Numeric('Max. Sale Price'), 'get_listing_aggregates'
+    )
+    default_image = fields.Function(
+        fields.Many2One('nereid.static.file', 'Image'),
+        'get_listing_aggregates'
+    )
+
+    @classmethod
+    @timed
+    def get_listing_aggregates(cls, templates, names):
+        """
+        Getter for the listing aggregates of templates.
+
+        The displayed variants of all the templates and their default
+        images are fetched in a single query, so that a page of template
+        tiles does not read the variants template by template.
+
+        The displayed variant of a template is its first displayed variant
+        and the default image is the (stored) default image of that
+        variant.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        product = Product.__table__()
+        cursor = Transaction().connection.cursor()
+
+        variants = dict((t.id, []) for t in templates)
+        images = {}
+        for sub_ids in grouped_slice(variants.keys()):
+            cursor.execute(*product.select(
+                product.template, product.id, product.default_image,
+                where=And([
+                    reduce_ids(product.template, sub_ids),
+                    product.displayed_on_eshop == True,  # noqa
+                    product.active == True,  # noqa
+                ]),
+                order_by=product.id.asc
+            ))
+            for template_id, product_id, image_id in cursor.fetchall():
+                variants[template_id].append(product_id)
+                images[product_id] = image_id
+
+        prices = {}
+        if set(['min_sale_price', 'max_sale_price']) & set(names):
+            for variant in Product.browse(
+                    list(chain.from_iterable(variants.itervalues()))):
+                prices[variant.id] = variant.sale_price()
+
+        result = dict((name, {}) for name in names)
+        for template_id, variant_ids in variants.iteritems():
+            variant_prices = [prices[v] for v in variant_ids if v in prices]
+            first_variant = variant_ids[0] if variant_ids else None
+            values = {
+                'displayed_variant': first_variant,
+                'displayed_variants_count': len(variant_ids),
+                'min_sale_price': min(variant_prices or [None]),
+                'max_sale_price': max(variant_prices or [None]),
+                'default_image': images.get(first_variant),
+            }
+            for name in names:
+                result[name][template_id] = values[name]
+        return result
+
+    @classmethod
+    @route('/products/+templates')
+    @route('/products/+templates/<int:page>')
+    @on_replica
+    @instrumented
+    def render_list(cls, page=1):
+        """
+        Renders the list of templates which have at least one active variant
+        displayed on the eshop, one tile per template instead of one per
+        variant.
+
+        The aggregates of the displayed variants are available on each
+        template as :attr:`displayed_variant`,
+        :attr:`displayed_variants_count`, :attr:`min_sale_price`,
+        :attr:`max_sale_price` and :attr:`default_image`. The snapshots of
+        the displayed variants (see :meth:`Product.get_snapshots`) are
+        available as `snapshots`, in the order of the templates, None for
+        the templates without displayed variant.
+
+        :param page: The page in pagination to be displayed
+        """
+        Product = Pool().get('product.product')
+
+        templates = current_website.paginate_catalog(cls, [
+            ('products', 'where', [
+                ('displayed_on_eshop', '=', True),
+                ('active', '=', True),
+            ]),
+        ], page, current_website.products_per_page or Product.per_page)
+        variants = [t.displayed_variant for t in templates.items()]
+        snapshots = iter(Product.get_snapshots(filter(None, variants)))
+        return render_template(
+            'product-template-list.jinja', templates=templates,
+            snapshots=[
+                next(snapshots) if variant else None for variant in variants
+            ]
+        )
+
+    def get_absolute_url(self, **kwargs):
+        """
+        Return the URL of the displayed variant of the template.
+
+        This method works only under a nereid request context
+        """
+        if self.displayed_variant:
+            return self.displayed_variant.get_absolute_url(**kwargs)
+
+    @classmethod
+    def read(cls, ids, fields_names=None):
+        record_read(cls.__name__, ids)
+        return super(ProductTemplate, cls).read(ids, fields_names=fields_names)
+
+    @staticmethod
+    def _get_product_ids(templates):
+        """
+        Return the IDs of the variants of the templates, inactive included
+        """
+        Product = Pool().get('product.product')
+        product = Product.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = []
+        for sub_ids in grouped_slice(map(int, templates)):
+            cursor.execute(*product.select(
+                product.id, where=reduce_ids(product.template, sub_ids)
+            ))
+            ids.extend(id for id, in cursor.fetchall())
+        return ids
+
+    @classmethod
+    def create(cls, vlist):
+        templates = super(ProductTemplate, cls).create(vlist)
+        publish(
+            cls.__name__, 'create', templates, _get_fields(vlist),
+            cls._get_product_ids(templates)
+        )
+        return templates
+
+    @classmethod
+    def write(cls, *args):
+        super(ProductTemplate, cls).write(*args)
+        templates = sum(args[::2], [])
+        publish(
+            cls.__name__, 'write', templates, _get_fields(args[1::2]),
+            cls._get_product_ids(templates)
+        )
+
+    @classmethod
+    def delete(cls, templates):
+        ids = map(int, templates)
+        # The variants are deleted with their template
+        product_ids = cls._get_product_ids(templates)
+        super(ProductTemplate, cls).delete(templates)
+        publish(cls.__name__, 'delete', ids, None, product_ids)
+
+    @timed
     def get_template_images(self, name=None):
         """
         Getter for `images` function field
@@ -81,6 +552,7 @@ class ProductTemplate:
                 template_images.append(media.static_file.id)
         return template_images
 
+    @timed
     def get_products_displayed_on_eshop(self, name=None):
         """
         Return the variants that are displayed on eshop
@@ -112,6 +584,81 @@ class Product:
     #: .. versionadded:: 0.3
     json_allowed_fields = set(['rec_name', 'sale_price', 'id', 'uri'])
 
+    #: The maximum number of products which can be requested at once from
+    #: :meth:`products_json`
+    json_batch_limit = 100
+
+    _json_fields_cache = Cache(
+        'nereid_catalog.product.json_fields', size_limit=10240
+    )
+
+    _uri_cache = Cache(
+        'nereid_catalog.product.uri', size_limit=10240, context=False
+    )
+
+    _snapshot_cache = Cache(
+        'nereid_catalog.product.snapshot', size_limit=10240
+    )
+
+    #: The maximum number of products returned by search suggestions
+    suggest_limit = 10
+
+    #: The width and height of the thumbnails of search suggestions
+    suggest_thumbnail_size = (64, 64)
+
+    #: The sizes `(width, height)` of the thumbnails of the default image
+    #: shown by listings, whose URLs are precomputed (see
+    #: :meth:`get_listing_thumbnail`)
+    listing_thumbnail_sizes = [(300, 300)]
+
+    #: The weights of the fields of products in the ranking of search
+    #: results
+    search_field_weights = {
+        'name': 3.0,
+        'code': 2.0,
+        'description': 1.0,
+        'long_description': 0.5,
+    }
+
+    #: The number of seconds after which the in-memory indexes of the
+    #: catalog (search suggestions and search) of a process are rebuilt, to
+    #: pick up the changes made by other processes. Changes made by the
+    #: process itself are applied incrementally.
+    catalog_index_timeout = 60 * 60
+
+    _catalog_indexes = {}
+    _catalog_indexes_building = {}
+    _catalog_indexes_lock = Lock()
+
+    #: The number of products read at once by the bulk exports of the
+    #: catalog
+    export_batch_size = 500
+
+    #: The number of seconds for which the JSON lines export of the catalog
+    #: is served before being written again, see :meth:`render_json_lines`
+    json_lines_cache_timeout = 60 * 15
+
+    #: The condition of the products in product feeds
+    feed_condition = 'new'
+
+    #: The number of seconds by which the watermark of a delta run overlaps
+    #: the previous run, to get the changes of the transactions which were
+    #: still running when it started (see :meth:`get_watermark`)
+    watermark_margin = 60 * 5
+
+    #: The available quantity from which a product is no longer in the
+    #: `low_stock` availability
+    low_stock_quantity = 5
+
+    #: The availabilities of the products listed when only the products in
+    #: stock are requested, along with the products not refreshed yet and
+    #: those which are not goods
+    available_buckets = ('in_stock', 'low_stock')
+
+    #: The fields of products from which no cache of the catalog is built,
+    #: whose changes invalidate none of them
+    uncached_fields = frozenset(['availability', 'available_quantity'])
+
     uri = fields.Char(
         'URI', select=True, states=DEFAULT_STATE2
     )
@@ -131,10 +678,21 @@ class Product:
         'product.product-product.product',
         'product', 'cross_sell', 'Cross-Sells', states=DEFAULT_STATE
     )
-    default_image = fields.Function(
-        fields.Many2One('nereid.static.file', 'Image'), 'get_default_image',
+    default_image = fields.Many2One(
+        'nereid.static.file', 'Image', readonly=True, ondelete='SET NULL',
+        help='The first image of the variant, or else of its template. '
+        'It is updated as the media change.'
     )
+    listing_thumbnails = fields.Text('Listing Thumbnails', readonly=True)
     use_template_description = fields.Boolean("Use template's description")
+    availability = fields.Selection([
+        (None, ''),
+        ('in_stock', 'In Stock'),
+        ('low_stock', 'Low Stock'),
+        ('out_of_stock', 'Out of Stock'),
+    ], 'Availability', readonly=True, select=True, sort=False,
+        help='Updated from the stock moves by refresh_availability.')
+    available_quantity = fields.Float('Available Quantity', readonly=True)
 
     @classmethod
     def view_attributes(cls):
@@ -167,21 +725,203 @@ class Product:
 
         return duplicate_products
 
+    @classmethod
+    def read(cls, ids, fields_names=None):
+        record_read(cls.__name__, ids)
+        return super(Product, cls).read(ids, fields_names=fields_names)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        # Migration from 4.0: default_image is stored
+        fill_default_images = not TableHandler(
+            cls, module_name
+        ).column_exist('default_image')
+
+        super(Product, cls).__register__(module_name)
+
+        if fill_default_images and TableHandler.table_exist('product_media'):
+            cls.update_default_images()
+
+    @classmethod
+    def create(cls, vlist):
+        products = super(Product, cls).create(vlist)
+        cls.update_default_images(map(int, products))
+        publish(
+            cls.__name__, 'create', products, _get_fields(vlist), products
+        )
+        return products
+
+    @classmethod
+    def write(cls, *args):
+        Redirect = Pool().get('product.uri.redirect')
+
+        actions = iter(args)
+        redirects = [
+            {'uri': p.uri, 'product': p.id}
+            for products, values in zip(actions, actions)
+            if 'uri' in values for p in products
+            if p.uri and p.uri != values['uri']
+        ]
+        super(Product, cls).write(*args)
+        Redirect.add_redirects(redirects)
+        actions = iter(args)
+        cls.update_default_images([
+            p.id for products, values in zip(actions, actions)
+            if 'template' in values for p in products
+        ])
+        products = sum(args[::2], [])
+        publish(
+            cls.__name__, 'write', products, _get_fields(args[1::2]),
+            map(int, products)
+        )
+
+    @classmethod
+    def delete(cls, products):
+        Deletion = Pool().get('product.product.deletion')
+
+        ids = map(int, products)
+        super(Product, cls).delete(products)
+        Deletion.create([{'product': id} for id in ids])
+        publish(cls.__name__, 'delete', ids, None, ids)
+
     @classmethod
     def validate(cls, products):
         super(Product, cls).validate(products)
-        cls.check_uri_uniqueness(products)
+        if not Transaction().context.get('_defer_uri_check'):
+            cls.check_uri_uniqueness(products)
 
     @classmethod
-    def get_default_image(cls, products, name):
+    def update_default_images(cls, ids=None):
         """
-        Returns default product image if any.
+        Store the default image of the products and the paths of its
+        listing thumbnails.
+
+        The default image is the first image of the media of the variant or
+        else of its template, as :meth:`get_images` returns them. The
+        products are updated by set based queries: one per slice of
+        products for their default image, and one per slice of their
+        images for the listing thumbnails.
+
+        :param ids: The IDs of the products, all the products by default
         """
-        res = {}
-        for product in products:
-            images = product.images or product.template.images
-            res[product.id] = images[0].id if images else None
-        return res
+        pool = Pool()
+        Media = pool.get('product.media')
+        StaticFile = pool.get('nereid.static.file')
+        product = cls.__table__()
+        media = Media.__table__()
+        static_file = StaticFile.__table__()
+        cursor = Transaction().connection.cursor()
+
+        is_image = Or([
+            Lower(static_file.name).like('%' + extension)
+            for extension, mimetype in sorted(mimetypes.types_map.items())
+            if 'image' in mimetype
+        ])
+        # The media of the variant come before those of the template, then
+        # in the order of the media
+        default_image = media.join(
+            static_file, condition=media.static_file == static_file.id
+        ).select(
+            static_file.id,
+            where=And([Or([
+                media.product == product.id,
+                media.template == product.template,
+            ]), is_image]),
+            order_by=[
+                Case((media.product == Null, 1), else_=0),
+                media.sequence, media.id,
+            ],
+            limit=1,
+        )
+
+        if ids is None:
+            wheres = [Literal(True)]
+        else:
+            wheres = [
+                reduce_ids(product.id, sub_ids)
+                for sub_ids in grouped_slice(ids)
+            ]
+        for where in wheres:
+            cursor.execute(*product.update(
+                [product.default_image, product.listing_thumbnails],
+                [default_image, Null], where=where
+            ))
+            cursor.execute(*product.join(
+                static_file, condition=product.default_image == static_file.id
+            ).select(
+                static_file.id, static_file.name, where=where,
+                group_by=[static_file.id, static_file.name]
+            ))
+            for images in grouped_slice(cursor.fetchall()):
+                images = list(images)
+                cursor.execute(*product.update(
+                    [product.listing_thumbnails],
+                    [Case(*[
+                        (product.default_image == image_id,
+                            cls._get_listing_thumbnails(image_id, image_name))
+                        for image_id, image_name in images
+                    ])],
+                    where=where & reduce_ids(
+                        product.default_image, [i for i, _ in images]
+                    )
+                ))
+        cls._clear_transaction_cache(ids)
+
+    @classmethod
+    def _clear_transaction_cache(cls, ids=None):
+        """
+        Clear the values of the products cached by the transaction once
+        they are updated by queries, as :meth:`write` does
+
+        :param ids: The IDs of the products, all the products by default
+        """
+        transaction = Transaction()
+        transaction.counter += 1
+        for cache in transaction.cache.itervalues():
+            if cls.__name__ not in cache:
+                continue
+            if ids is None:
+                cache[cls.__name__].clear()
+            else:
+                for id in ids:
+                    cache[cls.__name__].pop(id, None)
+
+    @classmethod
+    def _get_listing_thumbnails(cls, image_id, image_name):
+        """
+        Return the paths (relative to the root of the website) of the
+        thumbnails of the image for the :attr:`listing_thumbnail_sizes`, as
+        JSON
+        """
+        return json.dumps(dict(
+            ('%dx%d' % (width, height),
+             get_thumbnail_path(image_id, image_name, width, height))
+            for width, height in cls.listing_thumbnail_sizes
+        ))
+
+    def get_listing_thumbnail(self, width, height):
+        """
+        Return the URL of the thumbnail of the default image of the given
+        size, or None if the product has no image.
+
+        The URLs of the :attr:`listing_thumbnail_sizes` are precomputed when
+        the default image changes, so that a page of product tiles builds
+        no URL. Other sizes are built on the fly.
+
+        This method works only under a nereid request context
+        """
+        if not self.default_image:
+            return None
+        path = json.loads(self.listing_thumbnails or '{}').get(
+            '%dx%d' % (width, height)
+        )
+        if path is None:
+            return self.default_image.transform_command().thumbnail(
+                width, height, 'a'
+            ).url()
+        return get_url_root() + path
 
     @classmethod
     def __setup__(cls):
@@ -191,8 +931,16 @@ class Product:
         )
         cls._error_messages.update({
             'unique_uri': ('URI of Product must be Unique'),
+            'stock_not_installed': (
+                'The availability of products requires the stock module.'
+            ),
+            'import_relations_without_code': (
+                'The variant of "%(template)s" has up-sells or cross-sells '
+                'but no code to identify it.'
+            ),
         })
         cls.per_page = 12
+        event_bus.subscribe(_on_catalog_event)
 
     @staticmethod
     def default_displayed_on_eshop():
@@ -234,9 +982,125 @@ class Product:
         if query != ['OR'] and cls.search(query):
             cls.raise_user_error('unique_uri')
 
+    @classmethod
+    def check_uri_duplicates(cls):
+        """
+        Ensure uniqueness of the URIs of all the displayed products with a
+        single query.
+
+        This is the check of :meth:`check_uri_uniqueness` for all the
+        products at once, to be called after bulk changes made with the
+        `_defer_uri_check` context, which skips the check product by
+        product. Being private, the key is removed from the context of RPC
+        calls.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.select(
+            Lower(table.uri),
+            where=table.uri != Null,
+            group_by=Lower(table.uri),
+            having=(Count(Literal(1)) > 1) & (Max(Case(
+                (table.displayed_on_eshop == True, 1), else_=0  # noqa
+            )) == 1),
+            limit=1
+        ))
+        if cursor.fetchone():
+            cls.raise_user_error('unique_uri')
+
+    @classmethod
+    def get_taken_uris(cls):
+        """
+        Return the set of the URIs of all the products, in lower case, for
+        :meth:`get_unique_uri`
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.select(
+            Lower(table.uri), where=table.uri != Null
+        ))
+        return set(uri for uri, in cursor.fetchall())
+
+    @staticmethod
+    def get_unique_uri(uri, taken, suffixes=None):
+        """
+        Return the URI if not taken or else the first URI not taken among
+        the URI suffixed with the slug of each of the suffixes then with an
+        increasing number, and add it to the taken URIs.
+
+        >>> taken = set(['red-shoe'])
+        >>> Product.get_unique_uri('red-shoe', taken, ['RS 42'])
+        u'red-shoe-rs-42'
+        >>> Product.get_unique_uri('Red-Shoe', taken, ['RS 42'])
+        'Red-Shoe-2'
+
+        :param uri: The URI wanted
+        :param taken: The set of the URIs taken, in lower case
+        :param suffixes: A list of strings identifying the product
+        """
+        candidates = [uri] + [
+            '%s-%s' % (uri, slugify(suffix))
+            for suffix in suffixes or [] if suffix
+        ]
+        for candidate in candidates:
+            if candidate.lower() not in taken:
+                break
+        else:
+            number = 2
+            while ('%s-%d' % (uri, number)).lower() in taken:
+                number += 1
+            candidate = '%s-%d' % (uri, number)
+        taken.add(candidate.lower())
+        return candidate
+
+    def _get_uri_suffixes(self):
+        """
+        Return the list of the strings suffixed to the URI generated for the
+        product when the slug of its template name is taken, in order of
+        preference. Modules adding attributes to variants can extend it.
+        """
+        return [self.code]
+
+    @classmethod
+    def assign_missing_uris(cls, batch_size=None):
+        """
+        Assign a URI to the displayed products without one and return the
+        number of products changed.
+
+        The URIs are the slugs of the template names, suffixed as
+        :meth:`get_unique_uri` does to avoid the URIs taken, which are
+        loaded once. The products are processed in the order of their IDs,
+        so that the same catalog always gets the same URIs, and their
+        uniqueness is checked once at the end.
+
+        :param batch_size: The number of products written at once
+        """
+        taken = cls.get_taken_uris()
+        count = 0
+        with Transaction().set_context(_defer_uri_check=True):
+            for products in cls.iter_displayed_products(
+                    [['OR', ('uri', '=', None), ('uri', '=', '')]],
+                    batch_size):
+                to_write = []
+                for product in products:
+                    to_write.extend([[product], {
+                        'uri': cls.get_unique_uri(
+                            slugify(product.template.name), taken,
+                            product._get_uri_suffixes()
+                        ),
+                    }])
+                cls.write(*to_write)
+                count += len(products)
+        cls.check_uri_duplicates()
+        return count
+
     @classmethod
     @route('/product/<uri>')
     @route('/product/<path:path>/<uri>')
+    @on_replica
+    @instrumented
     def render(cls, uri, path=None):
         """Renders the template for a single product.
 
@@ -246,19 +1110,141 @@ class Product:
                      product/category/sub-cat/sub-sub-cat/product-uri
                      are generated
         """
+        product_id = cls.get_from_uri(uri)
+        if product_id is None:
+            redirect_uri = cls.get_redirect_uri(uri)
+            if redirect_uri is None:
+                return NotFound('Product Not Found')
+            return redirect(
+                url_for('product.product.render', uri=redirect_uri), 301
+            )
+
+        cls._add_to_recent_list(product_id)
+        return render_template(
+            'product.jinja', product=cls(product_id),
+            page=cls.get_page_data([product_id])[product_id]
+        )
+
+    @classmethod
+    def get_from_uri(cls, uri):
+        """
+        Return the ID of the displayed product with the given URI or None.
+
+        When the catalog snapshot is enabled, the IDs are looked up in it
+        first, without the products changed since it was built (see
+        :mod:`~nereid_catalog.snapshot`). The other IDs are cached by URI
+        until the catalog changes, so that rendering a product does not
+        search the products.
+
+        :param uri: URI of the product
+        """
+        if catalog_snapshot is not None:
+            event_bus.start()
+            catalog_snapshot.validate(cls.get_changed_ids)
+            product_id = catalog_snapshot.get_id(uri)
+            if product_id is not None:
+                return product_id
+
+        product_id = cls._uri_cache.get(uri)
+        if product_id is not None:
+            return product_id
+
         products = cls.search([
             ('displayed_on_eshop', '=', True),
             ('uri', '=', uri),
             ('template.active', '=', True),
         ], limit=1)
         if not products:
-            return NotFound('Product Not Found')
+            return None
+        return cls._uri_cache.set(uri, products[0].id)
+
+    @classmethod
+    def get_changed_ids(cls, since):
+        """
+        Return the IDs of the products changed since the watermark, with a
+        single query: those created, modified or deleted, and those whose
+        template or media were created or modified.
+
+        :param since: A watermark of :meth:`get_watermark`
+        """
+        pool = Pool()
+        Template = pool.get('product.template')
+        Media = pool.get('product.media')
+        Deletion = pool.get('product.product.deletion')
+        product = cls.__table__()
+        template = Template.__table__()
+        media = Media.__table__()
+        deletion = Deletion.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*Union(
+            product.select(product.id, where=Or([
+                product.create_date > since,
+                product.write_date > since,
+            ])),
+            product.join(
+                template, condition=product.template == template.id
+            ).select(product.id, where=template.write_date > since),
+            product.join(media, condition=Or([
+                media.product == product.id,
+                media.template == product.template,
+            ])).select(product.id, where=Or([
+                media.create_date > since,
+                media.write_date > since,
+            ])),
+            deletion.select(
+                deletion.product, where=deletion.create_date > since
+            )
+        ))
+        return [id for id, in cursor.fetchall()]
+
+    @classmethod
+    def get_redirect_uri(cls, uri):
+        """
+        Return the current URI of the displayed product which had the given
+        URI or None.
 
-        cls._add_to_recent_list(int(products[0]))
-        return render_template('product.jinja', product=products[0])
+        The URIs are cached with the IDs of :meth:`get_from_uri`, so that
+        following a redirect costs as little as rendering a product.
+
+        :param uri: The former URI of the product
+        """
+        pool = Pool()
+        Redirect = pool.get('product.uri.redirect')
+        Template = pool.get('product.template')
+        redirect_table = Redirect.__table__()
+        product = cls.__table__()
+        template = Template.__table__()
+        cursor = Transaction().connection.cursor()
+
+        redirect_uri = cls._uri_cache.get(('redirect', uri))
+        if redirect_uri is not None:
+            return redirect_uri
+
+        cursor.execute(*redirect_table.join(
+            product, condition=redirect_table.product == product.id
+        ).join(
+            template, condition=product.template == template.id
+        ).select(
+            product.uri,
+            where=And([
+                redirect_table.uri == uri,
+                product.displayed_on_eshop == True,  # noqa
+                product.active == True,  # noqa
+                template.active == True,  # noqa
+            ]),
+            order_by=redirect_table.id.desc,
+            limit=1
+        ))
+        row = cursor.fetchone()
+        if not row or not row[0]:
+            return None
+        return cls._uri_cache.set(('redirect', uri), row[0])
 
     @classmethod
     @route('/products/+recent', methods=['GET', 'POST'])
+    @on_replica
+    @instrumented
     def recent_products(cls):
         """
         GET
@@ -279,26 +1265,105 @@ class Product:
         if request.method == 'POST':
             cls._add_to_recent_list(request.form.get('product_id', type=int))
 
+        response = []
+        if hasattr(session, 'sid'):
+            response = cls._get_json_fields(
+                cls.browse(session.get('recent-products', [])),
+                cls._get_requested_json_fields()
+            )
+
+        return jsonify(products=response)
+
+    @classmethod
+    @route('/products/+json')
+    @on_replica
+    @instrumented
+    def products_json(cls):
+        """
+        Return the JSON of the displayed products whose IDs are given in the
+        `ids` argument, either repeated or comma separated, in the order of
+        the IDs. The fields are validated against
+        :attr:`json_allowed_fields`, as :meth:`recent_products` does.
+
+        At most :attr:`json_batch_limit` products can be requested at once.
+        """
+        ids = []
+        for value in request.args.getlist('ids'):
+            try:
+                ids.extend(int(id) for id in value.split(',') if id)
+            except ValueError:
+                abort(400)
+        if len(ids) > cls.json_batch_limit:
+            abort(400)
+
+        products = dict((p.id, p) for p in cls.search([
+            ('id', 'in', ids),
+            ('displayed_on_eshop', '=', True),
+            ('template.active', '=', True),
+        ], order=[]))
+        return jsonify(products=cls._get_json_fields(
+            [products[id] for id in ids if id in products],
+            cls._get_requested_json_fields()
+        ))
+
+    @classmethod
+    def _get_requested_json_fields(cls):
+        """
+        Return the fields requested in the `fields` arguments which are
+        allowed by :attr:`json_allowed_fields`, all of them by default
+        """
         fields = set(request.args.getlist('fields')) or cls.json_allowed_fields
-        fields = fields & cls.json_allowed_fields
+        return fields & cls.json_allowed_fields
 
-        if 'sale_price' in fields:
-            fields.remove('sale_price')
+    @classmethod
+    def _get_json_fields(cls, products, fields):
+        """
+        Return a list of the dictionaries of the given fields of products.
+        The `sale_price` formatted in the currency of the locale is always
+        included.
+
+        The fields other than the sale price are cached, see
+        :meth:`_get_cached_json_fields`. The sale price depends on the user
+        and is computed for each request.
+
+        :param products: A list of products
+        :param fields: A set of field names allowed by
+                       :attr:`json_allowed_fields`
+        """
+        return [
+            dict(product_val, sale_price=format_currency(
+                product.sale_price(), current_locale.currency.code
+            ))
+            for product, product_val in zip(
+                products, cls._get_cached_json_fields(products, fields)
+            )
+        ]
+
+    @classmethod
+    def _get_cached_json_fields(cls, products, fields):
+        """
+        Return a list of the dictionaries of the given fields of products,
+        without the `sale_price`.
 
+        The products are read together and the dictionary of each product
+        is cached per fields and locale until the catalog changes.
+
+        :param products: A list of products
+        :param fields: A set of field names allowed by
+                       :attr:`json_allowed_fields`
+        """
+        fields = frozenset(fields - set(['sale_price']))
         response = []
-        if hasattr(session, 'sid'):
-            products = cls.browse(session.get('recent-products', []))
-            for product in products:
+        for product in products:
+            key = (product.id, fields, current_locale.id)
+            product_val = cls._json_fields_cache.get(key)
+            if product_val is None:
                 product_val = {}
                 for field in fields:
                     product_val[field] = getattr(product, field)
-                product_val['sale_price'] = format_currency(
-                    product.sale_price(),
-                    current_locale.currency.code
-                )
-                response.append(product_val)
-
-        return jsonify(products=response)
+                cls._json_fields_cache.set(key, product_val)
+            response.append(product_val)
+        return response
 
     @classmethod
     def _add_to_recent_list(cls, product_id):
@@ -340,6 +1405,8 @@ class Product:
     @classmethod
     @route('/products')
     @route('/products/<int:page>')
+    @on_replica
+    @instrumented
     def render_list(cls, page=1):
         """
         Renders the list of all products which are displayed_on_shop=True
@@ -347,21 +1414,53 @@ class Product:
         .. tip::
 
             The implementation uses offset for pagination and could be
-            extremely resource intensive on databases. Hence you might want to
-            either have an alternate cache/search server based pagination or
-            limit the pagination to a maximum page number.
+            extremely resource intensive on databases. Hence the page number
+            is limited by the `max_catalog_page` of the website and pages
+            beyond it are not found.
 
-            The base implementation does NOT limit this and could hence result
-            in poor performance
+        The number of products per page is the `products_per_page` of the
+        website, falling back to :attr:`per_page`.
+
+        The products in stock only are listed when the `in_stock` argument
+        is set and they are sorted by availability when the `sort` argument
+        is `availability`, see :meth:`refresh_availability`. Otherwise the
+        products are listed in the order of the catalog snapshot when it is
+        enabled, see :mod:`~nereid_catalog.snapshot`.
 
         :param page: The page in pagination to be displayed
         """
-
-        products = Pagination(cls, [
+        in_stock, sort = cls.get_availability_args()
+        domain = [
             ('displayed_on_eshop', '=', True),
             ('template.active', '=', True),
-        ], page, cls.per_page)
-        return render_template('product-list.jinja', products=products)
+        ]
+        listing = None
+        if catalog_snapshot is not None and not (in_stock or sort):
+            catalog_snapshot.validate(cls.get_changed_ids)
+            displayed = list(domain)
+            listing = catalog_snapshot.get_listing(
+                lambda ids: map(int, cls.search(
+                    displayed + [('id', 'in', ids)], order=[]
+                ))
+            )
+        if listing is not None:
+            domain = [('id', 'in', listing)]
+        elif in_stock:
+            domain.append([
+                'OR',
+                ('availability', 'in', list(cls.available_buckets)),
+                ('availability', '=', None),
+                ('template.type', '!=', 'goods'),
+            ])
+        products = current_website.paginate_catalog(
+            cls, domain, page,
+            current_website.products_per_page or cls.per_page,
+            order=[('availability', 'ASC'), ('id', 'ASC')] if sort else None
+        )
+        return render_template(
+            'product-list.jinja', products=products,
+            snapshots=cls.get_snapshots(products.items())
+        )
 
     def sale_price(self, quantity=0):
         """Return the Sales Price.
@@ -382,6 +1481,8 @@ class Product:
 
     @classmethod
     @route('/sitemaps/product-index.xml')
+    @on_replica
+    @instrumented
     def sitemap_index(cls):
         """
         Returns a Sitemap Index Page
@@ -394,6 +1495,8 @@ class Product:
 
     @classmethod
     @route('/sitemaps/product-<int:page>.xml')
+    @on_replica
+    @instrumented
     def sitemap(cls, page):
         sitemap_section = SitemapSection(
             cls, [
@@ -404,6 +1507,209 @@ class Product:
         sitemap_section.changefreq = 'daily'
         return sitemap_section.render()
 
+    @classmethod
+    def _get_catalog_index(cls, kind, factory, add, wait=True):
+        """
+        Return the in-memory index of the displayed products of the given
+        kind for the database and language of the transaction.
+
+        The index is built on first use and rebuilt after
+        :attr:`catalog_index_timeout` seconds by a single thread at a time,
+        outside of any lock: the other threads keep using the previous index
+        until the new one replaces it, and wait for the first index unless
+        `wait` is False, in which case None is returned. Products which
+        changed since the last lookup are refreshed before the index is
+        returned. The event bus is started in the process first, so that the
+        changes of the other processes mark their products as stale.
+
+        :param kind: The name of the kind of index
+        :param factory: A callable returning a new empty index
+        :param add: A callable adding a product to the index
+        :param wait: Whether to wait for the first index built by another
+                     thread
+        """
+        event_bus.start()
+        transaction = Transaction()
+        key = (transaction.database.name, transaction.language, kind)
+        while True:
+            index = cls._catalog_indexes.get(key)
+            if index is not None and \
+                    index.built_at + cls.catalog_index_timeout >= time.time():
+                break
+            with cls._catalog_indexes_lock:
+                building = cls._catalog_indexes_building.get(key)
+                builder = building is None
+                if builder:
+                    building = cls._catalog_indexes_building[key] = Event()
+            if builder:
+                try:
+                    index = factory()
+                    cls._update_catalog_index(index, add, [
+                        p.id for p in cls.search([
+                            ('displayed_on_eshop', '=', True),
+                            ('template.active', '=', True),
+                        ], order=[])
+                    ])
+                    cls._catalog_indexes[key] = index
+                finally:
+                    with cls._catalog_indexes_lock:
+                        del cls._catalog_indexes_building[key]
+                    building.set()
+                break
+            elif index is not None:
+                break
+            elif not wait:
+                return None
+            # The index is built again if the thread building it failed
+            building.wait()
+
+        stale = index.pop_stale()
+        if stale:
+            cls._update_catalog_index(index, add, list(stale))
+        return index
+
+    @classmethod
+    def _update_catalog_index(cls, index, add, ids):
+        """
+        Add the displayed products among ids to the index and remove the
+        others, reading the products in batches.
+        """
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            products = cls.search([
+                ('id', 'in', sub_ids),
+                ('displayed_on_eshop', '=', True),
+                ('template.active', '=', True),
+            ], order=[])
+            for product in products:
+                add(index, product)
+            for product_id in set(sub_ids) - set(map(int, products)):
+                index.remove(product_id)
+
+    @classmethod
+    def invalidate_catalog_indexes(cls, ids, database_name=None):
+        """
+        Mark the products as stale in the in-memory indexes of the database,
+        the current database by default. They are refreshed from the
+        database on the next lookup, so changes which are rolled back are
+        not indexed.
+        """
+        database_name = database_name or Transaction().database.name
+        for (name, _, _), index in cls._catalog_indexes.items():
+            if name == database_name:
+                index.invalidate(ids)
+
+    @classmethod
+    def invalidate_catalog_caches(cls, ids, fields=None):
+        """
+        Invalidate the caches of the catalog built from the given products.
+        This is called whenever products or their templates change.
+
+        The in-memory indexes are invalidated for the products only, while
+        the caches of Tryton, which can not be invalidated by key, are
+        cleared. Nothing is invalidated when no product changed or when
+        only :attr:`uncached_fields` changed.
+
+        :param ids: IDs of the changed products
+        :param fields: The names of the fields of the products changed, all
+                       by default
+        """
+        Website = Pool().get('nereid.website')
+
+        if not ids or (fields and set(fields) <= cls.uncached_fields):
+            return
+        cls.invalidate_catalog_indexes(ids)
+        cls._json_fields_cache.clear()
+        cls._uri_cache.clear()
+        cls._snapshot_cache.clear()
+        Website.clear_search_results_cache()
+
+    @classmethod
+    def get_suggest_index(cls):
+        """
+        Return the :class:`~nereid_catalog.search.PrefixIndex` of the names
+        of the displayed products used for search suggestions
+        """
+        return cls._get_catalog_index(
+            'suggest', PrefixIndex, cls._add_to_suggest_index
+        )
+
+    @staticmethod
+    def _add_to_suggest_index(index, product):
+        image = product.default_image
+        index.add(product.id, product.name, {
+            'name': product.name,
+            'uri': product.uri,
+            'image': image and (
+                image.id, os.path.splitext(image.name)[1][1:] or 'png'
+            ),
+        })
+
+    @classmethod
+    def get_search_index(cls, wait=True):
+        """
+        Return the :class:`~nereid_catalog.search.SearchIndex` of the
+        displayed products, with the fields weighted by
+        :attr:`search_field_weights` and stemmed in the language of the
+        transaction
+
+        :param wait: Whether to wait for the index being built by another
+                     thread, else None is returned
+        """
+        return cls._get_catalog_index(
+            'search',
+            lambda: SearchIndex(
+                Transaction().language, cls.search_field_weights
+            ),
+            cls._add_to_search_index, wait=wait
+        )
+
+    @staticmethod
+    def _add_to_search_index(index, product):
+        index.add(product.id, {
+            'name': product.name,
+            'code': product.code,
+            'description': product.get_description(),
+            'long_description': product.get_long_description(),
+        })
+
+    @classmethod
+    def get_search_suggestions(cls, prefix, limit=None):
+        """
+        Return a list of dictionaries with the name, URL and thumbnail URL
+        of the displayed products having a word of their name starting with
+        prefix.
+
+        This method works only under a nereid request context
+
+        :param prefix: The prefix typed by the user
+        :param limit: The maximum number of suggestions. Defaults to
+                      :attr:`suggest_limit`
+        """
+        limit = min(limit or cls.suggest_limit, cls.suggest_limit)
+        width, height = cls.suggest_thumbnail_size
+        thumbnail = unicode(
+            TransformationCommand().thumbnail(width, height, 'a')
+        )
+
+        suggestions = []
+        for product_id, _, data in cls.get_suggest_index().search(
+                prefix, limit):
+            image_url = None
+            if data['image']:
+                image_url = url_for(
+                    'nereid.static.file.transform_static_file',
+                    active_id=data['image'][0], commands=thumbnail,
+                    extension=data['image'][1]
+                )
+            suggestions.append({
+                'id': product_id,
+                'name': data['name'],
+                'url': url_for('product.product.render', uri=data['uri']),
+                'image_url': image_url,
+            })
+        return suggestions
+
     def get_absolute_url(self, **kwargs):
         """
         Return the URL of the current product.
@@ -427,6 +1733,748 @@ class Product:
         }
         return response
 
+    def _get_snapshot(self):
+        """
+        Return the :class:`~nereid_catalog.snapshot.ProductSnapshot` of the
+        product
+
+        This method works only under a nereid request context
+        """
+        sale_price = self.sale_price()
+        return ProductSnapshot(
+            id=self.id,
+            uri=self.uri,
+            url=self.get_absolute_url(),
+            name=self.rec_name,
+            code=self.code,
+            list_price=self.list_price,
+            sale_price=sale_price,
+            formatted_price=format_currency(
+                sale_price, current_locale.currency.code
+            ),
+            image_url=self.get_listing_thumbnail(
+                *self.listing_thumbnail_sizes[0]
+            ),
+            description=self.get_description(),
+        )
+
+    @classmethod
+    def get_snapshots(cls, products):
+        """
+        Return the snapshots of the products, in the same order, for
+        listings which must not read records.
+
+        The products missing from the cache are read together and the
+        snapshot of each product is cached per locale and prices (see
+        :meth:`get_price_key`) until the catalog changes.
+
+        This method works only under a nereid request context
+
+        :param products: A list of products or product IDs
+        """
+        ids = map(int, products)
+        price_key = cls.get_price_key()
+        snapshots, missing = {}, []
+        for product_id in ids:
+            snapshot = cls._snapshot_cache.get(
+                (product_id, current_locale.id, price_key)
+            )
+            if snapshot is None:
+                missing.append(product_id)
+            else:
+                snapshots[product_id] = snapshot
+        for product in cls.browse(list(set(missing))):
+            snapshots[product.id] = cls._snapshot_cache.set(
+                (product.id, current_locale.id, price_key),
+                product._get_snapshot()
+            )
+        return [snapshots[id] for id in ids]
+
+    @classmethod
+    def get_price_key(cls):
+        """
+        Return the key of the sale prices of the current request, with
+        which the caches holding prices are keyed.
+
+        The prices depend on the user (see :meth:`sale_price`), whose ID is
+        the key. The modules computing the prices from a pricelist can
+        return the pricelist instead, so that its users share the caches.
+
+        This method works only under a nereid request context
+        """
+        return current_user.id
+
+    @classmethod
+    def get_availability_bucket(cls, quantity):
+        """
+        Return the availability of a product from its available quantity
+        """
+        if quantity <= 0:
+            return 'out_of_stock'
+        elif quantity < cls.low_stock_quantity:
+            return 'low_stock'
+        return 'in_stock'
+
+    @classmethod
+    def _get_available_quantities(cls, ids):
+        """
+        Return the quantities of the products available in the storage
+        locations of the warehouses today, by product ID
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+
+        location_ids = [
+            w.storage_location.id
+            for w in Location.search([('type', '=', 'warehouse')])
+        ]
+        quantities = dict.fromkeys(ids, 0)
+        if not location_ids:
+            return quantities
+        with Transaction().set_context(stock_date_end=Date.today()):
+            pbl = cls.products_by_location(
+                location_ids, product_ids=ids, with_childs=True
+            )
+        for (_, product_id), quantity in pbl.iteritems():
+            quantities[product_id] += quantity
+        return quantities
+
+    @classmethod
+    def refresh_availability(cls, since=None):
+        """
+        Store the availability and available quantity of the goods whose
+        stock moved since the watermark, of all the goods by default, so
+        that listings filter and sort products on indexed columns instead
+        of computing quantities.
+
+        The modification date of the products changed is updated, so that
+        they are in the delta feeds (see :meth:`get_feed_delta_domain`).
+        The watermark to use for the next refresh is returned along with
+        the number of products changed, as :meth:`write_feed` does. This
+        requires the `stock` module.
+
+        :param since: A watermark of :meth:`get_watermark`
+        :return: A tuple of the number of products changed and the
+                 watermark
+        """
+        pool = Pool()
+        try:
+            Move = pool.get('stock.move')
+        except KeyError:
+            cls.raise_user_error('stock_not_installed')
+        product = cls.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        watermark = cls.get_watermark()
+        if since:
+            cursor.execute(*move.select(
+                move.product,
+                where=(move.create_date > since) | (move.write_date > since),
+                group_by=move.product
+            ))
+            ids = [id for id, in cursor.fetchall()]
+            ids = map(int, cls.search([
+                ('id', 'in', ids),
+                ('template.type', '=', 'goods'),
+            ], order=[]))
+        else:
+            ids = map(int, cls.search([
+                ('template.type', '=', 'goods'),
+            ], order=[]))
+
+        changed = []
+        for sub_ids in grouped_slice(ids, cls.export_batch_size):
+            sub_ids = list(sub_ids)
+            quantities = cls._get_available_quantities(sub_ids)
+            cursor.execute(*product.select(
+                product.id, product.availability, product.available_quantity,
+                where=reduce_ids(product.id, sub_ids)
+            ))
+            values = {}
+            for product_id, availability, quantity in cursor.fetchall():
+                new = (
+                    cls.get_availability_bucket(quantities[product_id]),
+                    quantities[product_id],
+                )
+                if new != (availability, quantity):
+                    values.setdefault(new, []).append(product_id)
+            for (availability, quantity), product_ids in values.iteritems():
+                cursor.execute(*product.update(
+                    [product.availability, product.available_quantity,
+                        product.write_date],
+                    [availability, quantity, CurrentTimestamp()],
+                    where=reduce_ids(product.id, product_ids)
+                ))
+                changed.extend(product_ids)
+        cls._clear_transaction_cache(changed)
+
+        if changed:
+            publish(cls.__name__, 'write', changed, [
+                'availability', 'available_quantity',
+            ], changed)
+        return len(changed), watermark
+
+    @classmethod
+    def refresh_availability_cron(cls):
+        """
+        Refresh the availability of the goods whose stock moved since the
+        previous run, whose watermark is stored, and store the new one.
+
+        This is the function of the cron of the availability.
+        """
+        Refresh = Pool().get('product.availability.refresh')
+        refresh = Refresh(1)
+        count, watermark = cls.refresh_availability(refresh.watermark)
+        Refresh.write([refresh], {'watermark': watermark})
+        return count
+
+    @classmethod
+    def get_availability_args(cls):
+        """
+        Return whether the listing requested is restricted to the products
+        in stock (the `in_stock` argument) and whether it is sorted by
+        availability (the `availability` value of the `sort` argument)
+
+        This method works only under a nereid request context
+        """
+        return (
+            bool(request.args.get('in_stock', 0, type=int)),
+            request.args.get('sort') == 'availability',
+        )
+
+    @classmethod
+    def filter_by_availability(cls, ids, in_stock=False, sort=False):
+        """
+        Return the IDs of the products restricted to those in stock and or
+        sorted by availability, keeping their order otherwise. The stored
+        availabilities are read with a query per slice of products.
+
+        The products not refreshed yet and those which are not goods are
+        kept with those in stock.
+
+        :param ids: A list of product IDs
+        :param in_stock: Whether to keep only the products in stock
+        :param sort: Whether to sort the products by availability
+        """
+        if not (in_stock or sort):
+            return ids
+        Template = Pool().get('product.template')
+        product = cls.__table__()
+        template = Template.__table__()
+        cursor = Transaction().connection.cursor()
+
+        availabilities, goods = {}, set()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*product.join(
+                template, condition=product.template == template.id
+            ).select(
+                product.id, product.availability, template.type,
+                where=reduce_ids(product.id, sub_ids)
+            ))
+            for product_id, availability, type_ in cursor.fetchall():
+                availabilities[product_id] = availability
+                if type_ == 'goods':
+                    goods.add(product_id)
+        if in_stock:
+            available = set(cls.available_buckets) | {None}
+            ids = [
+                id for id in ids
+                if id not in goods or availabilities.get(id) in available
+            ]
+        if sort:
+            ranks = cls.get_availability_ranks()
+            ids = sorted(
+                ids,
+                key=lambda id: ranks.get(availabilities.get(id), len(ranks))
+            )
+        return ids
+
+    @classmethod
+    def get_availability_ranks(cls):
+        """
+        Return the rank of each availability in the listings sorted by
+        availability, the order of the selection. The products not
+        refreshed yet come last.
+        """
+        keys = [key for key, _ in cls.availability.selection if key]
+        return dict((key, index) for index, key in enumerate(keys))
+
+    @classmethod
+    def order_availability(cls, tables):
+        """
+        Order by the rank of the availability instead of its label, see
+        :meth:`get_availability_ranks`
+        """
+        table, _ = tables[None]
+        ranks = cls.get_availability_ranks()
+        return [Case(*[
+            (table.availability == key, rank)
+            for key, rank in sorted(ranks.items(), key=lambda r: r[1])
+        ], else_=len(ranks))]
+
+    @classmethod
+    def get_page_data(cls, products):
+        """
+        Return the data of the pages of the products as a dictionary of
+        plain dictionaries by product ID, so that the templates of product
+        pages read no record:
+
+        `id`, `name`, `code`, `uri`, `url`
+            The identification of the product
+        `sale_price`, `formatted_price`
+            The sale price, and formatted in the currency of the locale
+        `description`, `long_description`
+            The descriptions, see :meth:`get_description`
+        `images`
+            The `id`, `name`, `url`, `zoom_url` and `srcset` of the images
+            of the variant, or else of its template
+        `up_sells`, `cross_sells`
+            The `id`, `name`, `uri`, `url`, `sale_price`,
+            `formatted_price` and `thumbnail` of the displayed related
+            products
+
+        The related products and the media of all the products are fetched
+        with a query per slice of products and the records of the products
+        and related products are read together, instead of lazily one by
+        one by the template.
+
+        This method works only under a nereid request context
+        """
+        pool = Pool()
+        Media = pool.get('product.media')
+        Related = pool.get('product.product-product.product')
+        StaticFile = pool.get('nereid.static.file')
+        product = cls.__table__()
+        media = Media.__table__()
+        related = Related.__table__()
+        static_file = StaticFile.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = map(int, products)
+        up_sells = dict((id, []) for id in ids)
+        cross_sells = dict((id, []) for id in ids)
+        variant_media = dict((id, []) for id in ids)
+        template_media = dict((id, []) for id in ids)
+        for sub_ids in grouped_slice(ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*related.select(
+                related.product, related.up_sell, related.cross_sell,
+                where=reduce_ids(related.product, sub_ids),
+                order_by=related.id.asc
+            ))
+            for product_id, up_sell, cross_sell in cursor.fetchall():
+                if up_sell:
+                    up_sells[product_id].append(up_sell)
+                if cross_sell:
+                    cross_sells[product_id].append(cross_sell)
+
+            cursor.execute(*product.join(media, condition=Or([
+                media.product == product.id,
+                media.template == product.template,
+            ])).join(
+                static_file, condition=media.static_file == static_file.id
+            ).select(
+                product.id, media.product, media.id, static_file.id,
+                static_file.name,
+                where=reduce_ids(product.id, sub_ids),
+                order_by=[media.sequence.asc, media.id.asc]
+            ))
+            for product_id, variant_id, media_id, file_id, file_name \
+                    in cursor.fetchall():
+                mimetype = mimetypes.guess_type(file_name)[0]
+                if not mimetype or 'image' not in mimetype:
+                    continue
+                images = variant_media if variant_id else template_media
+                images[product_id].append((media_id, file_id, file_name))
+
+        # The images of the variant replace those of its template
+        product_media = dict(
+            (id, variant_media[id] or template_media[id]) for id in ids
+        )
+        all_media = set(
+            image for images in product_media.itervalues()
+            for image in images
+        )
+        srcsets = Media.get_srcsets(
+            [media_id for media_id, _, _ in all_media], formats=[None]
+        )
+        files = dict(
+            (f.id, f) for f in StaticFile.browse(
+                list(set(file_id for _, file_id, _ in all_media))
+            )
+        )
+        zoom_width, zoom_height = Media.zoom_sizes[0]
+
+        related_ids = set(
+            id for products_ids in up_sells.values() + cross_sells.values()
+            for id in products_ids
+        )
+        records = dict(
+            (p.id, p) for p in cls.browse(list(set(ids) | related_ids))
+        )
+        currency = current_locale.currency.code
+
+        def get_price(record):
+            price = record.sale_price()
+            return price, format_currency(price, currency)
+
+        def get_related(related_ids):
+            result = []
+            for record in (records[id] for id in related_ids):
+                if not (record.displayed_on_eshop and record.template.active):
+                    continue
+                sale_price, formatted_price = get_price(record)
+                result.append({
+                    'id': record.id,
+                    'name': record.rec_name,
+                    'uri': record.uri,
+                    'url': record.get_absolute_url(),
+                    'sale_price': sale_price,
+                    'formatted_price': formatted_price,
+                    'thumbnail': record.get_listing_thumbnail(
+                        *cls.listing_thumbnail_sizes[0]
+                    ),
+                })
+            return result
+
+        root = get_url_root()
+        result = {}
+        for product_id in ids:
+            record = records[product_id]
+            sale_price, formatted_price = get_price(record)
+            images = [{
+                'id': file_id,
+                'name': file_name,
+                'url': files[file_id].url,
+                'zoom_url': root + get_thumbnail_path(
+                    file_id, file_name, zoom_width, zoom_height
+                ),
+                'srcset': srcsets[media_id][None],
+            } for media_id, file_id, file_name in product_media[product_id]]
+            result[product_id] = {
+                'id': record.id,
+                'name': record.rec_name,
+                'code': record.code,
+                'uri': record.uri,
+                'url': record.get_absolute_url(),
+                'sale_price': sale_price,
+                'formatted_price': formatted_price,
+                'description': record.get_description(),
+                'long_description': record.get_long_description(),
+                'images': images,
+                'up_sells': get_related(up_sells[product_id]),
+                'cross_sells': get_related(cross_sells[product_id]),
+            }
+        return result
+
+    @classmethod
+    def iter_displayed_products(cls, domain=None, batch_size=None):
+        """
+        Iterate over the displayed products in batches of products, in the
+        order of their IDs.
+
+        The batches are searched with a condition on the ID instead of an
+        offset, so every batch costs the same whatever the size of the
+        catalog. The products of a batch are read together when the first
+        one is accessed.
+
+        :param domain: An additional domain the products must match
+        :param batch_size: The number of products per batch. Defaults to
+                           :attr:`export_batch_size`
+        """
+        batch_size = batch_size or cls.export_batch_size
+        last_id = 0
+        while True:
+            products = cls.search([
+                ('id', '>', last_id),
+                ('displayed_on_eshop', '=', True),
+                ('template.active', '=', True),
+            ] + (domain or []), order=[('id', 'ASC')], limit=batch_size)
+            if not products:
+                break
+            yield products
+            last_id = products[-1].id
+
+    def _json_line(self):
+        """
+        Return the record of the product in the JSON lines export of the
+        catalog: the :meth:`_json` serialization with the `id` and `uri`
+        of the product.
+        """
+        record = self._json()
+        record.update({
+            'id': self.id,
+            'uri': self.uri,
+        })
+        return record
+
+    @classmethod
+    def export_json_lines(cls, file_obj):
+        """
+        Write the displayed products as newline delimited JSON to the file,
+        one record (see :meth:`_json_line`) per line. Returns the number of
+        products written.
+
+        :param file_obj: A file like object opened for writing
+        """
+        writer = JSONLinesWriter(file_obj)
+        for products in cls.iter_displayed_products():
+            for product in products:
+                writer.write(product._json_line())
+        writer.close()
+        return writer.count
+
+    @classmethod
+    def export_catalog_json_lines(cls, filename):
+        """
+        Export the displayed products as newline delimited JSON to the
+        file. The file is replaced atomically once fully written, so feed
+        consumers never read a partial export.
+
+        This is meant to be called from a scheduled job or the trytond
+        console to generate feeds.
+
+        :param filename: The path of the file to write
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        with NamedTemporaryFile(dir=directory, delete=False) as buffer:
+            try:
+                count = cls.export_json_lines(buffer)
+            except Exception:
+                os.unlink(buffer.name)
+                raise
+        os.rename(buffer.name, filename)
+        return count
+
+    def _feed_record(self):
+        """
+        Return the record of the product in product feeds, with the fields
+        of :data:`~nereid_catalog.feed.FEED_FIELDS`.
+
+        This method works only under a nereid request context
+        """
+        image = self.default_image
+        return {
+            'id': self.id,
+            'title': self.name,
+            'description': self.get_description().striptags(),
+            'link': self.get_absolute_url(_external=True),
+            'image_link': image and url_for(
+                'nereid.static.file.send_static_file',
+                folder=image.folder.name, name=image.name, _external=True
+            ),
+            'price': u'%s %s' % (
+                self.sale_price(), current_locale.currency.code
+            ),
+            'availability': (
+                'out of stock' if self.availability == 'out_of_stock'
+                else 'in stock'
+            ),
+            'condition': self.feed_condition,
+            'mpn': self.code,
+        }
+
+    @classmethod
+    def get_watermark(cls):
+        """
+        Return the watermark of a delta run starting now: the time of the
+        database clock at the start of the transaction, less
+        :attr:`watermark_margin`.
+
+        The time of the database is the one of the creation and
+        modification dates of the records, and the changes committed by the
+        transactions which started before are not seen by the transaction.
+        """
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*Select([CurrentTimestamp()]))
+        now, = cursor.fetchone()
+        if isinstance(now, basestring):
+            # SQLite returns the text of the time
+            now = datetime.strptime(now[:19], '%Y-%m-%d %H:%M:%S')
+        return now.replace(tzinfo=None) - timedelta(
+            seconds=cls.watermark_margin
+        )
+
+    @classmethod
+    def get_feed_delta_domain(cls, since):
+        """
+        Return the domain of the products whose feed record may have changed
+        since the given date: the product, its template or their media
+        were created or modified since then.
+
+        :param since: A watermark of :meth:`get_watermark`
+        """
+        domain = ['OR']
+        for prefix in ('', 'template.', 'media.', 'template.media.'):
+            domain.extend([
+                (prefix + 'create_date', '>', since),
+                (prefix + 'write_date', '>', since),
+            ])
+        return [domain]
+
+    @classmethod
+    def get_feed_removed_ids(cls, since):
+        """
+        Return the IDs of the products removed from the feeds since the
+        given date: those hidden or deactivated, with their template, and
+        those deleted.
+
+        :param since: A watermark of :meth:`get_watermark`
+        """
+        Deletion = Pool().get('product.product.deletion')
+
+        with Transaction().set_context(active_test=False):
+            products = cls.search(cls.get_feed_delta_domain(since) + [[
+                'OR',
+                ('displayed_on_eshop', '=', False),
+                ('active', '=', False),
+                ('template.active', '=', False),
+            ]], order=[('id', 'ASC')])
+        deletions = Deletion.search([('create_date', '>', since)])
+        return sorted(
+            set(map(int, products)) | set(d.product for d in deletions)
+        )
+
+    @classmethod
+    def write_feed(cls, filename, format='google', since=None):
+        """
+        Write a feed of the displayed products to the file, one product at a
+        time. The file is replaced atomically once fully written.
+
+        A delta feed with only the products changed since a watermark is
+        written when `since` is given, followed by the removals of the
+        products hidden, deactivated or deleted since (see
+        :meth:`~nereid_catalog.feed.JSONLinesWriter.remove`). The watermark
+        to use for the next delta feed is returned along with the number of
+        products written, and recorded for the file so that the deletions
+        older than the watermarks of all the feeds are pruned (see
+        :meth:`ProductDeletion.prune`)::
+
+            count, watermark = Product.write_feed('/srv/feeds/full.xml')
+            ...
+            count, watermark = Product.write_feed(
+                '/srv/feeds/delta.xml', since=watermark
+            )
+
+        This method works only under a nereid request context, used to
+        build the absolute URLs and prices of the feed. Scheduled jobs can
+        use `app.test_request_context('/', base_url='https://<host>')`.
+
+        :param filename: The path of the file to write
+        :param format: The format of the feed, one of
+                       :data:`~nereid_catalog.feed.FEED_WRITERS`
+        :param since: The watermark of a delta feed
+        :return: A tuple of the number of products written and the watermark
+        """
+        Feed = Pool().get('product.feed')
+
+        writer_class = FEED_WRITERS[format]
+        domain = cls.get_feed_delta_domain(since) if since else []
+        # Taken before reading, so that changes committed during the export
+        # are in the next delta feed
+        watermark = cls.get_watermark()
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        with NamedTemporaryFile(dir=directory, delete=False) as buffer:
+            try:
+                writer = writer_class(
+                    buffer,
+                    title=current_website.name,
+                    link=url_for('nereid.website.home', _external=True),
+                )
+                for products in cls.iter_displayed_products(domain):
+                    for product in products:
+                        writer.write(product._feed_record())
+                if since:
+                    for product_id in cls.get_feed_removed_ids(since):
+                        writer.remove(product_id)
+                writer.close()
+            except Exception:
+                os.unlink(buffer.name)
+                raise
+        os.rename(buffer.name, filename)
+        Feed.set_watermark(os.path.abspath(filename), watermark)
+        return writer.count, watermark
+
+    @classmethod
+    def get_json_lines_filename(cls):
+        """
+        Return the name of the file of the JSON lines export served by
+        :meth:`render_json_lines` for the database and language of the
+        transaction, in the folder given by the `export_folder` option of
+        the `nereid_catalog` section of the configuration
+        """
+        transaction = Transaction()
+        folder = config.get(
+            'nereid_catalog', 'export_folder',
+            default=os.path.join(gettempdir(), 'nereid_catalog')
+        )
+        return os.path.join(folder, '%s-%s.jsonl' % (
+            transaction.database.name, transaction.language
+        ))
+
+    @classmethod
+    def _json_lines_expired(cls, filename):
+        try:
+            modified = os.path.getmtime(filename)
+        except OSError:
+            return True
+        return modified + cls.json_lines_cache_timeout < time.time()
+
+    @classmethod
+    def write_json_lines(cls, filename, wait=True):
+        """
+        Write the JSON lines export to the file if it expired, holding a
+        lock on the file so that a single request or job writes it at a
+        time.
+
+        :param filename: The path of the file to write
+        :param wait: Whether to wait for the export being written by
+                     another request or job, else nothing is written
+        """
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError:
+            pass
+        with open(filename + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(
+                    lock, fcntl.LOCK_EX if wait else
+                    fcntl.LOCK_EX | fcntl.LOCK_NB
+                )
+            except IOError:
+                return
+            try:
+                # The export may have been written while waiting
+                if cls._json_lines_expired(filename):
+                    cls.export_catalog_json_lines(filename)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @classmethod
+    @route('/products.jsonl')
+    @on_replica
+    @instrumented
+    def render_json_lines(cls):
+        """
+        Returns all the displayed products as newline delimited JSON, for
+        feed generators. See :meth:`export_json_lines`.
+
+        The export is written to a file (see :meth:`get_json_lines_filename`)
+        which is served for :attr:`json_lines_cache_timeout` seconds before
+        being written again, so that the requests do not export the catalog
+        each time and the file can be sent by the web server. An expired
+        export is written again by a single request at a time (see
+        :meth:`write_json_lines`), the others serve the previous file
+        meanwhile.
+        """
+        filename = cls.get_json_lines_filename()
+        if cls._json_lines_expired(filename):
+            cls.write_json_lines(filename, wait=not os.path.exists(filename))
+        return send_file(filename, mimetype='application/x-ndjson')
+
     def get_long_description(self):
         """
         Get long description of product.
@@ -465,6 +2513,7 @@ class Product:
         return Markup(description or '')
 
     @classmethod
+    @timed
     def get_product_images(cls, products, name=None):
         """
         Getter for `images` function field
@@ -506,11 +2555,148 @@ class ProductsRelated(ModelSQL):
         'product.product', 'Cross-sell Product',
         ondelete='CASCADE', select=True)
 
+    @classmethod
+    def create(cls, vlist):
+        relations = super(ProductsRelated, cls).create(vlist)
+        publish(
+            cls.__name__, 'create', relations, _get_fields(vlist),
+            [r.product.id for r in relations]
+        )
+        return relations
+
+    @classmethod
+    def write(cls, *args):
+        relations = sum(args[::2], [])
+        product_ids = set(r.product.id for r in relations)
+        super(ProductsRelated, cls).write(*args)
+        product_ids.update(r.product.id for r in cls.browse(relations))
+        publish(
+            cls.__name__, 'write', relations, _get_fields(args[1::2]),
+            product_ids
+        )
+
+    @classmethod
+    def delete(cls, relations):
+        ids = map(int, relations)
+        product_ids = [r.product.id for r in relations]
+        super(ProductsRelated, cls).delete(relations)
+        publish(cls.__name__, 'delete', ids, None, product_ids)
+
+
+class ProductUriRedirect(ModelSQL):
+    "Product URI Redirect"
+    __name__ = 'product.uri.redirect'
+
+    uri = fields.Char('URI', required=True, select=True)
+    product = fields.Many2One(
+        'product.product', 'Product',
+        ondelete='CASCADE', select=True, required=True)
+
+    @classmethod
+    def add_redirects(cls, vlist):
+        """
+        Record the former URIs of products, replacing the redirects of the
+        same URIs
+
+        :param vlist: A list of dictionaries with the `uri` and the
+                      `product` ID
+        """
+        if not vlist:
+            return
+        uris = list(set(values['uri'] for values in vlist))
+        for sub_uris in grouped_slice(uris):
+            cls.delete(cls.search([('uri', 'in', list(sub_uris))]))
+        cls.create(vlist)
+
+
+class ProductDeletion(ModelSQL):
+    "Product Deletion"
+    __name__ = 'product.product.deletion'
+
+    # Not a Many2One, the product no longer exists
+    product = fields.Integer('Product', required=True, select=True)
+
+    @classmethod
+    def prune(cls):
+        """
+        Delete the deletions older than the watermarks of all the feeds
+        (see :meth:`Product.write_feed`) and of the catalog snapshot, which
+        no delta needs anymore, and return their number. Nothing is deleted
+        until a feed is written.
+
+        This is the function of the cron of the feeds.
+        """
+        Feed = Pool().get('product.feed')
+
+        feeds = Feed.search([], order=[('watermark', 'ASC')], limit=1)
+        if not feeds:
+            return 0
+        watermark = feeds[0].watermark
+        if catalog_snapshot is not None and catalog_snapshot.watermark:
+            watermark = min(watermark, catalog_snapshot.watermark)
+        deletions = cls.search([('create_date', '<', watermark)])
+        cls.delete(deletions)
+        return len(deletions)
+
+
+class ProductFeed(ModelSQL):
+    "Product Feed"
+    __name__ = 'product.feed'
+
+    filename = fields.Char('File Name', required=True, select=True)
+    watermark = fields.DateTime(
+        'Watermark', required=True, readonly=True,
+        help='The watermark of the last feed written to the file.'
+    )
+
+    @classmethod
+    def set_watermark(cls, filename, watermark):
+        """
+        Record the watermark of the last feed written to the file. The
+        records of the files no longer written must be deleted, else the
+        deletions are kept since their last feed.
+        """
+        feeds = cls.search([('filename', '=', filename)])
+        if feeds:
+            cls.write(feeds, {'watermark': watermark})
+        else:
+            cls.create([{'filename': filename, 'watermark': watermark}])
+
+
+class ProductAvailabilityRefresh(ModelSingleton, ModelSQL):
+    "Product Availability Refresh"
+    __name__ = 'product.availability.refresh'
+
+    watermark = fields.DateTime(
+        'Watermark', readonly=True,
+        help='The watermark of the last refresh of the availability.'
+    )
+
 
 class ProductCategory:
     __metaclass__ = PoolMeta
     __name__ = 'product.category'
 
+    @classmethod
+    def create(cls, vlist):
+        categories = super(ProductCategory, cls).create(vlist)
+        publish(cls.__name__, 'create', categories, _get_fields(vlist))
+        return categories
+
+    @classmethod
+    def write(cls, *args):
+        super(ProductCategory, cls).write(*args)
+        publish(
+            cls.__name__, 'write', sum(args[::2], []),
+            _get_fields(args[1::2])
+        )
+
+    @classmethod
+    def delete(cls, categories):
+        ids = map(int, categories)
+        super(ProductCategory, cls).delete(categories)
+        publish(cls.__name__, 'delete', ids)
+
     @staticmethod
     def order_rec_name(tables):
         table, _ = tables[None]
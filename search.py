@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+import unicodedata
+from bisect import bisect_left
+from collections import defaultdict
+from threading import RLock
+
+__all__ = [
+    'normalize', 'normalize_query', 'tokenize', 'get_stemmer', 'trigrams',
+    'CatalogIndex', 'PrefixIndex', 'SearchIndex', 'StaleRecordsDataManager',
+]
+
+_TAG_RE = re.compile(r'<[^>]*>')
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize(text):
+    """
+    Normalize a text for matching: case folded, accents stripped and
+    whitespace collapsed.
+
+    >>> normalize(u'  Caf\\xe9   Cr\\xe8me ')
+    u'cafe creme'
+    """
+    if not text:
+        return u''
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    text = unicodedata.normalize('NFKD', text)
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return u' '.join(text.lower().split())
+
+
+def normalize_query(query):
+    """
+    Normalize a search query: case folded and whitespace collapsed, so that
+    queries differing only by those are answered the same way.
+
+    >>> normalize_query(u' Running  SHOES ')
+    u'running shoes'
+    """
+    return u' '.join((query or u'').lower().split())
+
+
+def tokenize(text):
+    """
+    Split a text into normalized words, ignoring HTML tags.
+
+    >>> tokenize(u'<p>Red <b>Running</b> Shoes, size 42</p>')
+    [u'red', u'running', u'shoes', u'size', u'42']
+    """
+    return _WORD_RE.findall(normalize(_TAG_RE.sub(u' ', text or u'')))
+
+
+def _strip_suffixes(word, rules, min_length=3):
+    """
+    Apply the first rule `(suffix, replacement)` matching the end of the
+    word, if the resulting stem is at least `min_length` long
+    """
+    for suffix, replacement in rules:
+        if word.endswith(suffix) and \
+                len(word) - len(suffix) + len(replacement) >= min_length:
+            return word[:len(word) - len(suffix)] + replacement
+    return word
+
+
+#: Light stemming rules by language, applied on normalized (accent
+#: stripped) words. They are inflectional only, conflating the plural and
+#: usual declensions of a word, which is what catalog searches need.
+STEMMING_RULES = {
+    'en': [
+        ('ies', 'y'), ('sses', 'ss'), ('shes', 'sh'), ('ches', 'ch'),
+        ('xes', 'x'), ('ing', ''), ('ed', ''), ('ss', 'ss'), ('s', ''),
+    ],
+    'de': [
+        ('ern', ''), ('em', ''), ('en', ''), ('er', ''), ('es', ''),
+        ('e', ''), ('n', ''), ('s', ''),
+    ],
+    'pt': [
+        ('oes', 'ao'), ('aes', 'ao'), ('ais', 'al'), ('eis', 'el'),
+        ('ois', 'ol'), ('res', 'r'), ('zes', 'z'), ('ns', 'm'), ('as', 'a'),
+        ('os', 'o'), ('es', 'e'), ('s', ''),
+    ],
+}
+
+
+def get_stemmer(language):
+    """
+    Return a function stemming the words of the language, given as a
+    language code like `de_DE`. Words of languages without stemming rules
+    are left untouched.
+
+    >>> stem = get_stemmer('en_US')
+    >>> stem(u'shoes'), stem(u'boxes'), stem(u'batteries')
+    (u'shoe', u'box', u'battery')
+    >>> get_stemmer('pt_BR')(u'cordoes')
+    u'cordao'
+    """
+    rules = STEMMING_RULES.get((language or '').split('_')[0])
+    if not rules:
+        return lambda word: word
+    return lambda word: _strip_suffixes(word, rules)
+
+
+def trigrams(word):
+    """
+    Return the set of trigrams of the word padded with spaces
+
+    >>> sorted(trigrams(u'shoe'))
+    [u'  s', u' sh', u'hoe', u'oe ', u'sho']
+    """
+    word = u'  %s ' % word
+    return set(word[index:index + 3] for index in xrange(len(word) - 2))
+
+
+class CatalogIndex(object):
+    """
+    Base class of the in-memory indexes of the catalog.
+
+    Records can be added, replaced and removed incrementally. Records
+    which changed elsewhere can be marked as stale with :meth:`invalidate`
+    and refreshed by the owner of the index with :meth:`pop_stale`. As the
+    records may be refreshed while the transaction changing them is not
+    committed, they are marked as stale again once it ends (see
+    :class:`StaleRecordsDataManager`).
+
+    The indexes are safe to share between the threads of a process.
+    """
+
+    def __init__(self):
+        self.built_at = time.time()
+        self._stale = set()
+        self._lock = RLock()
+
+    def remove(self, record_id):
+        """
+        Remove the record from the index if present
+        """
+        with self._lock:
+            self._stale.discard(record_id)
+
+    def invalidate(self, record_ids):
+        """
+        Mark the records as stale
+        """
+        with self._lock:
+            self._stale.update(record_ids)
+
+    def pop_stale(self):
+        """
+        Return and forget the IDs of the stale records
+        """
+        with self._lock:
+            stale, self._stale = self._stale, set()
+            return stale
+
+
+class PrefixIndex(CatalogIndex):
+    """
+    An in-memory index of product names to be looked up by prefix.
+
+    Every word start of a name is stored as a key in a sorted array, so
+    that all the names having a word starting with a prefix are found with
+    a bisection followed by a scan of the matching keys only. The keys
+    added are sorted once on the next lookup, so that building the index
+    sorts the keys of all the names at once::
+
+        >>> index = PrefixIndex()
+        >>> index.add(1, u'Red Running Shoes', {'uri': 'red-shoes'})
+        >>> index.add(2, u'Shoe Polish', {'uri': 'shoe-polish'})
+        >>> [id for id, _, _ in index.search(u'shoe')]
+        [2, 1]
+        >>> [id for id, _, _ in index.search(u'run')]
+        [1]
+    """
+
+    def __init__(self):
+        super(PrefixIndex, self).__init__()
+        self._keys = []
+        self._sorted = True
+        self._records = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    @staticmethod
+    def _get_keys(record_id, name):
+        words = name.split()
+        return [
+            (u' '.join(words[index:]), record_id)
+            for index in xrange(len(words))
+        ]
+
+    def add(self, record_id, name, data):
+        """
+        Add or replace the record in the index
+
+        :param record_id: ID of the record
+        :param name: The name by which the record is looked up
+        :param data: The data returned for the record by searches
+        """
+        name = normalize(name)
+        with self._lock:
+            self.remove(record_id)
+            self._records[record_id] = (name, data)
+            self._keys.extend(self._get_keys(record_id, name))
+            self._sorted = False
+
+    def _sort(self):
+        if not self._sorted:
+            self._keys.sort()
+            self._sorted = True
+
+    def remove(self, record_id):
+        """
+        Remove the record from the index if present
+        """
+        with self._lock:
+            super(PrefixIndex, self).remove(record_id)
+            if record_id not in self._records:
+                return
+            self._sort()
+            name, _ = self._records.pop(record_id)
+            for key in self._get_keys(record_id, name):
+                index = bisect_left(self._keys, key)
+                if index < len(self._keys) and self._keys[index] == key:
+                    del self._keys[index]
+
+    def search(self, prefix, limit=10):
+        """
+        Return a list of `(id, name, data)` tuples for the records having a
+        word starting with the prefix, in the order of the matching words.
+
+        :param prefix: The prefix to lookup
+        :param limit: The maximum number of records to return
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        result, seen = [], set()
+        with self._lock:
+            self._sort()
+            index = bisect_left(self._keys, (prefix,))
+            while index < len(self._keys) and len(result) < limit:
+                key, record_id = self._keys[index]
+                if not key.startswith(prefix):
+                    break
+                if record_id not in seen:
+                    seen.add(record_id)
+                    name, data = self._records[record_id]
+                    result.append((record_id, name, data))
+                index += 1
+        return result
+
+
+class SearchIndex(CatalogIndex):
+    """
+    An in-memory inverted index of the words of weighted fields, searched
+    with typo tolerance and ranked by relevance.
+
+    The words of each field are stemmed with the stemmer of the language of
+    the index. A word of the query matches the indexed words having the
+    same stem or, failing that, the indexed words whose trigrams are
+    similar enough (see :attr:`similarity_threshold`), so that misspelt
+    queries still find products. Records must match every word of the
+    query and are ranked by the sum of the weights of the fields in which
+    the words were found, scaled by the similarity of the match::
+
+        >>> index = SearchIndex('en_US', {'name': 3, 'description': 1})
+        >>> index.add(1, {'name': u'Red Shoes', 'description': u'Leather'})
+        >>> index.add(2, {'name': u'Shoe Polish', 'description': u'For shoes'})
+        >>> index.add(3, {'name': u'Leather Belt'})
+        >>> index.search(u'shoe')
+        [2, 1]
+        >>> index.search(u'lether')
+        [3, 1]
+        >>> index.search(u'red shoe')
+        [1]
+
+    :param language: The language code of the indexed texts
+    :param field_weights: A dictionary of the weight of each indexed field
+    """
+
+    #: The minimum trigram similarity (Jaccard index) of a query word and
+    #: an indexed word for them to be considered matching
+    similarity_threshold = 0.4
+
+    def __init__(self, language, field_weights):
+        super(SearchIndex, self).__init__()
+        self.stem = get_stemmer(language)
+        self.field_weights = field_weights
+        # stem -> {record id: weight}
+        self._postings = defaultdict(dict)
+        # trigram -> set of stems
+        self._trigrams = defaultdict(set)
+        # record id -> set of stems
+        self._records = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def add(self, record_id, values):
+        """
+        Add or replace the record in the index
+
+        :param record_id: ID of the record
+        :param values: A dictionary of the texts of the indexed fields
+        """
+        weights = defaultdict(float)
+        for field, weight in self.field_weights.iteritems():
+            for word in tokenize(values.get(field)):
+                weights[self.stem(word)] += weight
+
+        with self._lock:
+            self.remove(record_id)
+            self._records[record_id] = set(weights)
+            for stem, weight in weights.iteritems():
+                if stem not in self._postings:
+                    for trigram in trigrams(stem):
+                        self._trigrams[trigram].add(stem)
+                self._postings[stem][record_id] = weight
+
+    def remove(self, record_id):
+        """
+        Remove the record from the index if present
+        """
+        with self._lock:
+            super(SearchIndex, self).remove(record_id)
+            for stem in self._records.pop(record_id, ()):
+                postings = self._postings[stem]
+                postings.pop(record_id, None)
+                if postings:
+                    continue
+                del self._postings[stem]
+                for trigram in trigrams(stem):
+                    self._trigrams[trigram].discard(stem)
+                    if not self._trigrams[trigram]:
+                        del self._trigrams[trigram]
+
+    def _match(self, stem):
+        """
+        Return a dictionary of the indexed stems matching the stem with
+        their similarity to it
+        """
+        if stem in self._postings:
+            return {stem: 1.0}
+        query_trigrams = trigrams(stem)
+        shared = defaultdict(int)
+        for trigram in query_trigrams:
+            for candidate in self._trigrams.get(trigram, ()):
+                shared[candidate] += 1
+        matches = {}
+        for candidate, count in shared.iteritems():
+            similarity = float(count) / (
+                len(query_trigrams) + len(trigrams(candidate)) - count
+            )
+            if similarity >= self.similarity_threshold:
+                matches[candidate] = similarity
+        return matches
+
+    def search(self, query, limit=None):
+        """
+        Return the IDs of the records matching every word of the query,
+        the most relevant first.
+
+        :param query: The search query
+        :param limit: The maximum number of IDs to return
+        """
+        stems = set(self.stem(word) for word in tokenize(query))
+        if not stems:
+            return []
+
+        scores = None
+        with self._lock:
+            for stem in stems:
+                stem_scores = defaultdict(float)
+                for match, similarity in self._match(stem).iteritems():
+                    for record_id, weight in \
+                            self._postings[match].iteritems():
+                        stem_scores[record_id] = max(
+                            stem_scores[record_id], similarity * weight
+                        )
+                if scores is None:
+                    scores = stem_scores
+                else:
+                    scores = dict(
+                        (record_id, score + stem_scores[record_id])
+                        for record_id, score in scores.iteritems()
+                        if record_id in stem_scores
+                    )
+                if not scores:
+                    return []
+
+        ranked = sorted(scores, key=lambda r: (-scores[r], r))
+        return ranked[:limit] if limit else ranked
+
+
+class StaleRecordsDataManager(object):
+    """
+    A data manager of a transaction which marks the records it changed as
+    stale once it ends, committed or not, so that the indexes refreshed
+    from its uncommitted changes are refreshed again from the committed
+    records.
+
+    :param database_name: The name of the database of the transaction
+    :param invalidate: A callable marking a list of record IDs of the
+                       database as stale in its indexes
+    """
+
+    def __init__(self, database_name, invalidate):
+        self.database_name = database_name
+        self.invalidate = invalidate
+        self.record_ids = set()
+
+    def __eq__(self, other):
+        if not isinstance(other, StaleRecordsDataManager):
+            return NotImplemented
+        return self.database_name == other.database_name
+
+    def add(self, record_ids):
+        self.record_ids.update(record_ids)
+
+    def _invalidate(self):
+        record_ids, self.record_ids = self.record_ids, set()
+        if record_ids:
+            self.invalidate(list(record_ids), self.database_name)
+
+    def abort(self, trans):
+        pass
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        self._invalidate()
+
+    def tpc_abort(self, trans):
+        self._invalidate()
@@ -65,6 +65,15 @@ requires.append(
     'trytond >= %s.%s, < %s.%s' %
     (major_version, minor_version, major_version, minor_version + 1)
 )
+requires.append('python-sql >= 0.4')
+tests_require = ['mock']
+for dep in info.get('extras_depend', []):
+    tests_require.append(
+        'trytond_%s >= %s.%s, < %s.%s' % (
+            dep, major_version, minor_version, major_version,
+            minor_version + 1
+        )
+    )
 
 setup(
     name='trytond_nereid_catalog',
@@ -105,6 +114,7 @@ setup(
     [trytond.modules]
     nereid_catalog = trytond.modules.nereid_catalog
     """,
+    tests_require=tests_require,
     test_suite='tests.suite',
     test_loader='trytond.test_loader:Loader',
     cmdclass={
@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+"""
+Compact read only snapshots of products for rendering, and the snapshot of
+the catalog shared by the processes of a server.
+
+The catalog snapshot is a file holding the IDs of the displayed products
+by URI, their listing order, and the prices and listing thumbnails of each
+product. The processes map it in memory (see :class:`CatalogSnapshot`), so
+they share a single copy of it whatever their number, and look products up
+without loading it. It is enabled by the `snapshot_file` option of the
+`nereid_catalog` section of the configuration::
+
+    [nereid_catalog]
+    snapshot_file = /var/lib/nereid/catalog.snapshot
+
+and rebuilt periodically, for example every 5 minutes, with::
+
+    python -m trytond.modules.nereid_catalog.snapshot -c trytond.conf \\
+        --interval 300 <database>
+
+A rebuilt file replaces the previous one atomically and the processes
+switch to it within :attr:`CatalogSnapshot.check_interval` seconds. The
+products changed since are discarded from the snapshot as their events
+arrive (see :mod:`~nereid_catalog.events`) and, as the events of other
+processes may not be shared, every :attr:`CatalogSnapshot.check_interval`
+seconds with a single query of the products changed since the watermark
+of the snapshot (see :meth:`CatalogSnapshot.validate`).
+"""
+import os
+import json
+import mmap
+import time
+import bisect
+import struct
+import logging
+import argparse
+from datetime import datetime, timedelta
+from threading import Lock
+
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = [
+    'ProductSnapshot', 'write_catalog_snapshot', 'CatalogSnapshot',
+    'catalog_snapshot',
+]
+
+logger = logging.getLogger('nereid_catalog.snapshot')
+
+# The magic string, number of products, build time, watermark and offsets
+# of the URI index, ID index and listing order of the catalog snapshot files
+_HEADER = struct.Struct('<4sIddQQQ')
+_MAGIC = 'NCS3'
+# The offset and length of the URI and the ID of a product
+_URI_ENTRY = struct.Struct('<III')
+# The ID of a product and the offset and length of its record
+_ID_ENTRY = struct.Struct('<III')
+_LISTING_ENTRY = struct.Struct('<I')
+# The watermarks are stored as seconds since the epoch
+_EPOCH = datetime(1970, 1, 1)
+
+
+class ProductSnapshot(object):
+    """
+    A read only snapshot of the data of a product needed to render it in
+    listings, built in bulk by :meth:`Product.get_snapshots`.
+
+    Unlike records, snapshots never read the database when their attributes
+    are accessed. They hold no reference to a transaction, so they can be
+    kept in caches and pickled to be shared with other processes.
+    """
+
+    __slots__ = (
+        'id', 'uri', 'url', 'name', 'code', 'list_price', 'sale_price',
+        'formatted_price', 'image_url', 'description',
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read only' % self.__class__.__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is read only' % self.__class__.__name__)
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def __int__(self):
+        return self.id
+
+    def __eq__(self, other):
+        if not isinstance(other, ProductSnapshot):
+            return NotImplemented
+        return self.__getstate__() == other.__getstate__()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(self.__getstate__())
+
+    def __repr__(self):
+        return '<%s %s %r>' % (self.__class__.__name__, self.id, self.uri)
+
+    def get_absolute_url(self):
+        """
+        Return the URL of the product, for the templates rendering records
+        too
+        """
+        return self.url
+
+
+def write_catalog_snapshot(filename, batch_size=None):
+    """
+    Write the snapshot of the displayed products of the catalog to the file,
+    in the current transaction, and return the number of products.
+
+    The snapshot holds the watermark of the transaction (see
+    :meth:`Product.get_watermark`), from which the products changed since
+    are found. The prices are those of the transaction, which has no user
+    of a website.
+
+    The file is written aside and renamed, so that the processes reading
+    the previous snapshot never read a partial one.
+
+    :param filename: The name of the snapshot file
+    :param batch_size: The number of products read at once
+    """
+    Product = Pool().get('product.product')
+
+    watermark = Product.get_watermark()
+    data, uris, ids, offset = [], [], [], 0
+    for products in Product.iter_displayed_products(batch_size=batch_size):
+        for product in products:
+            record = json.dumps({
+                'id': product.id,
+                'uri': product.uri,
+                'list_price': str(product.list_price),
+                'sale_price': str(product.sale_price()),
+                'thumbnails': json.loads(product.listing_thumbnails or '{}'),
+            }, separators=(',', ':'))
+            uri = (product.uri or u'').encode('utf-8')
+            ids.append((product.id, offset, len(record)))
+            uris.append((uri, offset + len(record), len(uri), product.id))
+            data.extend([record, uri])
+            offset += len(record) + len(uri)
+    # The products are listed in the order of the listings of the catalog
+    listing = map(int, Product.search(
+        [('id', 'in', [id for id, _, _ in ids])]
+    )) if ids else []
+    uris.sort()
+
+    uri_offset = _HEADER.size + offset
+    id_offset = uri_offset + _URI_ENTRY.size * len(uris)
+    listing_offset = id_offset + _ID_ENTRY.size * len(ids)
+    partial = '%s.%d.tmp' % (filename, os.getpid())
+    with open(partial, 'wb') as snapshot_file:
+        snapshot_file.write(_HEADER.pack(
+            _MAGIC, len(ids), time.time(),
+            (watermark - _EPOCH).total_seconds(), uri_offset, id_offset,
+            listing_offset
+        ))
+        for chunk in data:
+            snapshot_file.write(chunk)
+        for _, start, length, product_id in uris:
+            snapshot_file.write(
+                _URI_ENTRY.pack(_HEADER.size + start, length, product_id)
+            )
+        # The products are iterated in the order of their IDs
+        for product_id, start, length in ids:
+            snapshot_file.write(
+                _ID_ENTRY.pack(product_id, _HEADER.size + start, length)
+            )
+        for product_id in listing:
+            snapshot_file.write(_LISTING_ENTRY.pack(product_id))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.rename(partial, filename)
+    return len(ids)
+
+
+class _Entries(object):
+    """
+    A sequence of the keys of fixed size entries of a mapped snapshot, for
+    bisect
+    """
+
+    def __init__(self, data, offset, count, key):
+        self.data = data
+        self.offset = offset
+        self.count = count
+        self.key = key
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(self.count))]
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return self.key(self.data, self.offset, index)
+
+
+class _Listing(_Entries):
+    """
+    The listing order of a mapped snapshot, whose slices keep the discarded
+    products only if they are still displayed
+    """
+
+    def __init__(self, data, offset, count, key, discarded, check):
+        super(_Listing, self).__init__(data, offset, count, key)
+        self.discarded = discarded
+        self.check = check
+
+    def __getitem__(self, index):
+        ids = super(_Listing, self).__getitem__(index)
+        if not isinstance(index, slice):
+            return ids
+        discarded = [id for id in ids if id in self.discarded]
+        if discarded:
+            kept = set(self.check(discarded))
+            ids = [
+                id for id in ids if id not in self.discarded or id in kept
+            ]
+        return ids
+
+
+class _MappedSnapshot(object):
+
+    def __init__(self, snapshot_file):
+        self.data = mmap.mmap(
+            snapshot_file.fileno(), 0, access=mmap.ACCESS_READ
+        )
+        magic, self.count, self.built, watermark, uri_offset, id_offset, \
+            self.listing_offset = _HEADER.unpack_from(self.data, 0)
+        if magic != _MAGIC:
+            raise ValueError('Not a catalog snapshot')
+        self.watermark = _EPOCH + timedelta(seconds=watermark)
+        self.uris = _Entries(self.data, uri_offset, self.count, self.get_uri)
+        self.ids = _Entries(self.data, id_offset, self.count, self.get_id)
+
+    @staticmethod
+    def get_uri(data, offset, index):
+        start, length, _ = _URI_ENTRY.unpack_from(
+            data, offset + index * _URI_ENTRY.size
+        )
+        return data[start:start + length]
+
+    @staticmethod
+    def get_id(data, offset, index):
+        return _ID_ENTRY.unpack_from(data, offset + index * _ID_ENTRY.size)[0]
+
+
+class CatalogSnapshot(object):
+    """
+    The reader of a catalog snapshot file written by
+    :func:`write_catalog_snapshot`, which maps it in memory.
+
+    The lookups return nothing while the file does not exist, nor for the
+    products discarded since the file was loaded (see :meth:`discard` and
+    :meth:`validate`).
+
+    :param filename: The name of the snapshot file
+    """
+
+    #: The number of seconds between the checks of the file for a new
+    #: snapshot
+    check_interval = 5
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._snapshot = None
+        self._inode = None
+        self._checked = 0
+        self._validated = 0
+        self._discarded = set()
+        self._lock = Lock()
+
+    def _get_snapshot(self):
+        if time.time() - self._checked < self.check_interval:
+            return self._snapshot
+        with self._lock:
+            self._checked = time.time()
+            try:
+                inode = os.stat(self.filename).st_ino
+            except OSError:
+                self._snapshot = self._inode = None
+                return None
+            if inode != self._inode:
+                # The previous mapping is released by the garbage collector
+                # once the lookups using it are done
+                with open(self.filename, 'rb') as snapshot_file:
+                    self._snapshot = _MappedSnapshot(snapshot_file)
+                self._inode = inode
+                self._validated = 0
+                self._discarded = set()
+                logger.info(
+                    'Catalog snapshot of %d products loaded',
+                    self._snapshot.count
+                )
+            return self._snapshot
+
+    def __len__(self):
+        snapshot = self._get_snapshot()
+        return snapshot.count if snapshot else 0
+
+    @property
+    def built(self):
+        """
+        The time at which the snapshot was built or None
+        """
+        snapshot = self._get_snapshot()
+        return snapshot.built if snapshot else None
+
+    @property
+    def watermark(self):
+        """
+        The watermark of the transaction which built the snapshot or None
+        """
+        snapshot = self._get_snapshot()
+        return snapshot.watermark if snapshot else None
+
+    def get_id(self, uri):
+        """
+        Return the ID of the displayed product with the URI or None
+        """
+        snapshot = self._get_snapshot()
+        if not snapshot or not uri:
+            return None
+        if isinstance(uri, unicode):
+            uri = uri.encode('utf-8')
+        index = bisect.bisect_left(snapshot.uris, uri)
+        if index < snapshot.count and snapshot.uris[index] == uri:
+            product_id = _URI_ENTRY.unpack_from(
+                snapshot.data,
+                snapshot.uris.offset + index * _URI_ENTRY.size
+            )[2]
+            if product_id not in self._discarded:
+                return product_id
+        return None
+
+    def get_record(self, product_id):
+        """
+        Return the dictionary of the `id`, `uri`, `list_price`, `sale_price`
+        and listing `thumbnails` (paths relative to the root of the website
+        by `<width>x<height>`) of the displayed product or None
+        """
+        snapshot = self._get_snapshot()
+        if not snapshot or product_id in self._discarded:
+            return None
+        index = bisect.bisect_left(snapshot.ids, product_id)
+        if index >= snapshot.count or snapshot.ids[index] != product_id:
+            return None
+        _, start, length = _ID_ENTRY.unpack_from(
+            snapshot.data, snapshot.ids.offset + index * _ID_ENTRY.size
+        )
+        return json.loads(snapshot.data[start:start + length])
+
+    def get_listing(self, check):
+        """
+        Return the IDs of the displayed products in the order of the
+        listings, as a sequence read from the file on access, or None.
+
+        The slices of the sequence keep the discarded products returned by
+        `check`, a callable given the discarded IDs of the slice, so that
+        the products changed but still displayed are still listed.
+        """
+        snapshot = self._get_snapshot()
+        if not snapshot:
+            return None
+        return _Listing(
+            snapshot.data, snapshot.listing_offset, snapshot.count,
+            self._get_listing_id, self._discarded, check
+        )
+
+    @staticmethod
+    def _get_listing_id(data, offset, index):
+        return _LISTING_ENTRY.unpack_from(
+            data, offset + index * _LISTING_ENTRY.size
+        )[0]
+
+    def discard(self, product_ids):
+        """
+        Stop returning the products, changed since the snapshot was built,
+        until a new snapshot is loaded
+        """
+        self._discarded.update(product_ids)
+
+    def validate(self, get_changed_ids):
+        """
+        Discard the products changed since the snapshot was built, at most
+        once every :attr:`check_interval` seconds.
+
+        :param get_changed_ids: A callable returning the IDs of the products
+                                changed since a watermark
+        """
+        snapshot = self._get_snapshot()
+        if not snapshot or \
+                time.time() - self._validated < self.check_interval:
+            return
+        self._validated = time.time()
+        self.discard(get_changed_ids(snapshot.watermark))
+
+
+def _get_catalog_snapshot():
+    filename = config.get('nereid_catalog', 'snapshot_file')
+    if filename:
+        return CatalogSnapshot(filename)
+
+
+#: The catalog snapshot of the process, None unless configured
+catalog_snapshot = _get_catalog_snapshot()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write the snapshot of the catalog'
+    )
+    parser.add_argument('database_name')
+    parser.add_argument('-c', '--config', dest='config_file')
+    parser.add_argument('--filename')
+    parser.add_argument(
+        '--interval', type=int,
+        help='Rebuild the snapshot every interval seconds'
+    )
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config.update_etc(options.config_file)
+    filename = options.filename or config.get(
+        'nereid_catalog', 'snapshot_file'
+    )
+    if not filename:
+        parser.error('No snapshot file configured')
+    Pool.start()
+    Pool(options.database_name).init()
+
+    while True:
+        start = time.time()
+        with Transaction().start(
+                options.database_name, 0, readonly=True):
+            count = write_catalog_snapshot(filename)
+        logger.info(
+            'Snapshot of %d products written in %.1fs', count,
+            time.time() - start
+        )
+        if not options.interval:
+            break
+        time.sleep(max(options.interval - (time.time() - start), 0))
+
+
+if __name__ == '__main__':
+    main()
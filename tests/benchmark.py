@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the catalog on large synthetic catalogs.
+
+The benchmarks are not part of the test suite. They generate catalogs of
+the sizes given (in number of variants) with media and related products,
+then measure the latency, the number of SQL queries and the memory growth
+of the routes and methods of the catalog, and write the results as JSON
+for regression tracking. The database is given by the environment,
+which must be set before the module is imported as the test modules of
+trytond read it on import. Run them on SQLite with::
+
+    TRYTOND_DATABASE_URI=sqlite:// DB_NAME=:memory: \\
+        python -m trytond.modules.nereid_catalog.tests.benchmark
+
+or on PostgreSQL with a `postgresql://` database URI and the name of a
+scratch database. The benchmarks are configured by the environment:
+
+`BENCHMARK_SIZES`
+    Comma separated numbers of variants of the catalogs, `10000` by
+    default. `10000,100000,1000000` runs all the standard sizes.
+`BENCHMARK_VARIANTS`
+    The number of variants per template, 4 by default
+`BENCHMARK_REPEAT`
+    The number of timed runs of each benchmark, 5 by default
+`BENCHMARK_OUTPUT`
+    The file the JSON results are written to, the standard output by
+    default
+"""
+import os
+import sys
+import json
+import time
+import resource
+from decimal import Decimal
+
+from trytond import backend
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, with_transaction
+
+from trytond.modules.nereid_catalog.instrumentation import QueryCounter
+from trytond.modules.nereid_catalog.tests.test_catalog import TestCatalog
+
+#: Words the names and descriptions of the synthetic products are made of
+WORDS = [
+    u'red', u'blue', u'green', u'black', u'leather', u'cotton', u'wool',
+    u'running', u'walking', u'shoes', u'boots', u'shirt', u'jacket', u'belt',
+    u'bag', u'hat', u'scarf', u'gloves', u'socks', u'classic', u'sport',
+]
+
+
+def get_max_rss():
+    """
+    Return the peak resident memory of the process in kilobytes
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss // 1024
+    return rss
+
+
+def measure(function, repeat):
+    """
+    Call the function once cold and `repeat` times warm, and return a
+    dictionary of the measures:
+
+    `cold_ms`
+        The duration of the first call
+    `min_ms`, `median_ms`, `max_ms`
+        The durations of the warm calls
+    `queries`
+        The number of SQL queries of the first and of the last call
+    `memory_kb`
+        The growth of the peak resident memory over all the calls
+    """
+    max_rss = get_max_rss()
+    durations, queries = [], []
+    for _ in xrange(repeat + 1):
+        with QueryCounter() as counter:
+            start = time.time()
+            function()
+            durations.append((time.time() - start) * 1000)
+        queries.append(counter.count)
+    warm = sorted(durations[1:])
+    return {
+        'cold_ms': round(durations[0], 3),
+        'min_ms': round(warm[0], 3),
+        'median_ms': round(warm[len(warm) // 2], 3),
+        'max_ms': round(warm[-1], 3),
+        'queries': {'cold': queries[0], 'warm': queries[-1]},
+        'memory_kb': get_max_rss() - max_rss,
+    }
+
+
+class CatalogBenchmark(TestCatalog):
+    """
+    Benchmarks of the catalog, reusing the fixtures of the catalog tests
+    """
+
+    #: The number of templates created at once
+    batch_size = 200
+
+    #: The number of static files shared by the media of the products
+    static_files = 20
+
+    def generate_catalog(self, size, variants):
+        """
+        Create a catalog of `size` displayed variants, `variants` per
+        template. Every template and variant has an image and every variant
+        has up-sells and cross-sells among the variants of its template.
+        """
+        StaticFolder = POOL.get('nereid.static.folder')
+        StaticFile = POOL.get('nereid.static.file')
+        Template = POOL.get('product.template')
+        Uom = POOL.get('product.uom')
+
+        uom, = Uom.search([('name', '=', 'Unit')], limit=1)
+        folder, = StaticFolder.create([{'name': 'benchmark'}])
+        files = StaticFile.create([{
+            'name': 'image-%d.png' % index,
+            'folder': folder.id,
+            'file_binary': buffer('image'),
+        } for index in xrange(self.static_files)])
+        categories = [self.category, self.category2, self.category3]
+
+        number = 0
+        for start in xrange(0, size // variants, self.batch_size):
+            vlist = []
+            for index in xrange(
+                    start, min(start + self.batch_size, size // variants)):
+                words = [
+                    WORDS[(index // len(WORDS) ** power) % len(WORDS)]
+                    for power in xrange(3)
+                ]
+                products = []
+                for _ in xrange(variants):
+                    number += 1
+                    products.append({
+                        'code': 'BENCH-%07d' % number,
+                        'uri': 'product-%d' % number,
+                        'displayed_on_eshop': True,
+                        'description': u' '.join(reversed(words)),
+                        'use_template_description': False,
+                        'media': [('create', [{
+                            'static_file': files[number % len(files)].id,
+                        }])],
+                    })
+                vlist.append({
+                    'name': u'%s %d' % (u' '.join(words).title(), index),
+                    'type': 'goods',
+                    'default_uom': uom.id,
+                    'list_price': Decimal(index % 500 + 1),
+                    'cost_price': Decimal(index % 500),
+                    'categories': [
+                        ('add', [categories[index % len(categories)].id])
+                    ],
+                    'description': u' '.join(words),
+                    'media': [('create', [{
+                        'static_file': files[index % len(files)].id,
+                    }])],
+                    'products': [('create', products)],
+                })
+            self.relate_variants(Template.create(vlist))
+
+    def relate_variants(self, templates):
+        """
+        Make the variants of each template up-sells and cross-sells of
+        each other
+        """
+        Product = POOL.get('product.product')
+
+        to_write = []
+        for template in templates:
+            ids = map(int, template.products)
+            for product in template.products:
+                others = [id for id in ids if id != product.id]
+                to_write.extend([[product], {
+                    'up_sells': [('add', others[:1])],
+                    'cross_sells': [('add', others[1:])],
+                }])
+        if to_write:
+            Product.write(*to_write)
+
+    def get_benchmarks(self, client):
+        """
+        Return a list of the `(name, function)` of the benchmarks
+        """
+        Product = POOL.get('product.product')
+
+        products = Product.search([
+            ('displayed_on_eshop', '=', True),
+        ], order=[('id', 'ASC')], limit=100)
+        product = products[len(products) // 2]
+
+        def get(url):
+            def function():
+                response = client.get(url)
+                assert response.status_code == 200, (url, response.status)
+            return function
+
+        def check_uri_uniqueness():
+            Product.check_uri_uniqueness(Product.browse(map(int, products)))
+
+        def copy():
+            Product.delete(Product.copy([product]))
+
+        return [
+            ('render', get('/product/%s' % product.uri)),
+            ('render_list', get('/products')),
+            ('render_list_page_10', get('/products/10')),
+            ('render_template_list', get('/products/+templates')),
+            ('quick_search', get('/search?q=leather+shoes')),
+            ('quick_search_typo', get('/search?q=lether+shoos')),
+            ('recent_products', get('/products/+recent')),
+            ('sitemap_index', get('/sitemaps/product-index.xml')),
+            ('sitemap', get('/sitemaps/product-1.xml')),
+            ('check_uri_uniqueness', check_uri_uniqueness),
+            ('copy', copy),
+        ]
+
+    @with_transaction()
+    def run_benchmarks(self, size, variants, repeat):
+        """
+        Generate a catalog of the size and return the results of the
+        benchmarks on it
+        """
+        self.setup_defaults()
+        start = time.time()
+        self.generate_catalog(size, variants)
+        results = {
+            'size': size,
+            'variants_per_template': variants,
+            'generation_s': round(time.time() - start, 3),
+            'benchmarks': {},
+        }
+
+        app = self.get_app()
+        with app.test_client() as client:
+            for name, function in self.get_benchmarks(client):
+                results['benchmarks'][name] = measure(function, repeat)
+        return results
+
+
+def main():
+    sizes = map(int, os.environ.get('BENCHMARK_SIZES', '10000').split(','))
+    variants = int(os.environ.get('BENCHMARK_VARIANTS', 4))
+    repeat = int(os.environ.get('BENCHMARK_REPEAT', 5))
+
+    trytond.tests.test_tryton.install_module('nereid_catalog')
+    results = {
+        'database': backend.name(),
+        'catalogs': [],
+    }
+    for size in sizes:
+        benchmark = CatalogBenchmark('run_benchmarks')
+        benchmark.setUp()
+        results['catalogs'].append(
+            benchmark.run_benchmarks(size, variants, repeat)
+        )
+
+    output = os.environ.get('BENCHMARK_OUTPUT')
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
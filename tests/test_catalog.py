@@ -1,15 +1,47 @@
 # -*- coding: utf-8 -*-
+import os
+import csv
+import fcntl
 import json
+import pickle
+import sqlite3
 import unittest
+import tempfile
+from contextlib import contextmanager
+from threading import Event
+from datetime import datetime, timedelta
 from decimal import Decimal
+from StringIO import StringIO
+from mock import Mock, patch
+from PIL import Image
 from lxml import objectify
-from nereid import render_template
+from nereid import render_template, current_locale
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import (
     POOL, USER, ModuleTestCase, with_transaction
 )
 from nereid.testing import NereidTestCase
+from trytond.modules.nereid_catalog.derivatives import (
+    DerivativesDataManager, generate_derivatives, get_derivative_filename
+)
+from trytond.modules.nereid_catalog.events import (
+    EventsDataManager, SQLiteEventBus, event_bus
+)
+from trytond.modules.nereid_catalog.importer import CatalogImporter, READERS
+from trytond.modules.nereid_catalog.instrumentation import (
+    QueryBudgetExceeded, query_budget, route_metrics, timings, prometheus_text
+)
+from trytond.modules.nereid_catalog.product import get_thumbnail_path
+from trytond.modules.nereid_catalog.replica import replica_pool
+from trytond.modules.nereid_catalog.search import StaleRecordsDataManager
+from trytond.modules.nereid_catalog.snapshot import (
+    CatalogSnapshot, write_catalog_snapshot
+)
+from trytond.modules.nereid_catalog.warmup import warm_catalog_caches
+from trytond.modules.company.tests import set_company
 from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.transaction import Transaction
 
 config.set('database', 'path', '/tmp/')
 
@@ -173,6 +205,8 @@ class TestCatalog(NereidTestCase):
         this method is called before each test execution.
         """
         trytond.tests.test_tryton.install_module('nereid_catalog')
+        # For the availability of the products
+        trytond.tests.test_tryton.install_module('stock')
 
         self.Currency = POOL.get('currency.currency')
         self.Site = POOL.get('nereid.website')
@@ -209,6 +243,10 @@ class TestCatalog(NereidTestCase):
                 '{% for product in products %}'
                 '|{{ product.name }}|{% endfor %}',
             'product.jinja': '{{ product.sale_price(product.id) }}',
+            'product-template-list.jinja':
+                '{% for template in templates %}'
+                '|{{ template.name }}:{{ template.displayed_variants_count }}|'
+                '{% endfor %}',
         }
 
     def get_template_source(self, name):
@@ -404,6 +442,1481 @@ class TestCatalog(NereidTestCase):
             home_template = render_template('home.jinja', product=product)
             self.assertTrue(file.name in home_template)
 
+    @with_transaction()
+    def test_0110_template_list_view(self):
+        """
+        List the catalog one tile per template with the displayed variants
+        aggregated
+        """
+        ProductTemplate = POOL.get('product.template')
+        Uom = POOL.get('product.uom')
+
+        self.setup_defaults()
+        self.create_test_products()
+
+        unit, = Uom.search([('name', '=', u'Unit')])
+        template, = ProductTemplate.create([{
+            'name': 'product 5',
+            'type': 'goods',
+            'list_price': Decimal('10'),
+            'cost_price': Decimal('5'),
+            'default_uom': unit,
+            'products': [(
+                'create', [{
+                    'uri': 'product-5-variant-%d' % index,
+                    'displayed_on_eshop': index != 3,
+                } for index in xrange(1, 4)]
+            )]
+        }])
+        self.assertEqual(template.displayed_variants_count, 2)
+        self.assertEqual(
+            template.displayed_variant.uri, 'product-5-variant-1'
+        )
+        self.assertEqual(template.min_sale_price, Decimal('10'))
+        self.assertEqual(template.max_sale_price, Decimal('10'))
+        self.assertEqual(template.default_image, None)
+        # Templates whose displayed variants are all inactive are not listed
+        ProductTemplate.create([{
+            'name': 'product 6',
+            'type': 'goods',
+            'list_price': Decimal('10'),
+            'cost_price': Decimal('5'),
+            'default_uom': unit,
+            'products': [('create', [{
+                'uri': 'product-6',
+                'displayed_on_eshop': True,
+                'active': False,
+            }])],
+        }])
+
+        app = self.get_app()
+        with app.test_client() as c:
+            rv = c.get('/products/+templates')
+            self.assertEqual(
+                rv.data,
+                '|product 1:1||product 2:1||product 3:1||product 5:2|'
+            )
+
+    @with_transaction()
+    def test_0120_listing_page_limits(self):
+        """
+        The page size and the maximum page depth of listings come from the
+        website
+        """
+        self.setup_defaults()
+        self.create_test_products()
+        website, = self.NereidWebsite.search([])
+        self.NereidWebsite.write([website], {
+            'products_per_page': 2,
+            'search_results_per_page': 1,
+            'max_catalog_page': 2,
+        })
+        app = self.get_app()
+
+        with app.test_client() as c:
+            rv = c.get('/products')
+            self.assertEqual(rv.data, '|product 1||product 2|')
+            rv = c.get('/products/2')
+            self.assertEqual(rv.data, '|product 3|')
+            rv = c.get('/products/3')
+            self.assertEqual(rv.status_code, 404)
+            rv = c.get('/products/0')
+            self.assertEqual(rv.status_code, 404)
+
+            rv = c.get('/search?q=product&page=2')
+            self.assertEqual(rv.data, '|product 2|')
+            rv = c.get('/search?q=product&page=3')
+            self.assertEqual(rv.status_code, 404)
+
+    @with_transaction()
+    def test_0130_catalog_pagination_count(self):
+        """
+        Listings matching more products than the count limit are counted
+        as estimates
+        """
+        from trytond.modules.nereid_catalog.pagination import \
+            CatalogPagination
+
+        self.setup_defaults()
+        self.create_test_products()
+        domain = [('displayed_on_eshop', '=', True)]
+
+        pagination = CatalogPagination(
+            self.Product, domain, 1, 10, count_limit=3
+        )
+        self.assertEqual(pagination.count, 3)
+        self.assertFalse(pagination.count_is_estimate)
+
+        pagination = CatalogPagination(
+            self.Product, domain, 1, 10, count_limit=2
+        )
+        self.assertEqual(pagination.count, 2)
+        self.assertTrue(pagination.count_is_estimate)
+
+        pagination = CatalogPagination(
+            self.Product, domain, 1, 10, count_limit=2,
+            count_mode='approximate'
+        )
+        self.assertEqual(pagination.count, 3)
+        self.assertTrue(pagination.count_is_estimate)
+
+    @with_transaction()
+    def test_0140_search_suggestions(self):
+        """
+        Suggest products by the prefix of a word of their name
+        """
+        self.setup_defaults()
+        self.create_test_products()
+        app = self.get_app()
+
+        with app.test_client() as c:
+            rv = c.get('/search/+suggest?q=prod')
+            results = json.loads(rv.data)['results']
+            self.assertEqual(
+                [r['name'] for r in results],
+                ['product 1', 'product 2', 'product 3']
+            )
+            self.assertTrue(results[0]['url'].endswith('/product/product-1'))
+
+            rv = c.get('/search/+suggest?q=prod&limit=1')
+            self.assertEqual(len(json.loads(rv.data)['results']), 1)
+
+            rv = c.get('/search/+suggest?q=shoe')
+            self.assertEqual(json.loads(rv.data)['results'], [])
+
+        # Changes are picked up incrementally
+        product, = self.Product.search([('uri', '=', 'product-1')])
+        self.Product.write([product], {'displayed_on_eshop': False})
+        with app.test_client() as c:
+            rv = c.get('/search/+suggest?q=prod')
+            self.assertEqual(len(json.loads(rv.data)['results']), 2)
+
+        # The variants of deleted templates are removed
+        product2, = self.Product.search([('uri', '=', 'product-2')])
+        POOL.get('product.template').delete([product2.template])
+        with app.test_client() as c:
+            rv = c.get('/search/+suggest?q=prod')
+            self.assertEqual(
+                [r['name'] for r in json.loads(rv.data)['results']],
+                ['product 3']
+            )
+
+        # The products changed are refreshed again once the transaction
+        # ends, as other transactions may have refreshed them before
+        index = self.Product.get_suggest_index()
+        transaction = Transaction()
+        datamanager = transaction.join(
+            StaleRecordsDataManager(transaction.database.name, None)
+        )
+        self.assertTrue(
+            set([product.id, product2.id]) <= datamanager.record_ids
+        )
+        datamanager.tpc_finish(transaction)
+        self.assertTrue(
+            set([product.id, product2.id]) <= index.pop_stale()
+        )
+
+    @with_transaction()
+    def test_0150_quick_search_cache(self):
+        """
+        Search results are cached per normalized query and invalidated
+        when the catalog changes
+        """
+        self.setup_defaults()
+        self.create_test_products()
+        app = self.get_app()
+
+        with app.test_client() as c:
+            rv = c.get('/search?q=Product')
+            self.assertEqual(rv.data, '|product 1||product 2||product 3|')
+
+        with app.test_request_context('/'):
+            website, = self.NereidWebsite.search([])
+            key = (website.id, 'en_US', u'product')
+            self.assertTrue(website._search_results_cache.get(key))
+
+            product, = self.Product.search([('uri', '=', 'product-1')])
+            self.Product.write([product], {'displayed_on_eshop': False})
+            self.assertEqual(website._search_results_cache.get(key), None)
+
+        with app.test_client() as c:
+            rv = c.get('/search?q=%20PRODUCT%20')
+            self.assertEqual(rv.data, '|product 2||product 3|')
+
+    @with_transaction()
+    def test_0160_quick_search_ranking(self):
+        """
+        Search tolerates typos and ranks the products by the fields
+        matching the query
+        """
+        self.setup_defaults()
+        self.create_test_products()
+        product2, = self.Product.search([('uri', '=', 'product-2')])
+        product3, = self.Product.search([('uri', '=', 'product-3')])
+        self.Product.write([product2], {
+            'use_template_description': False,
+            'description': 'Goes well with leather shoes',
+        })
+        self.Product.write([product3], {'code': 'SHOES'})
+        app = self.get_app()
+
+        with app.test_client() as c:
+            rv = c.get('/search?q=prodct')
+            self.assertEqual(rv.data, '|product 1||product 2||product 3|')
+
+            rv = c.get('/search?q=shoe')
+            self.assertEqual(rv.data, '|product 3||product 2|')
+
+            rv = c.get('/search?q=shoe+leather')
+            self.assertEqual(rv.data, '|product 2|')
+
+        with app.test_request_context('/'):
+            website, = self.NereidWebsite.search([])
+            product1, = self.Product.search([('uri', '=', 'product-1')])
+            # Only the index is searched
+            self.assertEqual(website._search_products(u'uct 1'), [])
+
+            # The results are limited to the pages which can be displayed
+            website.max_catalog_page = 2
+            website.search_results_per_page = 1
+            self.assertEqual(website.get_search_results_limit(), 2)
+            self.assertEqual(
+                website._search_products(u'product'),
+                [product1.id, product2.id]
+            )
+            website.max_catalog_page = 0
+            self.assertIsNone(website.get_search_results_limit())
+
+            # The products hidden by other processes are not found
+            product = self.Product.__table__()
+            Transaction().connection.cursor().execute(*product.update(
+                [product.displayed_on_eshop], [False],
+                where=product.id == product3.id
+            ))
+            self.assertEqual(
+                website._search_products(u'shoe'), [product2.id]
+            )
+
+            # The names are searched while the index is built
+            key = (Transaction().database.name, 'en_US', 'search')
+            index = self.Product._catalog_indexes.pop(key)
+            self.Product._catalog_indexes_building[key] = Event()
+            try:
+                self.assertIsNone(website._search_products(u'product'))
+                self.assertEqual(
+                    website.get_search_results(u'product'),
+                    [product1.id, product2.id]
+                )
+                # Until the index is built, the results are not cached
+                self.assertIsNone(website._search_results_cache.get(
+                    (website.id, 'en_US', u'product')
+                ))
+            finally:
+                del self.Product._catalog_indexes_building[key]
+                self.Product._catalog_indexes[key] = index
+
+    @with_transaction()
+    def test_0170_json_lines_export(self):
+        """
+        Export the displayed products as newline delimited JSON
+        """
+        self.setup_defaults()
+        self.create_test_products()
+        app = self.get_app()
+        if not config.has_section('nereid_catalog'):
+            config.add_section('nereid_catalog')
+        config.set('nereid_catalog', 'export_folder', tempfile.mkdtemp())
+
+        with app.test_client() as c:
+            rv = c.get('/products.jsonl')
+            records = map(json.loads, rv.data.splitlines())
+            self.assertEqual(
+                [r['uri'] for r in records],
+                ['product-1', 'product-2', 'product-3']
+            )
+            self.assertEqual(records[0]['template']['name'], 'product 1')
+            self.assertEqual(records[0]['template']['list_price'], '10')
+
+        # The export is served from its file until it times out
+        filename = self.Product.get_json_lines_filename()
+        with open(filename, 'w') as export:
+            export.write('{}\n')
+        with app.test_client() as c:
+            self.assertEqual(c.get('/products.jsonl').data, '{}\n')
+        os.utime(filename, (0, 0))
+        # The expired export is served while another request writes it
+        with open(filename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with app.test_client() as c:
+                self.assertEqual(c.get('/products.jsonl').data, '{}\n')
+        with app.test_client() as c:
+            self.assertEqual(
+                len(c.get('/products.jsonl').data.splitlines()), 3
+            )
+        config.remove_option('nereid_catalog', 'export_folder')
+
+        batches = list(self.Product.iter_displayed_products(batch_size=2))
+        self.assertEqual(map(len, batches), [2, 1])
+
+    @with_transaction()
+    def test_0180_product_feed(self):
+        """
+        Write full and delta product feeds
+        """
+        Deletion = POOL.get('product.product.deletion')
+        Feed = POOL.get('product.feed')
+
+        self.setup_defaults()
+        self.create_test_products()
+        app = self.get_app()
+        filename = os.path.join(tempfile.mkdtemp(), 'feed.csv')
+
+        with app.test_request_context('/'):
+            count, watermark = self.Product.write_feed(filename, 'csv')
+            self.assertEqual(count, 3)
+            with open(filename) as feed:
+                rows = list(csv.DictReader(feed))
+            self.assertEqual(
+                [row['title'] for row in rows],
+                ['product 1', 'product 2', 'product 3']
+            )
+            self.assertEqual(rows[0]['price'], '10 USD')
+            self.assertTrue(rows[0]['link'].endswith('/product/product-1'))
+
+            count, _ = self.Product.write_feed(
+                filename, 'csv', since=datetime.utcnow() + timedelta(days=1)
+            )
+            self.assertEqual(count, 0)
+            count, _ = self.Product.write_feed(
+                filename, 'csv', since=datetime.utcnow() - timedelta(days=1)
+            )
+            self.assertEqual(count, 3)
+
+            count, _ = self.Product.write_feed(filename, 'google')
+            self.assertEqual(count, 3)
+            xml = objectify.parse(filename).getroot()
+            self.assertEqual(len(xml.channel.item), 3)
+
+            # The products hidden or deleted are removed by delta feeds
+            product1, product2, product3 = self.Product.search(
+                [('displayed_on_eshop', '=', True)], order=[('id', 'ASC')]
+            )
+            product4, = self.Product.search([('uri', '=', 'product-4')])
+            self.Product.write([product2], {'displayed_on_eshop': False})
+            product3_id = product3.id
+            self.Product.delete([product3])
+            count, _ = self.Product.write_feed(
+                filename, 'csv', since=watermark
+            )
+            self.assertEqual(count, 1)
+            with open(filename) as feed:
+                rows = list(csv.DictReader(feed))
+            self.assertEqual(rows[0]['title'], 'product 1')
+            self.assertEqual(
+                [row['id'] for row in rows[1:]],
+                map(str, [product2.id, product3_id, product4.id])
+            )
+            self.assertEqual(
+                set(row['availability'] for row in rows[1:]),
+                set(['out of stock'])
+            )
+
+        # The deletions are pruned once older than the watermarks of all
+        # the feeds
+        feed, = Feed.search([])
+        self.assertEqual(feed.filename, filename)
+        self.assertEqual(Deletion.prune(), 0)
+        Feed.set_watermark(filename, datetime.utcnow() + timedelta(days=1))
+        Feed.set_watermark('other.csv', datetime.utcnow() - timedelta(days=1))
+        self.assertEqual(Deletion.prune(), 0)
+        Feed.delete(Feed.search([('filename', '=', 'other.csv')]))
+        self.assertEqual(Deletion.prune(), 1)
+        self.assertEqual(Deletion.search([]), [])
+
+    @with_transaction()
+    def test_0190_products_json(self):
+        """
+        Get the JSON of several products at once
+        """
+        self.setup_defaults()
+        self.create_test_products()
+        product1, product2, product3 = self.Product.search(
+            [('displayed_on_eshop', '=', True)], order=[('id', 'ASC')]
+        )
+        product4, = self.Product.search([('uri', '=', 'product-4')])
+        app = self.get_app()
+
+        with app.test_client() as c:
+            rv = c.get('/products/+json?ids=%d,%d&ids=%d&fields=uri' % (
+                product3.id, product1.id, product4.id
+            ))
+            products = json.loads(rv.data)['products']
+            self.assertEqual(
+                [p['uri'] for p in products], ['product-3', 'product-1']
+            )
+            self.assertEqual(set(products[0]), set(['uri', 'sale_price']))
+
+            rv = c.get('/products/+json?ids=%d&fields=cost_price' % (
+                product2.id
+            ))
+            products = json.loads(rv.data)['products']
+            self.assertEqual(products[0].keys(), ['sale_price'])
+
+            rv = c.get('/products/+json?ids=a')
+            self.assertEqual(rv.status_code, 400)
+
+            # The prices depend on the user and are not cached
+            with patch.object(
+                    self.Product, 'sale_price', return_value=Decimal('7')):
+                rv = c.get('/products/+json?ids=%d&fields=uri' % (
+                    product1.id
+                ))
+            products = json.loads(rv.data)['products']
+            self.assertEqual(products[0]['uri'], 'product-1')
+            self.assertEqual(products[0]['sale_price'], '$7.00')
+
+    @with_transaction()
+    def test_0200_route_instrumentation(self):
+        """
+        Count the queries and reads of the catalog routes
+        """
+        self.setup_defaults()
+        self.create_test_products()
+        app = self.get_app()
+        route_metrics.reset()
+
+        with app.test_client() as c:
+            rv = c.get('/products')
+            self.assertTrue(int(rv.headers['X-Catalog-Queries']) > 0)
+            self.assertIn('product.product=', rv.headers['X-Catalog-Reads'])
+            self.assertEqual(rv.headers['X-Catalog-Repeated-Queries'], '0')
+
+            with query_budget(50):
+                c.get('/product/product-1')
+            with self.assertRaises(QueryBudgetExceeded):
+                with query_budget(1):
+                    c.get('/product/product-1')
+
+        metrics = route_metrics.snapshot()
+        self.assertEqual(
+            metrics['product.product.render_list']['requests'], 1
+        )
+        self.assertEqual(metrics['product.product.render']['requests'], 2)
+
+    @with_transaction()
+    def test_0210_timings(self):
+        """
+        Time the getters and routes when timing is enabled
+        """
+        self.setup_defaults()
+        self.create_test_products()
+        app = self.get_app()
+        timings.reset()
+        route_metrics.reset()
+
+        products = self.Product.search([('displayed_on_eshop', '=', True)])
+        [p.images for p in products]
+        self.assertEqual(timings.snapshot(), {})
+
+        timings.enabled = True
+        try:
+            [p.images for p in self.Product.browse(map(int, products))]
+            with app.test_client() as c:
+                c.get('/products')
+        finally:
+            timings.enabled = False
+
+        calls = timings.snapshot()
+        getter = calls[('getter', 'product.product.get_product_images')]
+        self.assertEqual(getter['calls'], 1)
+        self.assertEqual(getter['records'], 3)
+        self.assertEqual(
+            calls[('route', 'product.product.render_list')]['calls'], 1
+        )
+        text = prometheus_text()
+        self.assertIn(
+            'nereid_catalog_calls_total{kind="getter",'
+            'name="product.product.get_product_images"} 1', text
+        )
+        self.assertIn(
+            'nereid_catalog_route_requests_total'
+            '{route="product.product.render_list"} 1', text
+        )
+
+    @with_transaction()
+    def test_0220_default_image(self):
+        """
+        Store the default image of the variants as their media change
+        """
+        StaticFolder = POOL.get('nereid.static.folder')
+        StaticFile = POOL.get('nereid.static.file')
+        Media = POOL.get('product.media')
+
+        self.setup_defaults()
+        folder, = StaticFolder.create([{'name': 'images'}])
+        image1, image2, document = StaticFile.create([{
+            'name': name,
+            'folder': folder.id,
+            'file_binary': buffer('content'),
+        } for name in ['image1.png', 'image2.jpg', 'document.pdf']])
+
+        template, = self._create_product_template('product 1', [{
+            'type': 'goods',
+            'list_price': Decimal('10'),
+            'cost_price': Decimal('5'),
+            'media': [('create', [
+                {'static_file': document.id, 'sequence': 1},
+                {'static_file': image1.id, 'sequence': 2},
+            ])],
+        }], uri='product-1')
+        product, = template.products
+        self.assertEqual(self.Product(product.id).default_image, image1)
+
+        media, = Media.create([{
+            'product': product.id,
+            'static_file': image2.id,
+        }])
+        self.assertEqual(self.Product(product.id).default_image, image2)
+        self.assertEqual(
+            POOL.get('product.template')(template.id).default_image, image2
+        )
+
+        app = self.get_app()
+        with app.test_request_context('/'):
+            self.assertEqual(
+                self.Product(product.id).get_listing_thumbnail(300, 300),
+                '/static-file-transform/%d/'
+                'thumbnail%%2Cw_300%%2Ch_300%%2Cm_a.jpg' % image2.id
+            )
+            self.assertTrue(
+                self.Product(product.id).get_listing_thumbnail(64, 64)
+                .endswith('/thumbnail%2Cw_64%2Ch_64%2Cm_a.jpg')
+            )
+
+        Media.delete([media])
+        self.assertEqual(self.Product(product.id).default_image, image1)
+
+        # The migration fills the default images of all the products
+        table = self.Product.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.update(
+            [table.default_image, table.listing_thumbnails], [None, None]
+        ))
+        self.Product.update_default_images()
+        product = self.Product(product.id)
+        self.assertEqual(product.default_image, image1)
+        self.assertIn('300x300', json.loads(product.listing_thumbnails))
+
+    @with_transaction()
+    def test_0230_media_srcsets(self):
+        """
+        Build the srcsets of media in a batch
+        """
+        StaticFolder = POOL.get('nereid.static.folder')
+        StaticFile = POOL.get('nereid.static.file')
+        Media = POOL.get('product.media')
+
+        self.setup_defaults()
+        folder, = StaticFolder.create([{'name': 'images'}])
+        image1, image2 = StaticFile.create([{
+            'name': name,
+            'folder': folder.id,
+            'file_binary': buffer('content'),
+        } for name in ['image1.png', 'image2.jpg']])
+        self._create_product_template('product 1', [{
+            'type': 'goods',
+            'list_price': Decimal('10'),
+            'cost_price': Decimal('5'),
+            'media': [('create', [
+                {'static_file': image1.id},
+                {'static_file': image2.id},
+            ])],
+        }], uri='product-1')
+        media1, media2 = Media.search([], order=[('id', 'ASC')])
+
+        app = self.get_app()
+        with app.test_request_context('/'):
+            srcsets = Media.get_srcsets(
+                [media1, media2], widths=[100, 200], formats=[None, 'webp']
+            )
+            self.assertEqual(
+                srcsets[media2.id][None],
+                '/static-file-transform/%(id)d/'
+                'thumbnail%%2Cw_100%%2Ch_100%%2Cm_a.jpg 100w, '
+                '/static-file-transform/%(id)d/'
+                'thumbnail%%2Cw_200%%2Ch_200%%2Cm_a.jpg 200w'
+                % {'id': image2.id}
+            )
+            self.assertTrue(
+                srcsets[media1.id]['webp'].endswith('m_a.webp 200w')
+            )
+
+            # The URLs are cached
+            with query_budget(0):
+                self.assertEqual(Media.get_srcsets(
+                    [media1, media2], widths=[100, 200],
+                    formats=[None, 'webp']
+                ), srcsets)
+
+            # The paths built outside of the applications are those of the
+            # route of the application
+            path = get_thumbnail_path(image2.id, image2.name, 100, 100)
+        self.assertEqual(
+            get_thumbnail_path(image2.id, image2.name, 100, 100), path
+        )
+        self.assertIn(path, srcsets[media2.id][None])
+
+    @with_transaction()
+    def test_0240_derivatives(self):
+        """
+        Generate the derivatives of media beforehand
+        """
+        StaticFolder = POOL.get('nereid.static.folder')
+        StaticFile = POOL.get('nereid.static.file')
+        Media = POOL.get('product.media')
+
+        self.setup_defaults()
+        image = Image.new('RGB', (40, 20))
+        content = StringIO()
+        image.save(content, 'png')
+        folder, = StaticFolder.create([{'name': 'images'}])
+        static_file, document = StaticFile.create([{
+            'name': 'image.png',
+            'folder': folder.id,
+            'file_binary': buffer(content.getvalue()),
+        }, {
+            'name': 'document.pdf',
+            'folder': folder.id,
+            'file_binary': buffer('content'),
+        }])
+        self.assertEqual(Media.derivative_workers, 0)
+        with patch.object(Media, 'derivative_workers', 2):
+            self._create_product_template('product 1', [{
+                'type': 'goods',
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'media': [('create', [{'static_file': static_file.id}])],
+            }], uri='product-1')
+
+        # The generation is queued until the transaction is committed
+        datamanager = Transaction().join(
+            DerivativesDataManager(Transaction().database.name)
+        )
+        self.assertEqual(datamanager.file_ids, set([static_file.id]))
+        self.assertIn((300, 300), datamanager.sizes)
+
+        filename = get_derivative_filename(
+            Transaction().database.name, static_file.id,
+            'thumbnail,w_10,h_10,m_a', 'png'
+        )
+        if os.path.exists(filename):
+            os.remove(filename)
+        self.assertEqual(generate_derivatives(
+            [static_file.id, document.id], [(10, 10)]
+        ), 1)
+        self.assertEqual(Image.open(filename).size, (10, 5))
+        self.assertEqual(generate_derivatives([static_file.id], [(10, 10)]), 0)
+
+    @with_transaction()
+    def test_0250_catalog_import(self):
+        """
+        Import a catalog in bulk
+        """
+        Product = POOL.get('product.product')
+
+        self.setup_defaults()
+        self.create_test_products()
+        rows = StringIO('\n'.join(json.dumps(row) for row in [{
+            'template': 'Red Shoe', 'code': 'RS-1', 'list_price': 10,
+            'cross_sells': ['RS-2'],
+        }, {
+            'template': 'Red Shoe', 'code': 'RS-2', 'up_sells': ['BS-1'],
+        }, {
+            'template': 'Blue Shoe', 'code': 'BS-1', 'uri': 'product-1',
+            'displayed_on_eshop': 'false',
+        }]))
+
+        stats = CatalogImporter().import_rows(READERS['jsonl'](rows))
+        self.assertEqual(stats['templates'], 2)
+        self.assertEqual(stats['products'], 3)
+        self.assertEqual(stats['relations'], 2)
+
+        red1, = Product.search([('code', '=', 'RS-1')])
+        red2, = Product.search([('code', '=', 'RS-2')])
+        blue, = Product.search([('code', '=', 'BS-1')])
+        # The URIs taken are suffixed with the code of the product
+        self.assertEqual(red1.uri, 'red-shoe')
+        self.assertEqual(red2.uri, 'red-shoe-rs-2')
+        self.assertEqual(blue.uri, 'product-1-bs-1')
+        self.assertEqual(red1.template, red2.template)
+        self.assertEqual(red1.list_price, Decimal('10'))
+        self.assertFalse(blue.displayed_on_eshop)
+        self.assertEqual(red1.cross_sells, (red2,))
+        self.assertEqual(red2.up_sells, (blue,))
+
+        # The duplicates created without the check are found at once
+        with Transaction().set_context(_defer_uri_check=True):
+            Product.create([{
+                'template': red1.template.id,
+                'uri': 'Red-Shoe',
+                'displayed_on_eshop': True,
+            }])
+        with self.assertRaises(UserError):
+            Product.check_uri_duplicates()
+
+        # The related products can only be given to variants with a code
+        rows = StringIO(json.dumps({
+            'template': 'Green Shoe', 'up_sells': ['RS-1'],
+        }))
+        with self.assertRaisesRegexp(UserError, 'Green Shoe'):
+            CatalogImporter().import_rows(READERS['jsonl'](rows))
+
+    @with_transaction()
+    def test_0260_assign_missing_uris(self):
+        """
+        Assign unique URIs to the displayed products without one
+        """
+        Product = POOL.get('product.product')
+        Template = POOL.get('product.template')
+        Uom = POOL.get('product.uom')
+
+        self.setup_defaults()
+        self.create_test_products()
+        uom, = Uom.search([('name', '=', 'Unit')], limit=1)
+        template1, template2 = Template.create([{
+            'name': 'Product 1',
+            'type': 'goods',
+            'default_uom': uom.id,
+            'list_price': Decimal('10'),
+            'cost_price': Decimal('5'),
+            'products': [('create', [
+                {'code': 'P1-A'}, {}, {'code': 'P1-C'},
+            ])],
+        }, {
+            'name': 'Shoe',
+            'type': 'goods',
+            'default_uom': uom.id,
+            'list_price': Decimal('10'),
+            'cost_price': Decimal('5'),
+            'products': [('create', [{}])],
+        }])
+        # Products displayed before their URI was required
+        product = Product.__table__()
+        Transaction().connection.cursor().execute(*product.update(
+            [product.displayed_on_eshop], [True],
+            where=product.id.in_([
+                p.id for p in template1.products + template2.products
+                if p.code != 'P1-C'
+            ])
+        ))
+
+        self.assertEqual(Product.assign_missing_uris(batch_size=2), 3)
+        variant1, variant2, hidden = sorted(
+            Product.browse(map(int, template1.products)), key=int
+        )
+        self.assertEqual(variant1.uri, 'product-1-p1-a')
+        self.assertEqual(variant2.uri, 'product-1-2')
+        self.assertFalse(hidden.uri)
+        self.assertEqual(Template(template2.id).products[0].uri, 'shoe')
+        self.assertEqual(Product.assign_missing_uris(), 0)
+
+    @with_transaction()
+    def test_0270_uri_redirects(self):
+        """
+        Redirect the former URIs of products to their current URI
+        """
+        Product = POOL.get('product.product')
+
+        self.setup_defaults()
+        self.create_test_products()
+        app = self.get_app()
+        product, = Product.search([('uri', '=', 'product-1')])
+
+        Product.write([product], {'uri': 'new-product-1'})
+        with app.test_client() as c:
+            rv = c.get('/product/product-1')
+            self.assertEqual(rv.status_code, 301)
+            self.assertTrue(
+                rv.location.endswith('/product/new-product-1')
+            )
+            rv = c.get('/product/new-product-1')
+            self.assertEqual(rv.status_code, 200)
+
+            # The redirects are cached like the current URIs
+            with query_budget(0):
+                self.assertEqual(
+                    Product.get_redirect_uri('product-1'), 'new-product-1'
+                )
+
+            Product.write([product], {'uri': 'newer-product-1'})
+            rv = c.get('/product/product-1')
+            self.assertEqual(rv.status_code, 301)
+            self.assertTrue(
+                rv.location.endswith('/product/newer-product-1')
+            )
+
+            # The URIs given back are live again
+            Product.write([product], {'uri': 'product-1'})
+            rv = c.get('/product/product-1')
+            self.assertEqual(rv.status_code, 200)
+            rv = c.get('/product/newer-product-1')
+            self.assertEqual(rv.status_code, 301)
+
+            Product.write([product], {'displayed_on_eshop': False})
+            rv = c.get('/product/newer-product-1')
+            self.assertEqual(rv.status_code, 404)
+
+            # Nor are the inactive products redirected to
+            Product.write([product], {
+                'displayed_on_eshop': True,
+                'active': False,
+            })
+            rv = c.get('/product/newer-product-1')
+            self.assertEqual(rv.status_code, 404)
+
+    @with_transaction()
+    def test_0280_replica_fallback(self):
+        """
+        Serve the read routes from the primary when the replica fails
+        """
+        self.setup_defaults()
+        self.create_test_products()
+        app = self.get_app()
+        primary = Transaction().connection
+
+        class OperationalError(Exception):
+            pass
+
+        replica = Mock()
+        replica.cursor.return_value.execute.side_effect = OperationalError
+        with patch(
+                'trytond.modules.nereid_catalog.replica.psycopg2',
+                Mock(OperationalError=OperationalError)), \
+                patch.object(
+                    replica_pool, 'get_connection', return_value=replica), \
+                patch.object(replica_pool, 'put_connection') as put, \
+                patch.object(replica_pool, 'mark_down') as mark_down:
+            with app.test_client() as c:
+                rv = c.get('/product/product-1')
+                self.assertEqual(rv.status_code, 200)
+                rv = c.get('/products')
+                self.assertEqual(rv.data, '|product 1||product 2||product 3|')
+
+        # The first query of each request ran on the replica, which failed,
+        # then the request ran on the primary connection of the
+        # transaction, which is restored
+        self.assertEqual(replica.cursor.return_value.execute.call_count, 2)
+        self.assertIs(Transaction().connection, primary)
+        self.assertEqual(mark_down.call_count, 2)
+        put.assert_called_with(
+            Transaction().database.name, replica, close=True
+        )
+
+    @with_transaction()
+    def test_0290_product_page_data(self):
+        """
+        Load the data of product pages in batches
+        """
+        StaticFolder = POOL.get('nereid.static.folder')
+        StaticFile = POOL.get('nereid.static.file')
+        Product = POOL.get('product.product')
+        Template = POOL.get('product.template')
+
+        self.setup_defaults()
+        self.create_test_products()
+        folder, = StaticFolder.create([{'name': 'images'}])
+        image1, image2 = StaticFile.create([{
+            'name': name,
+            'folder': folder.id,
+            'file_binary': buffer('content'),
+        } for name in ['image1.png', 'image2.jpg']])
+        product1, product2, product3, product4 = Product.search(
+            [], order=[('id', 'ASC')]
+        )
+        Product.write([product1], {
+            'media': [('create', [{'static_file': image1.id}])],
+            'up_sells': [('add', [product2.id, product4.id])],
+            'cross_sells': [('add', [product3.id])],
+        })
+        Template.write([product2.template], {
+            'media': [('create', [{'static_file': image2.id}])],
+        })
+
+        self.templates['product.jinja'] = (
+            '{{ page.formatted_price }}|'
+            '{% for product in page.up_sells %}{{ product.uri }}{% endfor %}'
+        )
+        app = self.get_app()
+        with app.test_request_context('/'):
+            data = Product.get_page_data([product1, product2])
+            page1, page2 = data[product1.id], data[product2.id]
+
+            self.assertEqual(page1['sale_price'], Decimal('10'))
+            self.assertEqual(page1['url'], '/product/product-1')
+            self.assertEqual(
+                [i['id'] for i in page1['images']], [image1.id]
+            )
+            self.assertTrue(
+                page1['images'][0]['zoom_url'].endswith('m_a.png')
+            )
+            # The images of the template are those of its variants
+            self.assertEqual(
+                [i['id'] for i in page2['images']], [image2.id]
+            )
+            # Only the displayed related products are given
+            self.assertEqual(
+                [p['uri'] for p in page1['up_sells']], ['product-2']
+            )
+            self.assertEqual(page1['up_sells'][0]['sale_price'], 20)
+            self.assertEqual(
+                [p['uri'] for p in page1['cross_sells']], ['product-3']
+            )
+            self.assertEqual(page2['up_sells'], [])
+
+        with app.test_client() as c:
+            rv = c.get('/product/product-1')
+            self.assertTrue(rv.data.endswith('|product-2'))
+
+    @with_transaction()
+    def test_0300_product_snapshots(self):
+        """
+        Build compact read only snapshots of products in bulk
+        """
+        Product = POOL.get('product.product')
+
+        self.setup_defaults()
+        self.create_test_products()
+        product1, product2 = Product.search([
+            ('displayed_on_eshop', '=', True),
+        ], order=[('id', 'ASC')], limit=2)
+
+        self.templates['product-list.jinja'] = (
+            '{% for product in snapshots %}'
+            '|{{ product.name }}:{{ product.url }}|{% endfor %}'
+        )
+        app = self.get_app()
+        with app.test_request_context('/'):
+            snapshot2, snapshot1 = Product.get_snapshots([product2, product1])
+            self.assertEqual(snapshot1.id, product1.id)
+            self.assertEqual(snapshot1.uri, 'product-1')
+            self.assertEqual(snapshot1.url, '/product/product-1')
+            self.assertEqual(snapshot1.name, 'product 1')
+            self.assertEqual(snapshot2.list_price, Decimal('20'))
+            self.assertIsNone(snapshot1.image_url)
+            with self.assertRaises(AttributeError):
+                snapshot1.uri = 'product-2'
+
+            copy = pickle.loads(pickle.dumps(snapshot1, 2))
+            self.assertEqual(copy, snapshot1)
+            self.assertEqual(pickle.loads(pickle.dumps(snapshot1)), snapshot1)
+
+            # The snapshots are cached
+            with query_budget(0):
+                self.assertEqual(
+                    Product.get_snapshots([product1.id]), [snapshot1]
+                )
+
+            # The prices of other users are not shared
+            with patch.object(
+                    Product, 'sale_price', return_value=Decimal('7')):
+                self.assertEqual(
+                    Product.get_snapshots([product1.id]), [snapshot1]
+                )
+                with patch.object(
+                        Product, 'get_price_key', return_value=-1):
+                    other, = Product.get_snapshots([product1.id])
+            self.assertEqual(snapshot1.formatted_price, '$10.00')
+            self.assertEqual(other.formatted_price, '$7.00')
+
+            Product.write([product1], {'uri': 'new-product-1'})
+            snapshot1, = Product.get_snapshots([product1.id])
+            self.assertEqual(snapshot1.uri, 'new-product-1')
+
+        self.templates['product-list.jinja'] = (
+            '{% for product in products %}|{{ product.id }}|{% endfor %}'
+            '{% for product in snapshots %}'
+            '|{{ product.name }}:{{ product.url }}|{% endfor %}'
+        )
+        self.templates['search-results.jinja'] = (
+            self.templates['product-list.jinja']
+        )
+        self.templates['product-template-list.jinja'] = (
+            '{% for product in snapshots %}|{{ product.name }}|{% endfor %}'
+        )
+        with app.test_client() as c:
+            # The page is searched once for the products and the snapshots
+            with patch.object(
+                    Product, 'search', wraps=Product.search) as search:
+                rv = c.get('/products')
+            self.assertEqual(search.call_count, 1)
+            ids = '|%d||%d||%d|' % (product1.id, product2.id, product2.id + 1)
+            self.assertEqual(
+                rv.data, ids + '|product 1:/product/new-product-1|'
+                '|product 2:/product/product-2||product 3:/product/product-3|'
+            )
+
+            rv = c.get('/search?q=product+2')
+            self.assertEqual(
+                rv.data, '|%d||product 2:/product/product-2|' % product2.id
+            )
+
+            rv = c.get('/products/+templates')
+            self.assertEqual(
+                rv.data, '|product 1||product 2||product 3|'
+            )
+
+    @with_transaction()
+    def test_0310_catalog_snapshot_file(self):
+        """
+        Share a snapshot of the catalog through a mapped file
+        """
+        Product = POOL.get('product.product')
+        Template = POOL.get('product.template')
+
+        self.setup_defaults()
+        self.create_test_products()
+        product1, product2, product3 = Product.search([
+            ('displayed_on_eshop', '=', True),
+        ], order=[('id', 'ASC')])
+        product3_id = product3.id
+        cursor = Transaction().connection.cursor()
+        # The products were created before the snapshot is built
+        yesterday = datetime.now() - timedelta(days=1)
+        for table in [Product.__table__(), Template.__table__()]:
+            cursor.execute(*table.update(
+                [table.create_date, table.write_date], [yesterday, yesterday]
+            ))
+
+        filename = os.path.join(tempfile.mkdtemp(), 'catalog.snapshot')
+        snapshot = CatalogSnapshot(filename)
+        snapshot.check_interval = 0
+        self.assertIsNone(snapshot.get_id('product-1'))
+        self.assertIsNone(snapshot.get_listing(None))
+        self.assertEqual(len(snapshot), 0)
+
+        self.assertEqual(write_catalog_snapshot(filename, batch_size=2), 3)
+        self.assertEqual(len(snapshot), 3)
+        self.assertEqual(snapshot.watermark, Product.get_watermark())
+        self.assertEqual(snapshot.get_id('product-2'), product2.id)
+        self.assertEqual(snapshot.get_id(u'product-3'), product3.id)
+        self.assertIsNone(snapshot.get_id('product-4'))
+        self.assertIsNone(snapshot.get_id('product'))
+        self.assertEqual(snapshot.get_record(product1.id), {
+            'id': product1.id,
+            'uri': 'product-1',
+            'list_price': '10',
+            'sale_price': '10',
+            'thumbnails': {},
+        })
+        self.assertIsNone(snapshot.get_record(0))
+        listing = snapshot.get_listing(None)
+        self.assertEqual(len(listing), 3)
+        self.assertEqual(
+            listing[:], [product1.id, product2.id, product3.id]
+        )
+        self.assertEqual(listing[1:2], [product2.id])
+        self.assertEqual(Product.get_changed_ids(snapshot.watermark), [])
+
+        app = self.get_app()
+        with patch(
+                'trytond.modules.nereid_catalog.product.catalog_snapshot',
+                snapshot):
+            # The products are found and listed without search
+            with patch.object(Product, 'search') as search:
+                self.assertEqual(
+                    Product.get_from_uri('product-2'), product2.id
+                )
+                with app.test_client() as c:
+                    rv = c.get('/products')
+                    self.assertEqual(
+                        rv.data, '|product 1||product 2||product 3|'
+                    )
+                self.assertFalse(search.called)
+
+            # The products changed without events are discarded once the
+            # snapshot is validated
+            table = Product.__table__()
+            cursor.execute(*table.update(
+                [table.displayed_on_eshop, table.write_date],
+                [False, datetime.now()],
+                where=table.id == product2.id
+            ))
+            Product._clear_transaction_cache([product2.id])
+            self.assertEqual(
+                Product.get_changed_ids(snapshot.watermark), [product2.id]
+            )
+            self.assertIsNone(Product.get_from_uri('product-2'))
+            self.assertIsNone(snapshot.get_id('product-2'))
+            self.assertIsNone(snapshot.get_record(product2.id))
+            with app.test_client() as c:
+                rv = c.get('/products')
+                self.assertEqual(rv.data, '|product 1||product 3|')
+
+            # The products changed are discarded from the snapshot by their
+            # events, but still listed while displayed
+            Product.write([product1], {'uri': 'new-product-1'})
+            self.assertIsNone(snapshot.get_id('product-1'))
+            self.assertIsNone(Product.get_from_uri('product-1'))
+            self.assertEqual(
+                Product.get_from_uri('new-product-1'), product1.id
+            )
+            self.assertEqual(
+                Product.get_redirect_uri('product-1'), 'new-product-1'
+            )
+            with app.test_client() as c:
+                rv = c.get('/products')
+                self.assertEqual(rv.data, '|product 1||product 3|')
+            Product.delete([product3])
+            self.assertIsNone(Product.get_from_uri('product-3'))
+
+        # Even without the events
+        fresh = CatalogSnapshot(filename)
+        with patch(
+                'trytond.modules.nereid_catalog.product.catalog_snapshot',
+                fresh):
+            self.assertEqual(fresh.get_id('product-3'), product3_id)
+            self.assertIsNone(Product.get_from_uri('product-3'))
+            self.assertIsNone(Product.get_from_uri('product-1'))
+
+        # A rebuilt snapshot replaces the previous one
+        write_catalog_snapshot(filename)
+        self.assertEqual(snapshot.get_id('new-product-1'), product1.id)
+        self.assertEqual(len(snapshot), 1)
+
+    @with_transaction()
+    def test_0320_catalog_events(self):
+        """
+        Publish the changes of the catalog on the event bus
+        """
+        Product = POOL.get('product.product')
+        Template = POOL.get('product.template')
+        Category = POOL.get('product.category')
+
+        self.setup_defaults()
+        self.create_test_products()
+        product1, = Product.search([('uri', '=', 'product-1')])
+
+        events = []
+
+        def handler(event, local):
+            events.append((event, local))
+
+        event_bus.subscribe(handler)
+        try:
+            Product.write([product1], {'uri': 'new-product-1'})
+            Template.write([product1.template], {'name': 'Product One'})
+            Category.write([self.category], {'name': 'Shoes'})
+        finally:
+            event_bus._handlers.remove(handler)
+
+        (product_event, local), (template_event, _), (category_event, _) = \
+            events
+        self.assertTrue(local)
+        self.assertEqual(product_event.model, 'product.product')
+        self.assertEqual(product_event.action, 'write')
+        self.assertEqual(product_event.ids, [product1.id])
+        self.assertEqual(product_event.fields, ['uri'])
+        self.assertEqual(template_event.model, 'product.template')
+        self.assertEqual(template_event.product_ids, [product1.id])
+        self.assertEqual(category_event.ids, [self.category.id])
+        self.assertEqual(category_event.product_ids, [])
+
+        # The events are sent to the other processes once committed, after
+        # those of the creation of the test products
+        datamanager = Transaction().join(
+            EventsDataManager(Transaction().database.name)
+        )
+        self.assertEqual(
+            datamanager.events[-len(events):], [e[0] for e in events]
+        )
+
+        # Only the changes of cached fields invalidate the caches
+        with patch.object(
+                Product, 'invalidate_catalog_indexes') as invalidate:
+            Product.invalidate_catalog_caches([])
+            Product.invalidate_catalog_caches(
+                [product1.id], ['availability', 'available_quantity']
+            )
+            self.assertFalse(invalidate.called)
+            Product.invalidate_catalog_caches([product1.id], ['uri'])
+            invalidate.assert_called_once_with([product1.id])
+
+        filename = os.path.join(tempfile.mkdtemp(), 'events.sqlite')
+        bus = SQLiteEventBus(filename)
+        bus._last_id = 0
+        received = []
+        bus._handlers.append(lambda event, local: received.append(event))
+        bus.send([product_event])
+        # The events of the process are not received again
+        self.assertEqual(bus.poll(), 0)
+        connection = sqlite3.connect(filename)
+        with connection:
+            connection.execute(
+                'UPDATE catalog_event SET pid = ?', (os.getpid() + 1,)
+            )
+        connection.close()
+        bus._last_id = 0
+        self.assertEqual(bus.poll(), 1)
+        self.assertEqual(received, [product_event])
+
+        # The thread reading the events is started again after a fork
+        thread_class = 'trytond.modules.nereid_catalog.events.threading.Thread'
+        with patch(thread_class) as thread:
+            bus._pid = os.getpid()
+            bus.start()
+            self.assertFalse(thread.called)
+            bus._pid = os.getpid() + 1
+            bus.start()
+            thread.assert_called_once_with(target=bus._run)
+            thread.return_value.start.assert_called_once_with()
+            self.assertEqual(bus._pid, os.getpid())
+            self.assertEqual(bus._last_id, 1)
+
+    @with_transaction()
+    def test_0330_availability_filters(self):
+        """
+        Filter and sort listings on the stored availability of products
+        """
+        Product = POOL.get('product.product')
+
+        self.setup_defaults()
+        self.create_test_products()
+        product1, product2, product3 = Product.search([
+            ('displayed_on_eshop', '=', True),
+        ], order=[('id', 'ASC')])
+        self.assertEqual(Product.get_availability_bucket(0), 'out_of_stock')
+        self.assertEqual(Product.get_availability_bucket(2), 'low_stock')
+        self.assertEqual(Product.get_availability_bucket(50), 'in_stock')
+        Product.write([product1], {
+            'availability': 'out_of_stock', 'available_quantity': 0,
+        }, [product2], {
+            'availability': 'low_stock', 'available_quantity': 2,
+        }, [product3], {
+            'availability': 'in_stock', 'available_quantity': 50,
+        })
+
+        ids = map(int, [product1, product2, product3])
+        self.assertEqual(Product.filter_by_availability(ids), ids)
+        self.assertEqual(
+            Product.filter_by_availability(ids, in_stock=True),
+            [product2.id, product3.id]
+        )
+        self.assertEqual(
+            Product.filter_by_availability(ids, sort=True),
+            [product3.id, product2.id, product1.id]
+        )
+
+        app = self.get_app()
+        with app.test_client() as c:
+            rv = c.get('/products?in_stock=1')
+            self.assertEqual(rv.data, '|product 2||product 3|')
+            rv = c.get('/products?sort=availability')
+            self.assertEqual(rv.data, '|product 3||product 2||product 1|')
+            rv = c.get('/search?q=product&in_stock=1&sort=availability')
+            self.assertEqual(rv.data, '|product 3||product 2|')
+
+    @with_transaction()
+    def test_0340_availability_refresh(self):
+        """
+        Refresh the stored availability of the goods from the stock moves
+        """
+        Product = POOL.get('product.product')
+        Location = POOL.get('stock.location')
+        Move = POOL.get('stock.move')
+        Refresh = POOL.get('product.availability.refresh')
+        Template = POOL.get('product.template')
+        Date = POOL.get('ir.date')
+
+        self.setup_defaults()
+        self.create_test_products()
+        self._create_product_template(
+            'service 1',
+            [{
+                'categories': [('add', [self.category.id])],
+                'type': 'service',
+                'list_price': Decimal('40'),
+                'cost_price': Decimal('5'),
+            }],
+            uri='service-1',
+        )
+        product1, product2, product3, product4, service = Product.search(
+            [], order=[('id', 'ASC')]
+        )
+        company, = self.Company.search([])
+        supplier, = Location.search([('code', '=', 'SUP')])
+        storage, = Location.search([('code', '=', 'STO')])
+
+        def receive(product, quantity):
+            Move.do(Move.create([{
+                'product': product.id,
+                'uom': product.default_uom.id,
+                'quantity': quantity,
+                'from_location': supplier.id,
+                'to_location': storage.id,
+                'planned_date': Date.today(),
+                'effective_date': Date.today(),
+                'unit_price': Decimal('5'),
+                'currency': company.currency.id,
+                'company': company.id,
+            }]))
+
+        ids = map(int, [product1, product2, product3, service])
+        # The products not refreshed yet are kept with those in stock
+        self.assertEqual(
+            Product.filter_by_availability(ids, in_stock=True), ids
+        )
+
+        with set_company(company):
+            receive(product1, 5)
+            receive(product2, 2)
+            self.assertEqual(
+                Product._get_available_quantities(ids[:3]), {
+                    product1.id: 5, product2.id: 2, product3.id: 0,
+                }
+            )
+
+            # The products were created before
+            yesterday = datetime.now() - timedelta(days=1)
+            for table in [Product.__table__(), Template.__table__()]:
+                Transaction().connection.cursor().execute(*table.update(
+                    [table.create_date, table.write_date],
+                    [yesterday, yesterday]
+                ))
+            Product._clear_transaction_cache()
+            since = Product.get_watermark()
+
+            self.assertIsNone(Refresh(1).watermark)
+            self.assertEqual(Product.refresh_availability_cron(), 4)
+            # The products refreshed are in the delta feeds
+            self.assertEqual(
+                Product.search(
+                    Product.get_feed_delta_domain(since) + [
+                        ('template.type', '=', 'goods'),
+                    ], order=[('id', 'ASC')]
+                ), [product1, product2, product3, product4]
+            )
+            watermark = Refresh(1).watermark
+            self.assertTrue(watermark)
+            self.assertEqual(
+                [(p.availability, p.available_quantity)
+                    for p in Product.browse(ids)], [
+                    ('in_stock', 5), ('low_stock', 2), ('out_of_stock', 0),
+                    (None, None),
+                ]
+            )
+            # The services are always available
+            self.assertEqual(
+                Product.filter_by_availability(ids, in_stock=True),
+                [product1.id, product2.id, service.id]
+            )
+            # The products are sorted by the rank of their availability,
+            # the products not refreshed last
+            self.assertEqual(Product.get_availability_ranks(), {
+                'in_stock': 0, 'low_stock': 1, 'out_of_stock': 2,
+            })
+            self.assertEqual(
+                Product.search([
+                    ('id', 'in', [service.id] + ids[:3]),
+                ], order=[('availability', 'DESC'), ('id', 'ASC')]),
+                [service, product3, product2, product1]
+            )
+            app = self.get_app()
+            with app.test_client() as c:
+                rv = c.get('/products?in_stock=1')
+                self.assertEqual(
+                    rv.data, '|product 1||product 2||service 1|'
+                )
+                rv = c.get('/products?sort=availability')
+                self.assertEqual(
+                    rv.data,
+                    '|product 1||product 2||product 3||service 1|'
+                )
+
+            # Only the products whose stock moved since the stored
+            # watermark are refreshed
+            receive(product3, 10)
+            with patch.object(
+                    Product, '_get_available_quantities',
+                    wraps=Product._get_available_quantities) as quantities:
+                self.assertEqual(Product.refresh_availability_cron(), 1)
+            quantities.assert_called_once_with(
+                [product1.id, product2.id, product3.id]
+            )
+            self.assertEqual(Product(product3.id).availability, 'in_stock')
+            self.assertGreaterEqual(Refresh(1).watermark, watermark)
+
+    @with_transaction()
+    def test_0350_warm_catalog_caches(self):
+        """
+        Build the caches of the catalog upfront
+        """
+        StaticFolder = POOL.get('nereid.static.folder')
+        StaticFile = POOL.get('nereid.static.file')
+        Media = POOL.get('product.media')
+        Product = POOL.get('product.product')
+        warmup_module = 'trytond.modules.nereid_catalog.warmup'
+
+        self.setup_defaults()
+        self.create_test_products()
+        folder, = StaticFolder.create([{'name': 'images'}])
+        image, = StaticFile.create([{
+            'name': 'image.png',
+            'folder': folder.id,
+            'file_binary': buffer('content'),
+        }])
+        product1, product2, product3 = Product.search([
+            ('displayed_on_eshop', '=', True),
+        ], order=[('id', 'ASC')])
+        media, = Media.create([{
+            'product': product1.id,
+            'static_file': image.id,
+        }])
+
+        @contextmanager
+        def catalog_request(app, base_url):
+            # The test application has no transaction handling and the
+            # in-memory database is local to the thread of the test
+            with app.test_request_context('/', base_url=base_url):
+                yield
+
+        app = self.get_app()
+        route_metrics.reset()
+        with patch(warmup_module + '.catalog_request', catalog_request), \
+                patch(warmup_module + '.ThreadPool') as thread_pool:
+            thread_pool.return_value.map.side_effect = map
+            timings = warm_catalog_caches(
+                app, 'http://localhost', concurrency=2
+            )
+        thread_pool.assert_called_with(2)
+        self.assertEqual(sorted(timings), [
+            'images', 'indexes', 'json', 'listings', 'pages', 'snapshots',
+            'uris',
+        ])
+
+        with app.test_request_context('/'):
+            # The website and locale of the request are read once
+            current_locale.id
+            with query_budget(0):
+                self.assertEqual(
+                    Product.get_from_uri('product-2'), product2.id
+                )
+                self.assertEqual(
+                    len(Product.get_snapshots(
+                        [product1, product2, product3]
+                    )), 3
+                )
+        self.assertIsNotNone(Media._srcset_cache.get(
+            (media.id, tuple(Media.srcset_widths), (None,))
+        ))
+
+        metrics = route_metrics.snapshot()
+        self.assertEqual(
+            metrics['product.product.render_list']['requests'], 1
+        )
+        self.assertEqual(
+            metrics['product.template.render_list']['requests'], 1
+        )
+
 
 def suite():
     "Catalog test suite"
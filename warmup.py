@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Warming of the caches of the catalog.
+
+The caches of the catalog (see :meth:`Product.invalidate_catalog_caches`)
+are built lazily by the requests needing them, hence the first requests
+after a deploy all hit the database. :func:`warm_catalog_caches` builds
+them upfront.
+
+Most of those caches live in the memory of the process, so the warming
+must run in the process serving the requests, typically in a background
+thread started by the WSGI script once the application is initialised::
+
+    from threading import Thread
+    from trytond.modules.nereid_catalog.warmup import warm_catalog_caches
+
+    app.initialise()
+    Thread(
+        target=warm_catalog_caches, args=(app, 'https://shop.example.com')
+    ).start()
+"""
+import time
+import logging
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from nereid import current_website, current_locale
+from nereid.helpers import url_for
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from snapshot import catalog_snapshot
+
+__all__ = ['catalog_request', 'warm_catalog_caches']
+
+logger = logging.getLogger('nereid_catalog.warmup')
+
+
+@contextmanager
+def catalog_request(app, base_url):
+    """
+    A context manager running its block in a readonly transaction and a
+    request context of the website of the base URL, as the nereid
+    dispatcher would for a request to that URL.
+
+    :param app: The initialised nereid application
+    :param base_url: The base URL of the website, like `https://<host>`
+    """
+    with Transaction().start(app.database_name, 0, readonly=True):
+        with app.test_request_context('/', base_url=base_url):
+            user = current_website.application_user.id
+            context = current_website.get_context()
+            context.update({
+                'company': current_website.company.id,
+            })
+            language = current_locale.language.code
+
+    with Transaction().start(
+            app.database_name, user, readonly=True, context=context):
+        with Transaction().set_context(language=language):
+            with app.test_request_context('/', base_url=base_url):
+                yield
+
+
+def warm_catalog_caches(app, base_url, top=1000, concurrency=4):
+    """
+    Build the caches of the catalog for the website of the base URL and
+    return a dictionary of the time spent (in seconds) on each stage:
+
+    `indexes`
+        The search suggestions and search indexes
+    `uris`
+        The URIs of the `top` first products of the sitemap order
+    `json`
+        The JSON payloads of those products, without the prices which
+        depend on the user
+    `images`
+        The srcsets of the images of those products
+    `snapshots`
+        The snapshots of those products listed to the guest user, and the
+        catalog snapshot when it is enabled
+    `listings`
+        The approximate counts of the product and template listings, when
+        the website counts them so
+    `pages`
+        The first pages of the product and template listings, as requested
+        by the guest user
+
+    The products are split in batches processed by `concurrency` threads,
+    each in its own transaction.
+
+    :param app: The initialised nereid application
+    :param base_url: The base URL of the website, like `https://<host>`
+    :param top: The number of products to warm
+    :param concurrency: The number of threads
+    """
+    timings = {}
+
+    def timed(stage, function, *args):
+        start = time.time()
+        result = function(*args)
+        timings[stage] = time.time() - start
+        return result
+
+    with catalog_request(app, base_url):
+        Product = Pool().get('product.product')
+        products = []
+        for batch in Product.iter_displayed_products(batch_size=top):
+            products = [(p.id, p.uri) for p in batch]
+            break
+        size = max(len(products) // concurrency, 1)
+        batches = [
+            products[index:index + size]
+            for index in xrange(0, len(products), size)
+        ]
+        timed('indexes', _warm_indexes)
+
+    def run_batches(function):
+        def run(batch):
+            with catalog_request(app, base_url):
+                function(batch)
+        pool = ThreadPool(concurrency)
+        try:
+            pool.map(run, batches)
+        finally:
+            pool.close()
+            pool.join()
+
+    timed('uris', run_batches, _warm_uris)
+    timed('json', run_batches, _warm_json)
+    timed('images', run_batches, _warm_images)
+    timed('snapshots', run_batches, _warm_snapshots)
+    with catalog_request(app, base_url):
+        timed('listings', _warm_listings)
+    timed('pages', _warm_pages, app, base_url)
+
+    logger.info(
+        'Warmed the caches of %d products in %s', len(products),
+        ', '.join(
+            '%s: %.2fs' % (stage, timings[stage]) for stage in sorted(timings)
+        )
+    )
+    return timings
+
+
+def _warm_indexes():
+    Product = Pool().get('product.product')
+
+    Product.get_suggest_index()
+    Product.get_search_index()
+
+
+def _warm_uris(batch):
+    Product = Pool().get('product.product')
+
+    for _, uri in batch:
+        Product.get_from_uri(uri)
+
+
+def _warm_json(batch):
+    Product = Pool().get('product.product')
+
+    Product._get_cached_json_fields(
+        Product.browse([id for id, _ in batch]), Product.json_allowed_fields
+    )
+
+
+def _warm_images(batch):
+    Product = Pool().get('product.product')
+
+    Product.get_page_data([id for id, _ in batch])
+
+
+def _warm_snapshots(batch):
+    Product = Pool().get('product.product')
+
+    if catalog_snapshot is not None:
+        catalog_snapshot.validate(Product.get_changed_ids)
+    Product.get_snapshots([id for id, _ in batch])
+
+
+def _warm_listings():
+    pool = Pool()
+    Product = pool.get('product.product')
+    Template = pool.get('product.template')
+
+    # Only the approximate counts are cached, with the domains of the
+    # listings as key
+    if current_website.catalog_count_mode != 'approximate' or \
+            not current_website.catalog_count_limit:
+        return
+    current_website.paginate_catalog(Product, [
+        ('displayed_on_eshop', '=', True),
+        ('template.active', '=', True),
+    ], 1, current_website.products_per_page or Product.per_page).count
+    current_website.paginate_catalog(Template, [
+        ('products', 'where', [
+            ('displayed_on_eshop', '=', True),
+            ('active', '=', True),
+        ]),
+    ], 1, current_website.products_per_page or Product.per_page).count
+
+
+def _warm_pages(app, base_url):
+    # The pages are requested through the application, which dispatches
+    # them in their own transactions
+    client = app.test_client()
+    for endpoint in [
+            'product.product.render_list',
+            'product.template.render_list']:
+        with app.test_request_context('/', base_url=base_url):
+            url = url_for(endpoint)
+        client.get(url, base_url=base_url)
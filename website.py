@@ -1,7 +1,18 @@
 # -*- coding: utf-8 -*-
+import time
+
+from trytond.cache import Cache
+from trytond.model import fields
 from trytond.pool import Pool, PoolMeta
-from nereid import request, route, render_template
-from nereid.contrib.pagination import Pagination
+from trytond.transaction import Transaction
+from nereid import (
+    request, route, render_template, abort, current_website, jsonify
+)
+
+from pagination import CatalogPagination
+from search import normalize_query
+from instrumentation import instrumented
+from replica import on_replica
 
 __all__ = ['WebSite']
 __metaclass__ = PoolMeta
@@ -10,19 +21,230 @@ __metaclass__ = PoolMeta
 class WebSite:
     __name__ = 'nereid.website'
 
+    #: The number of seconds for which the results of a search query are
+    #: reused. The results are also invalidated when the catalog changes.
+    search_results_cache_timeout = 60 * 5
+
+    _search_results_cache = Cache(
+        'nereid_catalog.website.search_results', size_limit=2048,
+        context=False
+    )
+
+    products_per_page = fields.Integer(
+        'Products per Page', help='Number of products on a listing page'
+    )
+    search_results_per_page = fields.Integer(
+        'Search Results per Page',
+        help='Number of products on a search results page'
+    )
+    max_catalog_page = fields.Integer(
+        'Max. Catalog Page',
+        help='Pages of listings and search results beyond this page are '
+        'not found. Zero or empty means no limit.'
+    )
+    catalog_count_limit = fields.Integer(
+        'Catalog Count Limit',
+        help='Listings and search results matching more products than this '
+        'limit are not counted exactly. Zero or empty means no limit.'
+    )
+    catalog_count_mode = fields.Selection([
+        ('exact', 'Exact up to the limit'),
+        ('approximate', 'Approximate beyond the limit'),
+    ], 'Catalog Count Mode', required=True,
+        help='How listings matching more products than the count limit are '
+        'counted: the limit itself, or a cached estimate of the whole result'
+    )
+
+    @staticmethod
+    def default_products_per_page():
+        return 12
+
+    @staticmethod
+    def default_search_results_per_page():
+        return 12
+
+    @staticmethod
+    def default_max_catalog_page():
+        return 100
+
+    @staticmethod
+    def default_catalog_count_limit():
+        return 1000
+
+    @staticmethod
+    def default_catalog_count_mode():
+        return 'exact'
+
+    def paginate_catalog(self, model, domain, page, per_page, order=None):
+        """
+        Return a pagination of the catalog records of the model matching
+        domain, with the page depth and count limits of the website applied.
+
+        Deep pages are an expensive OFFSET scan for the database and are
+        only ever requested by crawlers, so a page beyond
+        :attr:`max_catalog_page` (or lower than the first page) aborts the
+        request with a 404.
+
+        :param model: The model to paginate
+        :param domain: The search domain of the records
+        :param page: The page to be displayed
+        :param per_page: The number of records per page
+        """
+        too_deep = self.max_catalog_page and page > self.max_catalog_page
+        if page < 1 or too_deep:
+            abort(404)
+        return CatalogPagination(
+            model, domain, page, per_page, order,
+            count_limit=self.catalog_count_limit,
+            count_mode=self.catalog_count_mode or 'exact'
+        )
+
+    @classmethod
+    def clear_search_results_cache(cls, *args):
+        """
+        A method which conveniently clears the cache of search results
+        """
+        cls._search_results_cache.clear()
+
+    def get_search_results(self, query):
+        """
+        Return the ordered list of IDs of the displayed products matching
+        the search query.
+
+        The query is normalized (see
+        :func:`~nereid_catalog.search.normalize_query`) and the results are
+        cached per normalized query, website and language for
+        :attr:`search_results_cache_timeout` seconds, so that popular
+        queries and the pages of a result are not searched again. While the
+        search index is being built by another request, the names of the
+        products are searched instead and these results are not cached.
+
+        :param query: The search query as typed by the user
+        """
+        query = normalize_query(query)
+        key = (self.id, Transaction().language, query)
+        cached = self._search_results_cache.get(key)
+        if cached is not None and \
+                cached[0] + self.search_results_cache_timeout > time.time():
+            return cached[1]
+
+        ids = self._search_products(query)
+        if ids is None:
+            return self._search_product_names(query)
+        self._search_results_cache.set(key, (time.time(), ids))
+        return ids
+
+    def get_search_results_limit(self):
+        """
+        Return the maximum number of search results, that is the results
+        of the pages up to :attr:`max_catalog_page`, or None if the depth
+        of the pages is not limited
+        """
+        Product = Pool().get('product.product')
+
+        if not self.max_catalog_page:
+            return None
+        return self.max_catalog_page * (
+            self.search_results_per_page or Product.per_page
+        )
+
+    @staticmethod
+    def _get_search_domain():
+        return [
+            ('displayed_on_eshop', '=', True),
+            ('template.active', '=', True),
+        ]
+
+    def _search_products(self, query):
+        """
+        Search the products matching the normalized query and return their
+        IDs, the most relevant first, or None if the search index is being
+        built by another request.
+
+        The products are searched in the search index of the catalog only
+        (see :meth:`Product.get_search_index`), which tolerates typos and
+        ranks the results by the fields matching. The results beyond
+        :meth:`get_search_results_limit` are dropped and the others are
+        checked against the database, as the index of the process may not
+        have seen the latest changes of the other processes yet. An empty
+        query returns all the displayed products.
+        """
+        Product = Pool().get('product.product')
+
+        domain = self._get_search_domain()
+        limit = self.get_search_results_limit()
+        if not query:
+            return map(int, Product.search(domain, limit=limit))
+
+        index = Product.get_search_index(wait=False)
+        if index is None:
+            return None
+        ranked = index.search(query, limit=limit)
+        found = set(map(int, Product.search(
+            domain + [('id', 'in', ranked)], order=[]
+        )))
+        return [id for id in ranked if id in found]
+
+    def _search_product_names(self, query):
+        """
+        Return the IDs of the displayed products whose name contains the
+        normalized query, up to :meth:`get_search_results_limit`
+        """
+        Product = Pool().get('product.product')
+
+        return map(int, Product.search(
+            self._get_search_domain() + [
+                ('name', 'ilike', '%' + query + '%'),
+            ], limit=self.get_search_results_limit()
+        ))
+
     @classmethod
     @route('/search')
+    @on_replica
+    @instrumented
     def quick_search(cls):
-        """A quick and dirty search which searches through the product.product
-        for an insensitive like and returns a pagination object the same.
+        """A quick search through the displayed products which returns a
+        pagination object of the products matching the query, the most
+        relevant first.
+
+        The IDs of the results are cached (see :meth:`get_search_results`),
+        only the products of the page displayed are read. The `in_stock`
+        and `sort` arguments filter and sort the results by availability as
+        for :meth:`Product.render_list`, whose snapshots are available as
+        `snapshots` too.
         """
         Product = Pool().get('product.product')
 
         page = request.args.get('page', 1, type=int)
         query = request.args.get('q', '')
-        products = Pagination(Product, [
-            ('displayed_on_eshop', '=', True),
-            ('template.active', '=', True),
-            ('name', 'ilike', '%' + query + '%'),
-        ], page, Product.per_page)
-        return render_template('search-results.jinja', products=products)
+        per_page = current_website.search_results_per_page or Product.per_page
+        in_stock, sort = Product.get_availability_args()
+        products = current_website.paginate_catalog(Product, [
+            ('id', 'in', Product.filter_by_availability(
+                current_website.get_search_results(query), in_stock, sort
+            )),
+        ], page, per_page)
+        return render_template(
+            'search-results.jinja', products=products,
+            snapshots=Product.get_snapshots(products.items())
+        )
+
+    @classmethod
+    @route('/search/+suggest')
+    @on_replica
+    @instrumented
+    def search_suggestions(cls):
+        """
+        Return the products having a word of their name starting with the
+        query as JSON, for autocompletion as the user types.
+
+        The suggestions are looked up in an in-memory index of the displayed
+        products (see :meth:`Product.get_suggest_index`), hence no query
+        is made to the database for most calls.
+        """
+        Product = Pool().get('product.product')
+
+        return jsonify(results=Product.get_search_suggestions(
+            request.args.get('q', ''),
+            request.args.get('limit', None, type=int)
+        ))